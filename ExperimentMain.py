@@ -1,10 +1,9 @@
 import customtkinter as ctk
 from tkinter import messagebox
 from lib import Lens
+from session import log_power_change, log_staircase_trial, get_save_path
 import serial.tools.list_ports
 import os
-import csv
-from datetime import datetime
 import time
 
 # ------------------ CustomTkinter Settings ------------------
@@ -18,26 +17,6 @@ def center_window(window, width, height):
     y = (window.winfo_screenheight() // 2) - (height // 2)
     window.geometry(f"{width}x{height}+{x}+{y}")
 
-def get_save_path(participant_id, condition, trial_number):
-    base_dir = "data"
-    participant_dir = os.path.join(base_dir, participant_id)
-    condition_dir = os.path.join(participant_dir, condition.replace(" ", ""))
-    os.makedirs(condition_dir, exist_ok=True)
-    filename = f"trial_{trial_number}.csv"
-    return os.path.join(condition_dir, filename)
-
-def log_power_change(participant_id, trial_number, condition, right_power, left_power, save=True):
-    if condition == "Testing lenses" or not save:
-        return
-    file_path = get_save_path(participant_id, condition, trial_number)
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-    file_exists = os.path.isfile(file_path)
-    with open(file_path, 'a', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        if not file_exists:
-            writer.writerow(["timestamp","participant","trial","condition","right_power","left_power"])
-        writer.writerow([timestamp, participant_id, trial_number, condition, right_power, left_power])
-
 # ------------------ Participant Info Window ------------------
 from tkinter import ttk
 
@@ -233,25 +212,32 @@ def run_task_fixed_blur(fixed_value=1.0):
     log_power_change(participant_id, trial_number, condition, right_lens.get_diopter(), left_lens.get_diopter())
     messagebox.showinfo("Fixed Blur Condition", f"Lenses are set to {fixed_value} D for Fixed Blur condition.")
 
-def run_task_adaptive_blur(duration=10, step_interval=0.5):
+def run_task_adaptive_blur(n_trials=40, step_interval=0.5):
     """
-    Runs an adaptive blur sequence for a total of 'duration' seconds.
-    step_interval: seconds between power updates
+    Runs a psi-method staircase on blur detection for 'n_trials' trials.
+    step_interval: seconds the lenses get to settle before the participant answers
     """
-    start_time = time.time()
-    # Example sequence of blur values that repeat
-    sequence = [0, 1, 2, 3]
-    idx = 0
-    while time.time() - start_time < duration:
-        val = sequence[idx % len(sequence)]
-        set_lens_power(val)
-        log_power_change(participant_id, trial_number, condition,
-                         right_lens.get_diopter(), left_lens.get_diopter())
+    from adaptive_blur import PsiStaircase, run_adaptive_blur  # numpy is only needed for this condition
+
+    def ask_participant(blur):
         time.sleep(step_interval)
-        idx += 1
+        return messagebox.askyesno("Adaptive Blur", "Does the target look blurred?")
+
+    staircase = PsiStaircase()
+
+    def log_estimate(trial, blur, response, selection_time):
+        threshold, slope = staircase.estimate()
+        log_staircase_trial(participant_id, trial_number, trial + 1, blur, response, selection_time, threshold, slope)
+        print(f"[ADAPTIVE] Trial {trial + 1}: blur {blur:.2f} D, blurred={response}, "
+              f"next level chosen in {selection_time * 1000:.2f} ms")
+
+    run_adaptive_blur(set_lens_power, ask_participant, n_trials=n_trials, staircase=staircase, on_trial=log_estimate)
+    threshold, slope = staircase.estimate()
+    print(f"[ADAPTIVE] Estimated threshold {threshold:.2f} D, slope {slope:.2f}; "
+          f"saved to data/{participant_id}/{participant_id}_adaptive_blur.csv")
     # Use existing root as parent to avoid creating a new hidden Tk window
     messagebox.showinfo("Adaptive Blur Condition",
-                        "Adaptive Blur sequence completed.")
+                        f"Adaptive Blur sequence completed.\n\nEstimated blur threshold: {threshold:.2f} D")
 # ------------------ Launch GUI for Testing Lenses ------------------
 if condition == "Testing lenses":
     root = ctk.CTk()
@@ -318,6 +304,7 @@ else:
     else:
         messagebox.showerror("Error", f"Unknown condition: {condition}")
 
-    # Close lenses after condition run
-    for lens in lenses:
-        lens.connection.close()
+    # Close lenses after condition run and keep their serial command statistics with the trial data
+    session_dir = os.path.dirname(get_save_path(participant_id, condition, trial_number))
+    for side, lens in zip(["right", "left"], lenses):
+        lens.lens_close(os.path.join(session_dir, f"trial_{trial_number}_{side}_lens_stats.json"))
@@ -1,5 +1,7 @@
 import customtkinter as ctk
 from lib import Lens
+import lens_daemon
+from lens_profiles import profile_for
 import serial.tools.list_ports
 from tkinter import messagebox, PhotoImage
 
@@ -8,8 +10,11 @@ ctk.set_appearance_mode("Light")
 ctk.set_default_color_theme("blue")
 
 # ------------------ Detect Lenses ------------------
+# A running lens daemon already holds the ports; otherwise open them directly
+lens_client = lens_daemon.connect()
+remote_lenses = lens_client.lenses() if lens_client is not None else []
 ports = list(serial.tools.list_ports.comports())
-if len(ports) == 0:
+if len(ports) == 0 and not remote_lenses:
     messagebox.showerror("No Lenses Detected", "Please connect at least one lens and restart.")
     exit()
 
@@ -19,29 +24,14 @@ lens_types = []
 slider_ranges = []
 preset_values_all = []
 
-for p in ports:
-    lens = Lens(p.name)
+for lens in remote_lenses or [Lens(p.name) for p in ports]:
     lens.to_focal_power_mode()
     lenses.append(lens)
 
-    serial_num = lens.get_lens_serial_number()
-
-    if serial_num.startswith("ANAB"):  # EL-16-40
-        lens_type = "EL-16-40"
-        slider_min, slider_max = -10.0, 10.0
-        presets = [-10, -5, -2, 0, 2, 5, 10]
-    elif serial_num.startswith("CBAA"):  # Autofocal EL-35-45
-        lens_type = "Autofocal EL-35-45"
-        slider_min, slider_max = -2.0, 3.0
-        presets = [-2, -1, 0, 1, 2, 3]
-    else:
-        lens_type = "Unknown"
-        slider_min, slider_max = -2.0, 3.0
-        presets = [-2, -1, 0, 1, 2, 3]
-
-    lens_types.append(lens_type)
-    slider_ranges.append((slider_min, slider_max))
-    preset_values_all.append(presets)
+    profile = profile_for(lens.get_lens_serial_number())
+    lens_types.append(profile.model)
+    slider_ranges.append(profile.slider_range)
+    preset_values_all.append(profile.presets)
 
 # ------------------ Helper Functions ------------------
 def center_window(window, width, height):
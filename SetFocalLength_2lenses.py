@@ -5,17 +5,18 @@ Created on Mon Feb 15 13:47:04 2021
 @author: Rajat Agarwala, ZVSL
 """
 
+from startup import StartupTimer
+startup_timer = StartupTimer()
+
 from lib import Lens
 import serial.tools.list_ports
-import time
-import numpy
 
 import tkinter as tk
 import tkinter.messagebox as tkMessageBox
 from tkinter.messagebox import _show
 from tkinter import *
-from PIL import ImageTk, Image
 from functools import partial
+startup_timer.mark("imports done")
 
 ##Determine COM port to which the serial device is connected
 # only 1st four characters contain COM port number
@@ -110,6 +111,8 @@ if len(ports) > 1:
 
 
     root.protocol("WM_DELETE_WINDOW", on_closing)
+    startup_timer.mark("lenses initialized")
+    root.after_idle(lambda: (startup_timer.mark("window shown"), startup_timer.report()))
     root.mainloop()
 
 else:
@@ -153,4 +156,6 @@ else:
             root1.destroy()
 
     root1.protocol("WM_DELETE_WINDOW", on_closing)
+    startup_timer.mark("lens initialized")
+    root1.after_idle(lambda: (startup_timer.mark("window shown"), startup_timer.report()))
     root1.mainloop()
\ No newline at end of file
@@ -12,7 +12,7 @@ a = Analysis(['SetFocalLength_2lenses.py'],
              hookspath=[],
              hooksconfig={},
              runtime_hooks=[],
-             excludes=[],
+             excludes=['numpy', 'PIL', 'pandas'],  # not used by the lens GUI; keeps the exe small and quick to unpack
              win_no_prefer_redirects=False,
              win_private_assemblies=False,
              cipher=block_cipher,
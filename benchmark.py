@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the lens protocol, session logging and block generation.
+
+Serial benchmarks run real lib.Lens objects against lens_emulator.LensEmulator
+(Linux only). Results are written as JSON, keyed by git commit, so two runs can
+be compared:
+
+    python benchmark.py                         # writes benchmark_results/<commit>.json
+    python benchmark.py --compare benchmark_results/abc1234.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from lib import Lens, crc_16
+from lens_emulator import LensEmulator
+import session
+
+RESULTS_DIR = "benchmark_results"
+
+
+def measure(fn, number=1000, repeat=5, warmup=1):
+    """Times fn() 'number' times per round over 'repeat' rounds; returns seconds per call stats."""
+    for _ in range(warmup):
+        fn()
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - start) / number)
+    return {
+        "number": number,
+        "repeat": repeat,
+        "min_s": min(rounds),
+        "median_s": statistics.median(rounds),
+        "mean_s": statistics.fmean(rounds),
+        "stdev_s": statistics.stdev(rounds) if len(rounds) > 1 else 0.0,
+    }
+
+
+class NullOutlet:
+    def push_sample(self, sample, timestamp=0.0):
+        pass
+
+    def push_chunk(self, samples, timestamps=None):
+        pass
+
+
+class NullDisplay:
+    def show(self, text, font=None):
+        pass
+
+
+# ------------------ Benchmarks ------------------
+def bench_crc(results, scale):
+    # Typical frame sizes: 'H'/'X' (1), 'MMA'/'TCA' (3), 'Aw' (4), 'PwDA'/'PrDA' (8), 'IR' (10), replies (~12)
+    for size in (1, 3, 4, 8, 10, 12):
+        frame = bytes(random.Random(size).randrange(256) for _ in range(size))
+        results[f"crc_16[{size}B]"] = measure(lambda: crc_16(frame), number=20000 * scale)
+
+
+def bench_serial(results, scale, latency):
+    emulators = [LensEmulator(serial_number=f"CBAA{i:04d}", latency=latency).start() for i in range(2)]
+    try:
+        lenses = [Lens(emu.port) for emu in emulators]
+        for lens in lenses:
+            lens.to_focal_power_mode()
+        lens = lenses[0]
+
+        results["send_command[PrDA round trip]"] = measure(lambda: lens.send_command(b'PrDA\x00\x00\x00\x00', '>xxh'),
+                                                            number=200 * scale)
+        results["send_command[TCA round trip]"] = measure(lens.get_temperature, number=200 * scale)
+
+        values = [0.0, 0.5, 1.0, 1.5, 2.0]
+        state = {"i": 0}
+
+        def set_one():
+            state["i"] += 1
+            lens.set_diopter(values[state["i"] % len(values)])
+
+        def set_two():
+            state["i"] += 1
+            for l in lenses:
+                l.set_diopter(values[state["i"] % len(values)])
+
+        results["set_diopter[1 lens]"] = measure(set_one, number=500 * scale)
+        results["set_diopter[2 lenses]"] = measure(set_two, number=500 * scale)
+
+        markers = session.MarkerSender(NullOutlet(), os.path.join("data", "bench_triggers.csv"), verbose=False,
+                                       clock=time.perf_counter)
+        display = NullDisplay()
+        runner = session.BlockRunner("bench", lenses, markers, display, lambda **kw: None,
+                                     sleep=lambda s: None, post_task_wait=lambda: 7.5)
+        blocks = session.generate_blocks(*session.get_blur_levels(0.0, False))
+        state["b"] = 0
+
+        def run_one_block():
+            state["b"] += 1
+            with contextlib.redirect_stdout(io.StringIO()):
+                runner.run_block(blocks[state["b"] % len(blocks)])
+
+        results["run_block[zero sleeps, 2 lenses]"] = measure(run_one_block, number=20 * scale)
+
+        for l in lenses:
+            l.connection.close()
+    finally:
+        for emu in emulators:
+            emu.stop()
+
+
+def bench_logging(results, scale):
+    now = datetime.now()
+    results["log_power_change"] = measure(
+        lambda: session.log_power_change("bench", 1, "Fixed Blur", 1.0, 1.0), number=500 * scale)
+    results["log_trial"] = measure(
+        lambda: session.log_trial("bench", 1, "Visuomotor_1.0", 1.0, 1.0, now, now), number=500 * scale)
+    markers = session.MarkerSender(NullOutlet(), os.path.join("data", "bench_triggers.csv"), verbose=False,
+                                   clock=time.perf_counter)
+    results["send_marker"] = measure(lambda: markers.send(30, "Active Onset"), number=500 * scale)
+
+
+def bench_blocks(results, scale):
+    rng = random.Random(0)
+    main_levels = session.get_blur_levels(0.0, False)
+    results["generate_blocks[main]"] = measure(
+        lambda: session.generate_blocks(*main_levels, shuffle=rng.shuffle), number=2000 * scale)
+
+
+# ------------------ Reporting ------------------
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(results, baseline=None):
+    for name, stats in results.items():
+        line = f"{name:<40} {stats['median_s'] * 1e6:>12.2f} us"
+        if baseline and name in baseline:
+            ratio = stats["median_s"] / baseline[name]["median_s"]
+            line += f"   x{ratio:.2f} vs baseline"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark lens protocol, logging and session generation.")
+    parser.add_argument("--scale", type=int, default=1, help="multiply iteration counts")
+    parser.add_argument("--latency", type=float, default=0.0, help="emulated lens reply latency (s)")
+    parser.add_argument("--skip-serial", action="store_true", help="skip benchmarks that need the pty emulator")
+    parser.add_argument("--output", help="JSON result file (default: benchmark_results/<commit>.json)")
+    parser.add_argument("--compare", help="previous JSON result file to compare against")
+    args = parser.parse_args(argv)
+
+    random.seed(0)
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            bench_crc(results, args.scale)
+            bench_blocks(results, args.scale)
+            bench_logging(results, args.scale)
+            if not args.skip_serial:
+                bench_serial(results, args.scale, args.latency)
+        finally:
+            os.chdir(cwd)
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "scale": args.scale,
+        "latency": args.latency,
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+    print(f"[INFO] Benchmark results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Calibration sweep for connected lenses.
+
+For every lens the sweep
+  1. steps the drive current in current mode and records the focal-power and
+     temperature readbacks,
+  2. steps between focal-power set points and times how long the readback
+     takes to settle,
+then fits the current-to-diopter and settle-time models with least squares
+and stores them, with the inverted lookup table, under calibration/<lens_serial>.json.
+
+    python calibrate_lens.py                 # all connected lenses
+    python calibrate_lens.py --emulate 1     # dry run against the pty emulator
+"""
+
+import argparse
+import csv
+import itertools
+import os
+import time
+
+import numpy as np
+
+from lib import Lens
+from command_shaping import shaper_for
+from lens_calibration import (CalibrationStore, fit_current_model, fit_settle_model, table_from_model,
+                              predict_diopter)
+
+
+def sweep_current(lens, currents, settle=0.1):
+    rows = []
+    lens.to_current_mode()
+    for current in currents:
+        lens.set_current(float(current))
+        time.sleep(settle)
+        rows.append((float(current), lens.get_diopter(), lens.get_temperature()))
+    lens.set_current(0.0)
+    return rows
+
+
+def measure_settle_time(lens, start, target, tolerance=0.02, consecutive=3, timeout=2.0, hold=0.5):
+    """Seconds from the set_diopter(target) command until 'consecutive' readbacks lie within tolerance."""
+    lens.set_diopter(start)
+    time.sleep(hold)
+    t0 = time.perf_counter()
+    lens.set_diopter(target)
+    in_band, settled_at = 0, None
+    while time.perf_counter() - t0 < timeout:
+        reading = lens.get_diopter()
+        now = time.perf_counter() - t0
+        if abs(reading - target) <= tolerance:
+            if in_band == 0:
+                settled_at = now
+            in_band += 1
+            if in_band >= consecutive:
+                return settled_at
+        else:
+            in_band = 0
+    return timeout
+
+
+def sweep_steps(lens, set_points, tolerance=0.02):
+    rows = []
+    lens.to_focal_power_mode()
+    for start, target in itertools.permutations(set_points, 2):
+        settle_time = measure_settle_time(lens, start, target, tolerance)
+        rows.append((start, target, target - start, settle_time, lens.get_temperature()))
+    return rows
+
+
+def compare_shaping(lens, set_points, shaper, tolerance=0.02):
+    """Settle time of every step between set points, plain and with the overdrive shaper."""
+    rows = []
+    lens.to_focal_power_mode()
+    saved_shaper = lens.shaper
+    try:
+        for start, target in itertools.permutations(set_points, 2):
+            lens.shaper = None
+            plain = measure_settle_time(lens, start, target, tolerance)
+            lens.shaper = shaper
+            shaped = measure_settle_time(lens, start, target, tolerance)
+            rows.append((start, target, plain, shaped))
+    finally:
+        lens.shaper = saved_shaper
+    return rows
+
+
+def calibrate(lens, current_range, set_points, store, diopters=None, temperatures=(20.0, 30.0, 40.0),
+              output_dir=None):
+    print(f"[CALIBRATION] Lens {lens.lens_serial}: current sweep {current_range[0]:.0f}..{current_range[1]:.0f} mA")
+    current_rows = np.array(sweep_current(lens, np.linspace(current_range[0], current_range[1], 41)))
+    print(f"[CALIBRATION] Lens {lens.lens_serial}: {len(set_points) * (len(set_points) - 1)} focal-power steps")
+    step_rows = np.array(sweep_steps(lens, set_points))
+
+    current_model = fit_current_model(current_rows[:, 0], current_rows[:, 1], current_rows[:, 2])
+    settle_model = fit_settle_model(step_rows[:, 2], step_rows[:, 3], step_rows[:, 4])
+    models = {
+        "current_to_diopter": current_model,
+        "settle_time": settle_model,
+        "current_range_ma": list(current_range),
+        "calibrated": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+    if diopters is None:
+        reachable = predict_diopter(current_model, np.array(current_range), float(np.mean(current_rows[:, 2])))
+        diopters = np.linspace(reachable.min(), reachable.max(), 51)
+    table = table_from_model(lens.lens_serial, current_model, current_range, diopters, temperatures, models)
+    path = store.save(table)
+
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, f"{lens.lens_serial}_current_sweep.csv"), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["current_ma", "diopter", "temperature"])
+            writer.writerows(current_rows.tolist())
+        with open(os.path.join(output_dir, f"{lens.lens_serial}_step_sweep.csv"), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["start", "target", "step", "settle_time", "temperature"])
+            writer.writerows(step_rows.tolist())
+
+    print(f"[CALIBRATION] Lens {lens.lens_serial}: fit rmse {current_model['rmse_d']:.3f} D, "
+          f"settle {settle_model['coef']} (max {settle_model['max_s'] * 1000:.0f} ms) -> {path}")
+    lens.to_focal_power_mode()
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep and fit current/diopter and settle-time models per lens.")
+    parser.add_argument("--current-range", type=float, nargs=2, metavar=("MIN_MA", "MAX_MA"),
+                        help="drive current sweep range (default 0 to 80%% of the driver maximum)")
+    parser.add_argument("--set-points", type=float, nargs="+", default=[-2, -1, 0, 0.5, 1, 2, 3],
+                        help="focal-power set points for the step sweep (D)")
+    parser.add_argument("--store", default="calibration", help="calibration directory")
+    parser.add_argument("--raw-output", help="also write raw sweep CSVs to this directory")
+    parser.add_argument("--emulate", type=int, default=0, help="calibrate this many pty emulators instead")
+    parser.add_argument("--compare-shaping", action="store_true",
+                        help="after fitting, time every step with and without overdrive shaping")
+    args = parser.parse_args(argv)
+
+    emulators = []
+    if args.emulate:
+        from lens_emulator import LensEmulator
+        emulators = [LensEmulator(serial_number=f"CBAA{i:04d}", settle_tau=0.03).start() for i in range(args.emulate)]
+        ports = [emu.port for emu in emulators]
+    else:
+        import serial.tools.list_ports
+        ports = [p.name if os.name == "nt" else p.device for p in serial.tools.list_ports.comports()]
+
+    store = CalibrationStore(args.store)
+    try:
+        for port in ports:
+            lens = Lens(port)
+            current_range = args.current_range or (0.0, 0.8 * lens.max_output_current)
+            table = calibrate(lens, current_range, args.set_points, store, output_dir=args.raw_output)
+            if args.compare_shaping:
+                rows = np.array(compare_shaping(lens, args.set_points, shaper_for(lens, store)))
+                # Only lenses with a measured shaped model get shaping in the experiment scripts
+                table.models["settle_time_shaped"] = fit_settle_model(rows[:, 1] - rows[:, 0], rows[:, 3],
+                                                                     np.full(len(rows), lens.get_temperature()))
+                store.save(table)
+                print(f"[CALIBRATION] Lens {lens.lens_serial}: mean settle {rows[:, 2].mean() * 1000:.0f} ms plain, "
+                      f"{rows[:, 3].mean() * 1000:.0f} ms shaped (max {rows[:, 2].max() * 1000:.0f} / "
+                      f"{rows[:, 3].max() * 1000:.0f} ms)")
+            lens.lens_close()
+    finally:
+        for emu in emulators:
+            emu.stop()
+
+
+if __name__ == "__main__":
+    main()
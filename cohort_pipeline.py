@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Cohort aggregation with cached per-participant stages.
+
+Every participant goes through the same steps in a worker process:
+
+    logs      <pid>_blocks.csv + _triggers.csv + _trials.csv -> one row per trial
+              (condition, powers read back, Active Onset / Task Offset times)
+    epochs    signal_store/<pid> cut at every Active Onset (epoching.extract_epochs)
+    summary   per-condition block count, mean response in a window and its SEM
+
+Each stage's result is saved under cache/<stage>/ with a key hashed from
+the stage's version (STAGE_VERSIONS), its parameters, the content digests
+of its input files and what it uses of the stage before (the epochs only
+see the onsets). A rerun loads
+every result whose key still matches, so changing the summary window
+recomputes summaries only, and a new or re-recorded participant is the only
+one whose logs and epochs are redone. File digests are remembered per
+(size, mtime) and not re-read while a file is untouched.
+
+    python cohort_pipeline.py                         # every participant under data/
+    python cohort_pipeline.py P01 P02 --window 5 15
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from epoching import extract_epochs, load_triggers
+from glm import block_intervals
+from session import load_blocks
+from signal_store import STORE_DIR, SignalStore
+
+CACHE_DIR = "cache"
+# Bump a stage's version whenever a code change alters its results, so cached ones are recomputed
+STAGE_VERSIONS = {"logs": 1, "onsets": 1, "epochs": 1, "summary": 1}
+
+
+def file_digest(path, block_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class ResultCache:
+    """Stage results on disk, addressed by a hash of everything they were computed from."""
+
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+
+    def key(self, stage, params, inputs):
+        """inputs: digests of input files and keys of upstream stages."""
+        text = json.dumps({"stage": stage, "version": STAGE_VERSIONS[stage], "params": params, "inputs": inputs},
+                          sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, stage, participant_id, key, extension):
+        return os.path.join(self.directory, stage, f"{participant_id}_{key[:16]}.{extension}")
+
+    def load(self, stage, participant_id, key, extension="json"):
+        path = self.path(stage, participant_id, key, extension)
+        if not os.path.isfile(path):
+            return None
+        if extension == "npz":
+            with np.load(path) as arrays:
+                return {name: arrays[name] for name in arrays.files}
+        with open(path) as f:
+            return json.load(f)
+
+    def save(self, stage, participant_id, key, result, extension="json"):
+        path = self.path(stage, participant_id, key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name so an interrupted run never leaves a truncated hit
+        partial = path + ".partial"
+        with open(partial, "wb" if extension == "npz" else "w") as f:
+            if extension == "npz":
+                np.savez(f, **result)
+            else:
+                json.dump(result, f)
+        os.replace(partial, path)
+        return result
+
+    def digests(self, participant_id, paths):
+        """Content digests of paths, re-hashing only files whose size or mtime changed since the last run."""
+        index_path = os.path.join(self.directory, "digests", f"{participant_id}.json")
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        digests = {}
+        for path in paths:
+            stat = os.stat(path)
+            entry = index.get(path)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_digest(path)}
+                index[path] = entry
+            digests[os.path.basename(path)] = entry["sha256"]
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        with open(index_path, "w") as f:
+            json.dump(index, f)
+        return digests
+
+
+def merge_logs(blocks_path, triggers_path, trials_path):
+    """One dict per trial: the trials.csv row joined with its Active Onset and Task Offset times."""
+    plan = load_blocks(blocks_path)
+    times, codes, _ = load_triggers(triggers_path)
+    intervals = block_intervals(plan, times, codes)
+    with open(trials_path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    if len(rows) != len(intervals):
+        raise Exception(f"{trials_path}: {len(rows)} trials but {len(intervals)} active periods in the trigger log")
+    trials = []
+    for row, ((task, blur), onset, offset) in zip(rows, intervals):
+        if row["condition"] != f"{task}_{blur}":
+            raise Exception(f"{trials_path}: trial {row['trial']} is {row['condition']}, triggers say {task}_{blur}")
+        trials.append({"trial": int(row["trial"]), "task": task, "blur": blur,
+                       "right_power": float(row["right_power"]), "left_power": float(row["left_power"]),
+                       "onset": onset, "offset": offset})
+    return {"trials": trials}
+
+
+def cut_epochs(store, trials, tmin, tmax, baseline):
+    """(trials x channels x time) epochs with the trial number of each kept one."""
+    onsets = np.searchsorted(store.times, [trial["onset"] for trial in trials])
+    start = int(round(tmin * store.sfreq))
+    length = int(round((tmax - tmin) * store.sfreq)) + 1
+    window = (int(round((baseline[0] - tmin) * store.sfreq)), int(round((baseline[1] - tmin) * store.sfreq)))
+    epochs, keep = extract_epochs(store.data, onsets, start, length, window)
+    return {"epochs": np.asarray(epochs, np.float32),
+            "trial": np.array([trial["trial"] for trial in trials])[keep],
+            "sfreq": np.array(store.sfreq)}
+
+
+def summarize(trials, epochs, tmin, window):
+    """Per condition: blocks, lens power error and (with epochs) the mean response in window with its SEM."""
+    by_trial = {trial["trial"]: trial for trial in trials}
+    summary = {}
+    for trial in trials:
+        name = f"{trial['task']}_{trial['blur']}"
+        entry = summary.setdefault(name, {"task": trial["task"], "blur": trial["blur"], "blocks": 0,
+                                          "power_error": 0.0})
+        entry["blocks"] += 1
+        entry["power_error"] = max(entry["power_error"], abs(trial["right_power"] - trial["blur"]),
+                                   abs(trial["left_power"] - trial["blur"]))
+    if epochs is not None and len(epochs["trial"]):
+        sfreq = float(epochs["sfreq"])
+        first, last = (int(round((t - tmin) * sfreq)) for t in window)
+        # Mean over the window, per epoch and channel
+        amplitude = epochs["epochs"][:, :, first:last + 1].mean(axis=2)
+        names = np.array([f"{by_trial[t]['task']}_{by_trial[t]['blur']}" for t in epochs["trial"].tolist()])
+        for name, entry in summary.items():
+            values = amplitude[names == name]
+            entry["epochs"] = len(values)
+            if len(values):
+                entry["amplitude"] = values.mean(axis=0).tolist()
+                entry["sem"] = (values.std(axis=0, ddof=1) / np.sqrt(len(values))).tolist() if len(values) > 1 \
+                    else [0.0] * values.shape[1]
+    return summary
+
+
+def process_participant(participant_id, params, data_dir="data", store_dir=STORE_DIR, cache_dir=CACHE_DIR):
+    """Runs the three stages for one participant, loading each from the cache when its key matches."""
+    cache = ResultCache(cache_dir)
+    folder = os.path.join(data_dir, participant_id)
+    log_paths = [os.path.join(folder, f"{participant_id}_{name}.csv") for name in ("blocks", "triggers", "trials")]
+    recomputed = []
+
+    logs_key = cache.key("logs", {}, cache.digests(participant_id, log_paths))
+    logs = cache.load("logs", participant_id, logs_key)
+    if logs is None:
+        logs = cache.save("logs", participant_id, logs_key, merge_logs(*log_paths))
+        recomputed.append("logs")
+
+    epochs, epochs_key = None, None
+    store_path = os.path.join(store_dir, participant_id)
+    if os.path.isfile(os.path.join(store_path, "meta.json")):
+        epoch_params = {name: params[name] for name in ("tmin", "tmax", "baseline")}
+        store_files = [os.path.join(store_path, name) for name in ("signal.f32", "times.f64", "meta.json")]
+        # Keyed on the onsets, not the whole logs result: a corrected power reading does not re-cut epochs
+        onsets = cache.key("onsets", {}, [(trial["trial"], trial["onset"]) for trial in logs["trials"]])
+        inputs = dict(cache.digests(participant_id, store_files), onsets=onsets)
+        epochs_key = cache.key("epochs", epoch_params, inputs)
+        epochs = cache.load("epochs", participant_id, epochs_key, "npz")
+        if epochs is None:
+            epochs = cache.save("epochs", participant_id, epochs_key,
+                                cut_epochs(SignalStore(store_path), logs["trials"], **epoch_params), "npz")
+            recomputed.append("epochs")
+
+    summary_params = {"window": params["window"], "tmin": params["tmin"]}
+    summary_key = cache.key("summary", summary_params, {"logs": logs_key, "epochs": epochs_key})
+    summary = cache.load("summary", participant_id, summary_key)
+    if summary is None:
+        summary = cache.save("summary", participant_id, summary_key,
+                             summarize(logs["trials"], epochs, params["tmin"], params["window"]))
+        recomputed.append("summary")
+    return participant_id, summary, recomputed
+
+
+def _run_participant(task):
+    participant_id, params, data_dir, store_dir, cache_dir = task
+    try:
+        return process_participant(participant_id, params, data_dir, store_dir, cache_dir)
+    except Exception as e:
+        return participant_id, None, [f"error: {e}"]
+
+
+def find_participants(data_dir="data"):
+    return sorted(pid for pid in os.listdir(data_dir)
+                  if os.path.isfile(os.path.join(data_dir, pid, f"{pid}_triggers.csv")))
+
+
+def run_cohort(participant_ids=None, tmin=-5.0, tmax=25.0, baseline=(-5.0, 0.0), window=(5.0, 15.0),
+               data_dir="data", store_dir=STORE_DIR, cache_dir=CACHE_DIR, workers=None):
+    """{pid: (summary or None, stages recomputed)} for the cohort, one participant per worker task."""
+    if participant_ids is None:
+        participant_ids = find_participants(data_dir)
+    params = {"tmin": tmin, "tmax": tmax, "baseline": list(baseline), "window": list(window)}
+    tasks = [(pid, params, data_dir, store_dir, cache_dir) for pid in participant_ids]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return {pid: (summary, recomputed) for pid, summary, recomputed in pool.map(_run_participant, tasks)}
+
+
+def write_cohort_table(results, path):
+    """One row per participant and condition; amplitude and SEM are averaged over channels."""
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["participant", "task", "blur", "blocks", "epochs", "power_error", "amplitude", "sem"])
+        for pid, (summary, _) in sorted(results.items()):
+            for entry in (summary or {}).values():
+                writer.writerow([pid, entry["task"], entry["blur"], entry["blocks"], entry.get("epochs", ""),
+                                 f"{entry['power_error']:.3f}",
+                                 f"{np.mean(entry['amplitude']):.6g}" if "amplitude" in entry else "",
+                                 f"{np.mean(entry['sem']):.6g}" if "sem" in entry else ""])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-participant logs, epochs and summaries with cached stages.")
+    parser.add_argument("participants", nargs="*", help="default: every participant folder under --data")
+    parser.add_argument("--data", default="data")
+    parser.add_argument("--store", default=STORE_DIR)
+    parser.add_argument("--cache", default=CACHE_DIR)
+    parser.add_argument("--tmin", type=float, default=-5.0)
+    parser.add_argument("--tmax", type=float, default=25.0)
+    parser.add_argument("--baseline", type=float, nargs=2, default=[-5.0, 0.0], metavar=("START_S", "END_S"))
+    parser.add_argument("--window", type=float, nargs=2, default=[5.0, 15.0], metavar=("START_S", "END_S"),
+                        help="response window after Active Onset")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--output", default="cohort_summary.csv")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = run_cohort(args.participants or None, args.tmin, args.tmax, tuple(args.baseline), tuple(args.window),
+                         args.data, args.store, args.cache, args.workers)
+    write_cohort_table(results, args.output)
+    for pid, (_, recomputed) in sorted(results.items()):
+        print(f"[INFO] {pid}: " + (", ".join(recomputed) if recomputed else "all stages cached"))
+    print(f"[INFO] {len(results)} participants in {time.perf_counter() - start:.2f} s -> {args.output}")
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Overdrive shaping of focal-power steps.
+
+A plain step settles with the lens's own time constant tau. The shaper first
+commands a point k times further along the step, holds it for
+tau*ln(k/(k-1)), then commands the real target. For a first-order response
+the lens reaches the target at the end of the pulse instead of creeping up to
+it over several tau.
+
+tau comes from the settle-time model: for a first-order response, the time to
+come within a tolerance e of the target is tau*ln|step| - tau*ln(e), so tau is
+the ln|step| coefficient fitted by lens_calibration.fit_settle_model. Overdrive
+points are clamped to the lens's focal-power range. With a calibration table
+they are also kept to safe_fraction of the driver's maximum output current
+(get_max_output_current).
+
+    lens.shaper = shaper_for(lens)
+    lens.set_diopter(1.5)        # overdrive pulse, then 1.5 D
+    set_diopters(lenses, 1.5)    # both eyes pulsed together
+"""
+
+import math
+import time
+
+import numpy as np
+
+from lens_calibration import CalibrationStore
+from lens_profiles import profile_for
+
+
+class CommandShaper:
+    def __init__(self, tau, safe_range, overdrive=2.0, table=None, max_output_current=None, safe_fraction=0.9,
+                 min_pulse=0.002):
+        self.tau = tau
+        self.overdrive = overdrive
+        self.min_pulse = min_pulse
+        low, high = safe_range
+        if table is not None and max_output_current:
+            # Stop short of the first tabulated diopter, either side of the lowest-current point, whose
+            # calibrated drive current exceeds the safe fraction of the driver maximum
+            temperature = float(np.mean(table.temperatures))
+            currents = np.abs(table.current_for(table.diopters, temperature))
+            over = table.diopters[currents > safe_fraction * max_output_current]
+            rest = table.diopters[np.argmin(currents)]
+            if np.any(over > rest):
+                high = min(high, float(over[over > rest].min()))
+            if np.any(over < rest):
+                low = max(low, float(over[over < rest].max()))
+        self.safe_range = (low, high)
+
+    def plan(self, previous, target):
+        """Command sequence [(diopter, hold_s), ...] for a step from previous to target."""
+        step = target - previous
+        if self.tau <= 0 or abs(step) < 1e-6:
+            return [(target, 0.0)]
+        peak = min(max(previous + self.overdrive * step, self.safe_range[0]), self.safe_range[1])
+        gain = (peak - previous) / step
+        if gain <= 1.0:
+            # Clamped all the way back to the target: nothing left to overdrive with
+            return [(target, 0.0)]
+        pulse = self.tau * math.log(gain / (gain - 1.0))
+        if pulse < self.min_pulse:
+            return [(target, 0.0)]
+        return [(peak, pulse), (target, 0.0)]
+
+    def apply(self, send, previous, target):
+        """Runs the plan through send(diopter), holding each pulse with sub-millisecond accuracy."""
+        for diopter, hold in self.plan(previous, target):
+            start = time.perf_counter()
+            send(diopter)
+            if hold:
+                hold_until(start + hold)
+
+
+def hold_until(end):
+    """Waits until perf_counter() reaches end; time.sleep can overshoot by a scheduler tick, so spin the last 2 ms."""
+    remaining = end - time.perf_counter()
+    if remaining > 0.004:
+        time.sleep(remaining - 0.002)
+    while time.perf_counter() < end:
+        pass
+
+
+def set_diopters(lenses, diopter):
+    """
+    Steps several lenses to one focal power together. All overdrive pulses
+    start at once and each lens gets its final command when its own pulse
+    ends, instead of one lens's pulse delaying the next lens's step. Lenses
+    without a shaper (or without a known previous target) get a plain write.
+    """
+    pulses, plain = [], []
+    for lens in lenses:
+        shaper, previous = getattr(lens, "shaper", None), getattr(lens, "commanded_diopter", None)
+        plan = shaper.plan(previous, diopter) if shaper is not None and previous is not None else [(diopter, 0.0)]
+        if len(plan) > 1:
+            if lens.mode != 5:
+                raise Exception('Cannot set focal power when not in focal power mode')
+            pulses.append((lens, plan[0]))
+        else:
+            plain.append(lens)
+
+    start = time.perf_counter()
+    for lens, (peak, _) in pulses:
+        lens.write_diopter(peak)
+    for lens in plain:
+        lens.set_diopter(diopter)
+    for lens, (_, hold) in sorted(pulses, key=lambda pulse: pulse[1][1]):
+        hold_until(start + hold)
+        lens.write_diopter(diopter)
+        lens.commanded_diopter = diopter
+
+
+def shaper_for(lens, store=None, overdrive=2.0, safe_fraction=0.9):
+    """
+    CommandShaper for a connected lens, using its calibrated settle model and
+    table when the calibration store has them, else its profile's model if the
+    lens type has one. Returns None when neither gives a time constant.
+    """
+    store = store or CalibrationStore()
+    profile = profile_for(lens.lens_serial)
+    model, table = profile.settle_model, None
+    if store.has(lens.lens_serial):
+        table = store.load(lens.lens_serial)
+        model = table.models.get("settle_time") or model
+    if model is None:
+        return None
+    safe_range = getattr(lens, "focal_power_range", None) or profile.safe_range
+    return CommandShaper(model["coef"][1], safe_range, overdrive, table, lens.max_output_current, safe_fraction)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Design-efficiency search over block orders and post-task jitter.
+
+Candidates are drawn the way the experiment draws them: generate_blocks
+shuffles within each repetition and the post-task waits come from
+uniform(5, 10). Each candidate's timeline follows BlockRunner (lens switch,
+3 s prep, 10/20 s active, jittered rest); the switch phase defaults to the
+runner's session.SWITCH_PHASE_S, which is 0 while lenses are pre-positioned
+during the rest. It is scored by the A-efficiency
+of the blur contrasts (glm.blur_contrast_weights), 1 / trace(C (X'X)^-1 C').
+
+Candidates are scored in batches: all boxcars of a batch are convolved with
+the HRF in one FFT and all X'X are inverted in one stacked call. Batches are
+spread over a process pool. The best schedule is written in the _blocks.csv
+format with its waits next to it, under the run id the experiment form
+builds (P01_Main, or P01_Practice with --practice), where
+fNIRS_blockswithInstructions.py picks it up (session.load_schedule).
+
+    python design_optimizer.py P01 --prescription -0.5 --candidates 20000    # schedules/P01_Main_blocks.csv
+"""
+
+import argparse
+import csv
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from glm import blur_contrast_weights, canonical_hrf
+from session import SCHEDULE_DIR, SWITCH_PHASE_S, generate_blocks, get_blur_levels, run_id, save_blocks
+
+PREP_S = 3.0
+ACTIVE_S = {"Visuomotor": 20.0, "Motor-only": 10.0, "Visual-only": 10.0, "Baseline": 10.0}
+
+
+def active_periods(blocks, waits, switch_s=SWITCH_PHASE_S):
+    """(onsets, durations, total length) of the active periods in seconds for one candidate."""
+    durations = np.array([ACTIVE_S[block["Task"]] for block in blocks])
+    block_lengths = switch_s + PREP_S + durations + np.asarray(waits)
+    starts = np.concatenate([[0.0], np.cumsum(block_lengths)[:-1]])
+    return starts + switch_s + PREP_S, durations, float(block_lengths.sum())
+
+
+def score_candidates(candidates, conditions, sfreq=1.0, switch_s=SWITCH_PHASE_S, drift_cutoff=128.0):
+    """
+    A-efficiency of the blur contrasts for a list of (blocks, waits)
+    candidates, evaluated together. Shorter candidates are zero-padded
+    (padding rows carry no information, not even in the constant).
+    """
+    column = {condition: i for i, condition in enumerate(conditions)}
+    timings = [active_periods(blocks, waits, switch_s) for blocks, waits in candidates]
+    n = int(np.ceil(max(total for _, _, total in timings) * sfreq)) + 1
+    boxcars = np.zeros((len(candidates), n, len(conditions)))
+    valid = np.zeros((len(candidates), n))
+    for b, ((blocks, _), (onsets, durations, total)) in enumerate(zip(candidates, timings)):
+        for block, onset, duration in zip(blocks, onsets, durations):
+            start = int(round(onset * sfreq))
+            boxcars[b, start:start + int(round(duration * sfreq)), column[(block["Task"], block["Blur(D)"])]] = 1.0
+        valid[b, :int(round(total * sfreq))] = 1.0
+
+    # One FFT convolution for every regressor of every candidate
+    hrf = canonical_hrf(sfreq)
+    size = n + len(hrf) - 1
+    regressors = np.fft.irfft(np.fft.rfft(boxcars, size, axis=1) * np.fft.rfft(hrf, size)[None, :, None],
+                              size, axis=1)[:, :n]
+    n_drift = int(2 * n / sfreq / drift_cutoff)
+    k = np.arange(1, n_drift + 1)
+    drifts = np.cos(np.pi * (np.arange(n)[:, None] + 0.5) * k / n)
+    design = np.concatenate([regressors * valid[:, :, None],
+                             drifts[None] * valid[:, :, None],
+                             valid[:, :, None]], axis=2)
+
+    names = list(conditions) + [f"drift{i}" for i in k] + ["constant"]
+    contrasts = np.array(list(blur_contrast_weights(names).values()))
+    xtx_inv = np.linalg.pinv(np.einsum("btp,btq->bpq", design, design))
+    variance = np.einsum("cp,bpq,cq->b", contrasts, xtx_inv, contrasts)
+    return 1.0 / variance
+
+
+def _search(task):
+    """Worker: draws and scores n_candidates from one seed; returns (efficiency, blocks, waits) of the best."""
+    seed, n_candidates, prescription, is_practice, wait_range, batch_size, switch_s = task
+    rng = random.Random(seed)
+    levels = get_blur_levels(prescription, is_practice)
+    conditions = sorted({(block["Task"], block["Blur(D)"]) for block in generate_blocks(*levels)})
+    best = (-np.inf, None, None)
+    for first in range(0, n_candidates, batch_size):
+        candidates = []
+        for _ in range(min(batch_size, n_candidates - first)):
+            blocks = generate_blocks(*levels, shuffle=rng.shuffle)
+            candidates.append((blocks, [rng.uniform(*wait_range) for _ in blocks]))
+        scores = score_candidates(candidates, conditions, switch_s=switch_s)
+        i = int(np.argmax(scores))
+        if scores[i] > best[0]:
+            best = (float(scores[i]), candidates[i][0], candidates[i][1])
+    return best
+
+
+def optimize(prescription=0.0, is_practice=False, n_candidates=10000, wait_range=(5.0, 10.0), batch_size=200,
+             switch_s=SWITCH_PHASE_S, workers=None, seed=None):
+    """Best (efficiency, blocks, waits) over n_candidates spread across a process pool."""
+    workers = workers or os.cpu_count() or 1
+    seeds = random.Random(seed).sample(range(2 ** 31), workers)
+    shares = [n_candidates // workers + (i < n_candidates % workers) for i in range(workers)]
+    tasks = [(s, n, prescription, is_practice, wait_range, batch_size, switch_s) for s, n in zip(seeds, shares) if n]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return max(pool.map(_search, tasks), key=lambda result: result[0])
+
+
+def save_schedule(participant_id, blocks, waits, directory=SCHEDULE_DIR):
+    os.makedirs(directory, exist_ok=True)
+    blocks_path = save_blocks(participant_id, blocks, directory)
+    with open(os.path.join(directory, f"{participant_id}_post_task_waits.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Trial", "post_task_wait"])
+        writer.writerows((block["Trial"], f"{wait:.3f}") for block, wait in zip(blocks, waits))
+    return blocks_path
+
+
+if __name__ == "__main__":
+    import time
+
+    parser = argparse.ArgumentParser(description="Search block orders and jitter for the most efficient blur contrasts.")
+    parser.add_argument("participant", help="participant ID as entered in the experiment form, without the run type")
+    parser.add_argument("--prescription", type=float, default=0.0)
+    parser.add_argument("--practice", action="store_true")
+    parser.add_argument("--candidates", type=int, default=10000)
+    parser.add_argument("--wait-range", type=float, nargs=2, default=[5.0, 10.0], metavar=("MIN_S", "MAX_S"))
+    parser.add_argument("--switch", type=float, default=SWITCH_PHASE_S,
+                        help="lens switch phase per block (s); default matches the runner's pre-positioning")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", default=SCHEDULE_DIR)
+    args = parser.parse_args()
+    if args.participant.endswith(("_Main", "_Practice")):
+        parser.error("give the participant ID without the run type; use --practice for practice runs")
+
+    start = time.perf_counter()
+    efficiency, blocks, waits = optimize(args.prescription, args.practice, args.candidates, tuple(args.wait_range),
+                                         switch_s=args.switch, workers=args.workers, seed=args.seed)
+    # Reference: what an unoptimized random draw scores on average
+    rng = random.Random(args.seed)
+    levels = get_blur_levels(args.prescription, args.practice)
+    conditions = sorted({(block["Task"], block["Blur(D)"]) for block in generate_blocks(*levels)})
+    reference = score_candidates([(generate_blocks(*levels, shuffle=rng.shuffle),
+                                   [rng.uniform(*args.wait_range) for _ in range(len(blocks))]) for _ in range(200)],
+                                 conditions, switch_s=args.switch).mean()
+    path = save_schedule(run_id(args.participant, args.practice), blocks, waits, args.output)
+    print(f"[INFO] {args.candidates} candidates in {time.perf_counter() - start:.1f} s; efficiency {efficiency:.4f} "
+          f"(random draws average {reference:.4f}) -> {path}")
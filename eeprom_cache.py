@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+EEPROM snapshot cache with fast change detection.
+
+The 256-byte EEPROM of each lens is stored under eeprom/<lens_serial>.json
+together with its SHA-256 digest. At session start check() reads only a
+sample of addresses and compares their digest with the same addresses in the
+snapshot. A full pipelined dump runs only when they disagree or no snapshot
+exists yet. The sample rotates from one check to the next, so every address
+has been re-read after 256 / sample_size sessions.
+
+    cache = EepromCache()
+    result = cache.check(lens)
+    if result["status"] == "changed":
+        print("EEPROM changed at", result["changed_addresses"])
+"""
+
+import hashlib
+import json
+import os
+import time
+
+EEPROM_DIR = "eeprom"
+EEPROM_SIZE = 256
+
+
+def digest(values):
+    return hashlib.sha256(bytes(values)).hexdigest()
+
+
+def sample_addresses(rotation, sample_size):
+    """Every stride-th address, shifted by rotation; rotations 0..stride-1 cover the whole EEPROM."""
+    stride = max(EEPROM_SIZE // sample_size, 1)
+    return [(rotation % stride + k * stride) % EEPROM_SIZE for k in range(min(sample_size, EEPROM_SIZE))]
+
+
+class EepromCache:
+    def __init__(self, directory=EEPROM_DIR, sample_size=16):
+        self.directory = directory
+        self.sample_size = sample_size
+
+    def path(self, lens_serial):
+        return os.path.join(self.directory, f"{lens_serial}.json")
+
+    def load(self, lens_serial):
+        try:
+            with open(self.path(lens_serial)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, lens_serial, values, checks=0):
+        snapshot = {
+            "lens_serial": lens_serial,
+            "digest": digest(values),
+            "eeprom": list(values),
+            "checks": checks,
+            "saved": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path(lens_serial), "w") as f:
+            json.dump(snapshot, f)
+        return snapshot
+
+    def check(self, lens, full=False):
+        """
+        Compares the lens EEPROM with its cached snapshot. Returns a dict with
+        status 'unchanged', 'changed' or 'new', the changed addresses, the number
+        of bytes read and the elapsed time. A changed snapshot is kept next to the
+        new one as <lens_serial>_<timestamp>.json.
+        """
+        start = time.perf_counter()
+        lens_serial = lens.lens_serial
+        snapshot = self.load(lens_serial)
+        result = {"lens_serial": lens_serial, "status": "unchanged", "changed_addresses": []}
+
+        if snapshot is not None and not full:
+            addresses = sample_addresses(snapshot["checks"], self.sample_size)
+            cached = [snapshot["eeprom"][a] for a in addresses]
+            if digest(lens.eeprom_read(addresses)) == digest(cached):
+                self.save(lens_serial, snapshot["eeprom"], snapshot["checks"] + 1)
+                result.update(bytes_read=len(addresses), elapsed_s=time.perf_counter() - start)
+                return result
+
+        values = lens.eeprom_dump()
+        if snapshot is None:
+            result["status"] = "new"
+        elif digest(values) != snapshot["digest"]:
+            result["status"] = "changed"
+            result["changed_addresses"] = [a for a, (old, new) in enumerate(zip(snapshot["eeprom"], values))
+                                           if old != new]
+            os.replace(self.path(lens_serial),
+                       os.path.join(self.directory, f"{lens_serial}_{time.strftime('%Y%m%d-%H%M%S')}.json"))
+        self.save(lens_serial, values, 0 if snapshot is None else snapshot["checks"] + 1)
+        result.update(bytes_read=EEPROM_SIZE, elapsed_s=time.perf_counter() - start)
+        return result
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import serial.tools.list_ports
+    from lib import Lens
+
+    parser = argparse.ArgumentParser(description="Check connected lenses against their cached EEPROM snapshots.")
+    parser.add_argument("--store", default=EEPROM_DIR, help="snapshot directory")
+    parser.add_argument("--full", action="store_true", help="always dump the whole EEPROM")
+    parser.add_argument("--sample-size", type=int, default=16)
+    args = parser.parse_args()
+
+    cache = EepromCache(args.store, args.sample_size)
+    for port in serial.tools.list_ports.comports():
+        lens = Lens(port.name if os.name == "nt" else port.device)
+        result = cache.check(lens, full=args.full)
+        print(f"{result['lens_serial']}: {result['status']} ({result['bytes_read']} bytes, "
+              f"{result['elapsed_s'] * 1000:.1f} ms) {result['changed_addresses'] or ''}")
+        lens.lens_close()
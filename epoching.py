@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Marker-locked epoching of fNIRS recordings.
+
+Marker codes from a session are decoded back to (task, blur, phase) with the
+block plan in <pid>_blocks.csv, then all Active Onset epochs are cut from
+the signal in one pass. The signal is a (samples x channels) array whose
+sample times are on the same clock as the trigger log (see
+session.MarkerSender). Epochs come from a strided window view over the signal,
+so no per-trial Python loop or intermediate copy is needed; the only copy is
+the final gather of the selected windows.
+
+    plan = session.load_blocks("data/P01/P01_blocks.csv")
+    times, codes, _ = load_triggers("data/P01/P01_triggers.csv")
+    epochs = epoch_by_condition(signal, signal_times, times, codes, MarkerCodebook(plan), sfreq=10.0)
+    epochs[("Visuomotor", 1.0)].shape          # (epochs, channels, time)
+"""
+
+import csv
+from datetime import datetime
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from session import TIMESTAMP_FORMAT
+
+# Fixed codes sent by BlockRunner, per phase
+PHASE_CODES = {5: "lens_switch", 10: "lens_switch", 20: "prep", 70: "post_task", 80: "baseline", 99: "block_complete"}
+
+
+def load_triggers(path):
+    """(times, codes, names) from <pid>_triggers.csv; times are POSIX seconds."""
+    times, codes, names = [], [], []
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            times.append(datetime.strptime(row["timestamp"], TIMESTAMP_FORMAT).timestamp())
+            codes.append(int(row["marker_code"]))
+            names.append(row["marker_name"])
+    return np.array(times), np.array(codes), names
+
+
+class MarkerCodebook:
+    """Maps marker codes to (task, blur, phase) using the block plan."""
+
+    def __init__(self, blocks):
+        self.codes = {code: (None, None, phase) for code, phase in PHASE_CODES.items()}
+        for block in blocks:
+            self.codes[block["Active Onset"]] = (block["Task"], block["Blur(D)"], "active")
+            self.codes[block["Task Offset"]] = (block["Task"], block["Blur(D)"], "offset")
+
+    def decode(self, code):
+        """(task, blur, phase); unknown codes decode to (None, None, None)."""
+        return self.codes.get(int(code), (None, None, None))
+
+    def conditions(self):
+        return sorted({(task, blur) for task, blur, phase in self.codes.values() if phase == "active"})
+
+
+def extract_epochs(signal, onsets, start, length, baseline=None):
+    """
+    Epochs of 'length' samples beginning 'start' samples from each onset index,
+    as an (epochs, channels, length) array. Windows that run off either end
+    of the signal are dropped; the second return value marks the kept onsets.
+    baseline=(b0, b1) subtracts the mean of samples b0:b1 within each epoch.
+    """
+    signal = np.asarray(signal)
+    if signal.ndim == 1:
+        signal = signal[:, None]
+    # windows[i] is signal[i:i + length].T, a view with no copy
+    windows = sliding_window_view(signal, length, axis=0)
+    first = np.asarray(onsets, int) + start
+    keep = (first >= 0) & (first < len(windows))
+    epochs = windows[first[keep]]
+    if baseline is not None:
+        epochs = epochs - epochs[:, :, baseline[0]:baseline[1]].mean(axis=2, keepdims=True)
+    return epochs, keep
+
+
+def epoch_by_condition(signal, signal_times, marker_times, marker_codes, codebook, sfreq, tmin=-5.0, tmax=25.0,
+                       baseline=(-5.0, 0.0)):
+    """
+    Baseline-corrected Active Onset epochs per (task, blur) condition, all
+    cut in a single extract_epochs call. Times are in seconds; sfreq in Hz.
+    """
+    decoded = [codebook.decode(code) for code in marker_codes]
+    active = np.array([phase == "active" for _, _, phase in decoded], bool)
+    labels = [(task, blur) for (task, blur, phase), is_active in zip(decoded, active) if is_active]
+    onsets = np.searchsorted(signal_times, np.asarray(marker_times)[active])
+
+    start = int(round(tmin * sfreq))
+    length = int(round((tmax - tmin) * sfreq)) + 1
+    window = None
+    if baseline is not None:
+        window = (int(round((baseline[0] - tmin) * sfreq)), int(round((baseline[1] - tmin) * sfreq)))
+    epochs, keep = extract_epochs(signal, onsets, start, length, window)
+
+    kept_labels = [label for label, k in zip(labels, keep) if k]
+    by_condition = {}
+    for condition in dict.fromkeys(kept_labels):
+        mask = np.array([label == condition for label in kept_labels])
+        by_condition[condition] = epochs[mask]
+    return by_condition
+
+
+def epoch_times(sfreq, tmin=-5.0, tmax=25.0):
+    return tmin + np.arange(int(round((tmax - tmin) * sfreq)) + 1) / sfreq
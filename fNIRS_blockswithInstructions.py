@@ -1,54 +1,62 @@
 # ------------------ Imports ------------------
+from startup import StartupTimer, lazy_import, background
+startup_timer = StartupTimer()
+
 import customtkinter as ctk
 from tkinter import Tk, messagebox
 import serial.tools.list_ports
 import os
-import csv
-from datetime import datetime
-import time
 from lib import Lens
-from pylsl import StreamInfo, StreamOutlet
-import random
-import pandas as pd
-import simpleaudio as sa
-import numpy as np
+import lens_daemon
+import lens_status
+from eeprom_cache import EepromCache
+from session import (get_blur_levels, generate_blocks, save_blocks, load_schedule, schedule_mismatches, run_id,
+                     MarkerSender, LabelDisplay, BlockRunner, describe_markers, PREPOSITION_LENSES)
 from screeninfo import get_monitors
-import random
+
+# Only needed once blocks run; imported on first use or by the background preload below
+np = lazy_import("numpy", startup_timer)
+sa = lazy_import("simpleaudio", startup_timer)
+startup_timer.mark("imports done")
 
 # ------------------ CustomTkinter Settings ------------------
 ctk.set_appearance_mode("Light")
 ctk.set_default_color_theme("blue")
 
 # ------------------ LSL Marker Stream ------------------
-info = StreamInfo(name='TuneTriggers', type='Markers', channel_count=1,
-                  channel_format='int32', source_id='fNIRS_marker_001')
-lsl_outlet = StreamOutlet(info)
-
-def play_start_tone(frequency=440, duration=0.5):
-    fs = 44100
-    t = np.linspace(0, duration, int(fs * duration), False)
+def create_lsl_outlet():
+    from pylsl import StreamInfo, StreamOutlet
+    info = StreamInfo(name='TuneTriggers', type='Markers', channel_count=1,
+                      channel_format='int32', source_id='fNIRS_marker_001')
+    # Recorders see what each code means without the experiment's sources
+    describe_markers(info)
+    return StreamOutlet(info)
+
+# Built while the participant form is open; collected before the first marker
+lsl_outlet_future = background(create_lsl_outlet, startup_timer)
+
+# ------------------ Audio ------------------
+TONE_FS = 44100
+tone_cache = {}
+
+def make_tone(frequency, duration):
+    t = np.linspace(0, duration, int(TONE_FS * duration), False)
     tone = np.sin(frequency * t * 2 * np.pi)
-    audio = (tone * 32767).astype(np.int16)
-    sa.play_buffer(audio, 1, 2, fs).wait_done()
-
-def send_marker(code, name=None):
-    # Send to LSL
-    lsl_outlet.push_sample([code])
-
-    # Create timestamp
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+    return (tone * 32767).astype(np.int16)
 
-    # Print to console
-    if name:
-        print(f"[LSL] Marker sent: {code} ({name}) at {timestamp}")
-    else:
-        print(f"[LSL] Marker sent: {code} at {timestamp}")
+def play_start_tone(frequency=440, duration=0.5):
+    audio = tone_cache.get((frequency, duration))
+    if audio is None:
+        audio = tone_cache[(frequency, duration)] = make_tone(frequency, duration)
+    sa.play_buffer(audio, 1, 2, TONE_FS).wait_done()
 
-    # Save to CSV
-    with open(trigger_log_path, 'a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow([timestamp, code, name if name else ""])
+def preload_audio():
+    # Cue tones used by the block runner
+    for frequency in (1000, 1500, 2000, 2500):
+        tone_cache[(frequency, 0.3)] = make_tone(frequency, 0.3)
+    sa.preload()  # import simpleaudio now so the first cue does not pay for it
 
+audio_future = background(preload_audio, startup_timer)
 
 # ------------------ Display Setup ------------------
 monitors = get_monitors()
@@ -113,38 +121,17 @@ def get_participant_info():
             messagebox.showerror("Error", "Prescription must be a number", parent=root_base)
             return
 
-        result['participant'] = f"{pid}_{run_type}"
+        result['participant'] = run_id(pid, run_type == "Practice")
         result['prescription'] = prescription
         win.destroy()
 
     ctk.CTkButton(win, text="Confirm", command=confirm).pack(pady=20)
     win.bind("<Return>", confirm)
+    win.after_idle(lambda: startup_timer.mark("participant form shown"))
     win.wait_window()
 
     return result
 
-def get_trial_file_path(participant_id):
-    folder = os.path.join("data", participant_id)
-    os.makedirs(folder, exist_ok=True)
-    return os.path.join(folder, f"{participant_id}_trials.csv")
-
-def log_trial(participant_id, trial_number, condition, right_power, left_power, start_time, end_time):
-    file_path = get_trial_file_path(participant_id)
-    file_exists = os.path.isfile(file_path)
-    with open(file_path, 'a', newline='') as f:
-        writer = csv.writer(f)
-        if not file_exists:
-            writer.writerow(["participant", "trial", "condition", "right_power", "left_power", "start_time", "end_time"])
-        writer.writerow([
-            participant_id,
-            trial_number,
-            condition,
-            right_power,
-            left_power,
-            start_time.strftime("%Y-%m-%d %H:%M:%S.%f"),
-            end_time.strftime("%Y-%m-%d %H:%M:%S.%f")
-        ])
-
 # ------------------ Participant & Lens Setup ------------------
 participant_info = get_participant_info()
 participant_id = participant_info['participant']
@@ -157,17 +144,24 @@ prescription = participant_info['prescription']  # float, default 0 if user didn
 folder = os.path.join("data", participant_id)
 os.makedirs(folder, exist_ok=True)   # ✅ This creates the folder if it doesn't exist
 
-# Create trigger log file if it doesn't exist
+# Trigger log for this run; MarkerSender creates it with its header on first use
 trigger_log_path = os.path.join("data", participant_id, f"{participant_id}_triggers.csv")
-if not os.path.exists(trigger_log_path):
-    with open(trigger_log_path, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(["timestamp", "marker_code", "marker_name"])
+lsl_outlet = lsl_outlet_future.result()
+markers = MarkerSender(lsl_outlet, trigger_log_path)
+send_marker = markers.send
 
-# Detect connected lenses
+# Detect connected lenses; a running lens daemon already holds the ports and is used first
+lens_client = lens_daemon.connect()
+remote_lenses = lens_client.lenses() if lens_client is not None else []
 ports = list(serial.tools.list_ports.comports())
 simulation_mode = False
-if len(ports) < 2:
+if len(remote_lenses) >= 2:
+    print(f"[INFO] Using lenses from lens daemon: {', '.join(l.lens_serial for l in remote_lenses)}")
+    right_lens, left_lens = remote_lenses[0], remote_lenses[1]
+    lenses = [right_lens, left_lens]
+    for l in lenses:
+        l.to_focal_power_mode()
+elif len(ports) < 2:
     proceed = messagebox.askyesno(
         "Lenses Not Found",
         "Two tunable lenses not detected.\nRun in Simulation Mode?",
@@ -185,82 +179,78 @@ if len(ports) < 2:
         @property
         def connection(self): return self
         def close(self): pass
+        def lens_close(self, stats_path=None): pass
     right_lens, left_lens = DummyLens("R"), DummyLens("L")
     lenses = [right_lens, left_lens]
 else:
-    right_lens = Lens(ports[0].name)
-    left_lens = Lens(ports[1].name)
+    right_lens = Lens(ports[0].name, trace_path=os.path.join(folder, f"{participant_id}_right_trace.bin"))
+    left_lens = Lens(ports[1].name, trace_path=os.path.join(folder, f"{participant_id}_left_trace.bin"))
     lenses = [right_lens, left_lens]
     for l in lenses:
         l.to_focal_power_mode()
 
-# ------------------ Experiment Parameters ------------------
-task_variants = ["Visuomotor", "Motor-only", "Visual-only", "Baseline"]
+    # Overdrive shaping for lenses whose shaped step response has been measured (calibrate_lens.py --compare-shaping);
+    # these modules pull in numpy, so they are imported only when real lenses are driven directly
+    from lens_calibration import CalibrationStore
+    from command_shaping import shaper_for
+    calibration_store = CalibrationStore()
+    for l in lenses:
+        if calibration_store.has(l.lens_serial) and \
+                "settle_time_shaped" in calibration_store.load(l.lens_serial).models:
+            l.shaper = shaper_for(l, calibration_store)
+            print(f"[INFO] Overdrive shaping enabled for lens {l.lens_serial}")
+
+    # Pre-session integrity check: a sampled digest, with a full dump only on mismatch
+    eeprom_cache = EepromCache()
+    for l in lenses:
+        result = eeprom_cache.check(l)
+        print(f"[EEPROM] {l.lens_serial}: {result['status']} ({result['elapsed_s'] * 1000:.1f} ms)")
+        if result["status"] == "changed":
+            messagebox.showwarning("Lens EEPROM Changed",
+                                   f"EEPROM of lens {l.lens_serial} differs from its last snapshot at "
+                                   f"{len(result['changed_addresses'])} addresses.", parent=root_base)
+
+# Publish lens state for monitoring tools unless the lens daemon already does
+status_board = None
+if not remote_lenses and not simulation_mode:
+    status_board = lens_status.StatusBoard(lens_status.DEFAULT_PATH, [l.lens_serial for l in lenses])
+    for i, l in enumerate(lenses):
+        status_board.update(i, mode=l.mode, temperature=l.get_temperature())
 
+# ------------------ Experiment Parameters ------------------
 #prescription = -0.0  # Example prescription value
 
 # Detect if this is a practice run
 is_practice = "Practice" in participant_id
 
+blur_levels_vm_vo, blur_levels_motor, repeats = get_blur_levels(prescription, is_practice)
 if is_practice:
-    blur_levels_vm_vo = [x + prescription for x in [0, 0.5]]
-    blur_levels_motor = [x + prescription for x in [0]]
-    repeats = 1
     print("[INFO] Practice run detected: Using reduced block set (1 repeat, 0 & 0.5 D)")
 else:
-    blur_levels_vm_vo = [x + prescription for x in [0, 0.5, 1.0, 1.5, 2.0]]
-    blur_levels_motor = [x + prescription for x in [0]]
-    repeats = 3
     print("[INFO] Main run detected: Using full block set (3 repeats, 5 blur levels)")
 
-marker_base = {"Visuomotor": 30, "Motor-only": 40, "Visual-only": 50, "Baseline": 60}
-task_descriptions = {
-    "Visuomotor": "Move the bead from left to right \n 1 grey 2 white repeat.",
-    "Motor-only": "Pick the bead from left and drop on the right board",
-    "Visual-only": "Watch the board from left to right",
-    "Baseline": "+"
-}
-
 # ------------------ Generate Randomized Blocks ------------------
-blocks = []
-trial_counter = 1
-for r in range(repeats):
-    rep_blocks = []
-    rep_blocks += [("Visuomotor", b) for b in blur_levels_vm_vo]
-    rep_blocks += [("Motor-only", b) for b in blur_levels_motor]
-    rep_blocks += [("Visual-only", b) for b in blur_levels_vm_vo]
-    rep_blocks += [("Baseline", b) for b in blur_levels_vm_vo]
-    random.shuffle(rep_blocks)
-    for task, blur in rep_blocks:
-        blur_idx = 0 if task == "Motor-only" else blur_levels_vm_vo.index(blur)
-        active_marker = marker_base[task] + blur_idx
-        blocks.append({
-            "Trial": trial_counter,
-            "Task": task,
-            "Blur(D)": blur,
-            "Lens Switch": 10,
-            "Prep Cue": 20,
-            "Active Onset": active_marker,
-            "Task Offset": active_marker + 5,
-            "Post-task": 70,
-            "Baseline": 80
-        })
-        trial_counter += 1
+# An order and jitter prepared by design_optimizer.py take precedence over a fresh shuffle
+schedule = load_schedule(participant_id)
+post_task_waits = None
+if schedule is not None:
+    blocks, post_task_waits = schedule
+    # A schedule made for another prescription or run type must not run in place of this one
+    problems = schedule_mismatches(blocks, post_task_waits, blur_levels_vm_vo, blur_levels_motor, repeats)
+    if problems:
+        messagebox.showerror("Schedule Mismatch",
+                             f"The optimized schedule for {participant_id} does not match the prescription "
+                             f"and run type entered:\n\n" + "\n".join(problems), parent=root_base)
+        exit()
+    print(f"[INFO] Using optimized schedule for {participant_id} ({len(blocks)} blocks)")
+else:
+    blocks = generate_blocks(blur_levels_vm_vo, blur_levels_motor, repeats)
 
 # Save block randomization
-folder = os.path.join("data", participant_id)
-os.makedirs(folder, exist_ok=True)
-pd.DataFrame(blocks).to_csv(os.path.join(folder, f"{participant_id}_blocks.csv"), index=False)
+save_blocks(participant_id, blocks)
 print(f"[INFO] Participant: {participant_id}")
 print("[INFO] Randomized block order saved.")
 
-# ------------------ Lens Control ------------------
-def set_lens_power(val):
-    val = float(val)
-    for l in lenses:
-        l.set_diopter(val)
-    send_marker(5, "Lens Switch")
-
 # ------------------ Instruction GUI ------------------
 root = ctk.CTk()
 width, height = 1280, 768
@@ -274,94 +264,31 @@ instruction_label = ctk.CTkLabel(root, text="", font=("Arial", 36))
 instruction_label.pack(expand=True)
 root.update()
 
-# ------------------ Run a Single Block ------------------
-def run_block(block):
-    start_time = datetime.now()
-
-    # Lens setting
-    instruction_label.configure(text="Lens Switching...\n\n Setting blur value")
-    root.update()
-    set_lens_power(block["Blur(D)"])
-    time.sleep(1)
-    print(f"[INFO] Setting blur value: {block['Blur(D)']}")
-    send_marker(block["Lens Switch"], "Lens Switch")
-
-    # Task sequence
-    if block["Task"] == "Baseline":
-        prep_text = f"Prepare for the task: {block['Task']}\n\n Look at the fixation cross"
-        instruction_label.configure(text=prep_text)
-        root.update()
-        send_marker(block["Prep Cue"], "Prep Cue")
-        time.sleep(3)
-
-        play_start_tone(frequency=1500, duration=0.3)
-        instruction_label.configure(text="+", font=("Arial", 72))
-        root.update()
-        send_marker(block["Active Onset"], f"Active Onset - {block['Task']} Blur {block['Blur(D)']}D")
-        time.sleep(10)
-        send_marker(block["Task Offset"], "Baseline End")
-
-        play_start_tone(frequency=2500, duration=0.3)   
-        instruction_label.configure(text="Task Complete.\n\nPlease remain still.", font=("Arial", 36))
-        root.update()
-        send_marker(block["Post-task"], "Post-task")
-        post_task_duration = random.uniform(5, 10)  # Random float between 5 and 10 seconds
-        print(f"[INFO] Post-task wait: {post_task_duration:.2f} seconds")
-        time.sleep(post_task_duration)
-    else:
-        prep_text = f"Prepare for the task: {block['Task']}\n\n{task_descriptions[block['Task']]}"
-        if is_practice:
-            prep_text = f"[Practice Run]\n\n{prep_text}"
-        instruction_label.configure(text=prep_text)
-        root.update()
-        send_marker(block["Prep Cue"], "Prep Cue")
-        time.sleep(3)
-
-        play_start_tone(frequency=1000, duration=0.3)
-        active_text = f"Active Task: {block['Task']}"
-        if is_practice:
-            active_text = f"Active Task (Practice): {block['Task']}"
-        instruction_label.configure(text=active_text)
-        root.update()
-        send_marker(block["Active Onset"], f"Active Onset - {block['Task']} Blur {block['Blur(D)']}D")
-        if block["Task"] == "Visuomotor":
-            time.sleep(20)  # 20 seconds for Visuomotor
-        else:
-            time.sleep(10)  # 10 seconds for other tasks
-
-        play_start_tone(frequency=2000, duration=0.3)
-        instruction_label.configure(text="Task Complete.\n\nPlease remain still.")
-        root.update()
-        send_marker(block["Task Offset"], "Task Offset")
-        send_marker(block["Post-task"], "Post-task")
-        post_task_duration = random.uniform(5, 10)  # Random float between 5 and 10 seconds
-        print(f"[INFO] Post-task wait: {post_task_duration:.2f} seconds")
-        time.sleep(post_task_duration)
-
-    end_time = datetime.now()
-    log_trial(
-        participant_id,
-        block["Trial"],
-        f"{block['Task']}_{block['Blur(D)']}",
-        right_lens.get_diopter(),
-        left_lens.get_diopter(),
-        start_time,
-        end_time
-    )
-
-    send_marker(99, "Block Complete")
-    print(f"[INFO] Trial {block['Trial']} complete.")
-    return True
+# ------------------ Block Runner ------------------
+# Per-switch waits from the lens profiles (or calibrated settle models); pulls in numpy, so imported here
+from lens_profiles import SwitchTimer
+switch_timer = SwitchTimer(lenses)
+runner = BlockRunner(participant_id, lenses, markers, LabelDisplay(root, instruction_label),
+                     play_start_tone, is_practice=is_practice, status_board=status_board,
+                     settle_wait=switch_timer.wait, preposition=PREPOSITION_LENSES)
+if post_task_waits is not None:
+    runner.post_task_wait = iter(post_task_waits).__next__
+run_block = runner.run_block
+set_lens_power = runner.set_lens_power
+
+audio_future.result()
+startup_timer.mark("ready to run blocks")
+startup_timer.report()
 
 # ------------------ Run Experiment ------------------
-for block in blocks:
-    continue_exp = run_block(block)
+for block, next_block in zip(blocks, blocks[1:] + [None]):
+    continue_exp = run_block(block, next_block)
     if not continue_exp:
         break
 
 # ------------------ Cleanup ------------------
-for l in lenses:
-    l.connection.close()
+for side, l in zip(["right", "left"], lenses):
+    l.lens_close(os.path.join(folder, f"{participant_id}_{side}_lens_stats.json"))
 root.destroy()
 messagebox.showinfo("Experiment Complete", "All blocks finished successfully!", parent=root_base)
 root_base.destroy()
\ No newline at end of file
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Binary ring-buffer tracer for raw lens driver frames.
+
+Lens records every command and response frame with a monotonic timestamp
+into a fixed-size FrameTracer. Recording is a clock read and a list store,
+so it can stay on during real sessions; the buffer is only formatted when
+it is dumped (on demand, or by Lens on a protocol error).
+
+Decode a dump offline with CRC validation and command names:
+
+    python frame_trace.py data/P01_Main/P01_Main_right_trace.bin
+"""
+
+import struct
+import time
+
+MAGIC = b'LTRC'
+VERSION = 1
+HEADER = struct.Struct('<4sHHI')   # magic, version, label length, record count
+RECORD = struct.Struct('<QBH')     # monotonic ns, direction, frame length
+
+TX, RX = 0, 1
+
+
+class FrameTracer:
+    def __init__(self, capacity=4096, label=''):
+        self.capacity = capacity
+        self.label = label
+        self._frames = [None] * capacity
+        self._count = 0
+
+    def record(self, direction, frame):
+        self._frames[self._count % self.capacity] = (time.monotonic_ns(), direction, frame)
+        self._count += 1
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def frames(self):
+        """Recorded (t_ns, direction, frame) tuples, oldest first."""
+        if self._count <= self.capacity:
+            return self._frames[:self._count]
+        start = self._count % self.capacity
+        return self._frames[start:] + self._frames[:start]
+
+    def clear(self):
+        self._frames = [None] * self.capacity
+        self._count = 0
+
+    def dump(self, path):
+        frames = self.frames()
+        label = self.label.encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(label), len(frames)))
+            f.write(label)
+            for t_ns, direction, frame in frames:
+                f.write(RECORD.pack(t_ns, direction, len(frame)))
+                f.write(frame)
+        return path
+
+
+def load_trace(path):
+    """Returns (label, [(t_ns, direction, frame), ...]) from a dump written by FrameTracer.dump."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, label_len, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise Exception('Not a lens frame trace: {}'.format(path))
+    offset = HEADER.size
+    label = data[offset:offset + label_len].decode('utf-8')
+    offset += label_len
+    frames = []
+    for _ in range(count):
+        t_ns, direction, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        frames.append((t_ns, direction, data[offset:offset + length]))
+        offset += length
+    return label, frames
+
+
+def decode_frame(direction, frame):
+    """Returns (name, payload, crc_ok) for one raw frame."""
+    # Imported here: lib imports FrameTracer from this module, so a top-level import would be circular
+    import lib
+
+    if direction == TX:
+        payload, crc = frame[:-2], frame[-2:]
+        crc_ok = len(frame) >= 2 and struct.unpack('<H', crc)[0] == lib.crc_16(payload)
+        return lib.command_name(payload), payload, crc_ok
+    payload, crc, newline = frame[:-4], frame[-4:-2], frame[-2:]
+    crc_ok = len(frame) >= 4 and newline == b'\r\n' and struct.unpack('<H', crc)[0] == lib.crc_16(payload)
+    return lib.command_name(payload), payload, crc_ok
+
+
+def decode_trace(frames):
+    """Yields one dict per frame with relative time, command name, CRC check and reply latency."""
+    if not frames:
+        return
+    t0 = frames[0][0]
+    last_tx, last_name = None, None
+    for t_ns, direction, frame in frames:
+        name, payload, crc_ok = decode_frame(direction, frame)
+        latency = None
+        if direction == TX:
+            last_tx, last_name = t_ns, name
+        elif last_tx is not None:
+            # Replies only echo part of the opcode, so name them after the request they answer
+            name = last_name
+            latency = (t_ns - last_tx) / 1e6
+        yield {
+            'time_ms': (t_ns - t0) / 1e6,
+            'direction': 'TX' if direction == TX else 'RX',
+            'command': name,
+            'frame': frame,
+            'crc_ok': crc_ok,
+            'latency_ms': latency,
+        }
+
+
+def print_trace(path):
+    label, frames = load_trace(path)
+    print('=== Frame trace {} ({} frames) ==='.format(label or path, len(frames)))
+    for row in decode_trace(frames):
+        framehex = ' '.join('{:02x}'.format(c) for c in row['frame'])
+        latency = '' if row['latency_ms'] is None else '{:8.3f} ms'.format(row['latency_ms'])
+        print('{:12.3f}  {}  {:<5} {:<4} {:<45} {}'.format(
+            row['time_ms'], row['direction'], row['command'], 'ok' if row['crc_ok'] else 'BAD', framehex, latency))
+
+
+if __name__ == '__main__':
+    import sys
+
+    for trace_path in sys.argv[1:]:
+        print_trace(trace_path)
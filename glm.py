@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Block-design GLM for the blur x task study.
+
+One boxcar per (task, blur) condition runs from each Active Onset marker to
+its Task Offset marker (decoded with the block plan, see epoching.py). All
+boxcars of a design are convolved with the canonical HRF in one FFT, and a
+discrete cosine drift basis (128 s cutoff) and a constant are appended.
+
+Fits are batched: each participant contributes X'X and X'Y for all of its
+channels, and every participant is solved in one stacked call. Contrasts
+compare each blur level with the unblurred level of the same task.
+
+    design, names = design_matrix(plan, marker_times, marker_codes, signal_times, sfreq)
+    fit = fit_glm([design], [signal])
+    contrasts = blur_contrasts(names, fit)
+    effect, t = contrasts[("Visuomotor", 1.0)]       # (participants, channels)
+"""
+
+import math
+import os
+
+import numpy as np
+
+from epoching import MarkerCodebook, load_triggers
+from session import load_blocks
+
+
+def canonical_hrf(sfreq, duration=32.0):
+    """SPM double-gamma HRF (peak ~5 s, undershoot ~15 s), normalized to unit sum."""
+    t = np.arange(0, duration, 1 / sfreq)
+    peak = t ** 5 * np.exp(-t) / math.gamma(6)
+    undershoot = t ** 15 * np.exp(-t) / math.gamma(16)
+    hrf = peak - undershoot / 6
+    return hrf / hrf.sum()
+
+
+def block_intervals(plan, marker_times, marker_codes):
+    """(condition, onset, offset) per block, pairing each Active Onset with the next matching Task Offset."""
+    codebook = MarkerCodebook(plan)
+    intervals, open_blocks = [], {}
+    for t, code in zip(marker_times, marker_codes):
+        task, blur, phase = codebook.decode(code)
+        if phase == "active":
+            open_blocks[(task, blur)] = t
+        elif phase == "offset" and (task, blur) in open_blocks:
+            intervals.append(((task, blur), open_blocks.pop((task, blur)), t))
+    return intervals
+
+
+def design_matrix(plan, marker_times, marker_codes, frame_times, sfreq, conditions=None, drift_cutoff=128.0,
+                  n_drift=None):
+    """
+    (design, names) for samples at frame_times. conditions and n_drift fix the
+    column layout (e.g. shared across a cohort); by default they are every
+    condition in the plan and the cosines with periods above drift_cutoff s.
+    """
+    conditions = conditions or MarkerCodebook(plan).conditions()
+    frame_times = np.asarray(frame_times)
+    n = len(frame_times)
+    boxcars = np.zeros((n, len(conditions)))
+    column = {condition: i for i, condition in enumerate(conditions)}
+    for condition, onset, offset in block_intervals(plan, marker_times, marker_codes):
+        if condition in column:
+            start, stop = np.searchsorted(frame_times, (onset, offset))
+            boxcars[start:stop, column[condition]] = 1.0
+
+    # Convolve every regressor with the HRF at once
+    hrf = canonical_hrf(sfreq)
+    size = n + len(hrf) - 1
+    regressors = np.fft.irfft(np.fft.rfft(boxcars, size, axis=0) * np.fft.rfft(hrf, size)[:, None], size, axis=0)[:n]
+
+    if n_drift is None:
+        n_drift = int(2 * n / sfreq / drift_cutoff)
+    k = np.arange(1, n_drift + 1)
+    drifts = np.cos(np.pi * (np.arange(n)[:, None] + 0.5) * k / n) * math.sqrt(2 / n)
+    design = np.column_stack([regressors, drifts, np.ones(n)])
+    names = list(conditions) + [f"drift{i}" for i in k] + ["constant"]
+    return design, names
+
+
+def _row_slices(n_rows, chunk_rows):
+    return (slice(start, min(start + chunk_rows, n_rows)) for start in range(0, n_rows, chunk_rows))
+
+
+def fit_glm(designs, signals, chunk_rows=65536):
+    """
+    Ordinary least squares for many participants at once. designs[i] is
+    (samples_i x regressors), signals[i] is (samples_i x channels); the
+    regressor and channel counts must match across participants. Returns a
+    dict of betas (participants x regressors x channels), residual variance
+    (participants x channels) and the (X'X)^-1 stack.
+
+    Signals may be memory-mapped (SignalStore.data): X'Y and the residual
+    sums are accumulated over chunk_rows-sample slices, so only one slice of
+    a signal is converted to float at a time.
+    """
+    xtx = np.stack([X.T @ X for X in designs])
+    xty = np.zeros((len(designs), xtx.shape[1], signals[0].shape[1]))
+    for i, (X, Y) in enumerate(zip(designs, signals)):
+        for rows in _row_slices(len(X), chunk_rows):
+            xty[i] += X[rows].T @ np.asarray(Y[rows], float)
+    xtx_inv = np.linalg.pinv(xtx)
+    betas = xtx_inv @ xty
+    sigma2 = np.zeros((len(designs), xty.shape[2]))
+    for i, (X, Y, beta) in enumerate(zip(designs, signals, betas)):
+        for rows in _row_slices(len(X), chunk_rows):
+            sigma2[i] += ((np.asarray(Y[rows], float) - X[rows] @ beta) ** 2).sum(axis=0)
+        sigma2[i] /= max(len(X) - np.linalg.matrix_rank(X), 1)
+    return {"betas": betas, "sigma2": sigma2, "xtx_inv": xtx_inv}
+
+
+def contrast(fit, weights):
+    """(effect, t) for one contrast vector over regressors, per participant and channel."""
+    weights = np.asarray(weights, float)
+    effect = np.einsum("r,brc->bc", weights, fit["betas"])
+    variance = np.einsum("r,brs,s->b", weights, fit["xtx_inv"], weights)[:, None] * fit["sigma2"]
+    return effect, effect / np.sqrt(np.maximum(variance, 1e-30))
+
+
+def blur_contrast_weights(names):
+    """
+    {(task, blur): weights} contrasting every blurred condition with the same
+    task at its lowest blur level (0 D plus the participant's prescription).
+    """
+    column = {name: i for i, name in enumerate(names)}
+    conditions = [name for name in names if isinstance(name, tuple)]
+    lowest = {}
+    for task, blur in conditions:
+        lowest[task] = min(blur, lowest.get(task, blur))
+    contrasts = {}
+    for name in conditions:
+        task, blur = name
+        reference = (task, lowest[task])
+        if name == reference:
+            continue
+        weights = np.zeros(len(names))
+        weights[column[name]], weights[column[reference]] = 1.0, -1.0
+        contrasts[name] = weights
+    return contrasts
+
+
+def blur_contrasts(names, fit):
+    """{(task, blur): (effect, t)} for every contrast of blur_contrast_weights."""
+    return {name: contrast(fit, weights) for name, weights in blur_contrast_weights(names).items()}
+
+
+def fit_cohort(participant_ids, data_dir="data", store_dir="signal_store"):
+    """Fits every participant's signal_store recording with a shared design layout; returns (names, fit)."""
+    from signal_store import SignalStore
+
+    plans, markers, stores = [], [], []
+    for pid in participant_ids:
+        plans.append(load_blocks(os.path.join(data_dir, pid, f"{pid}_blocks.csv")))
+        times, codes, _ = load_triggers(os.path.join(data_dir, pid, f"{pid}_triggers.csv"))
+        markers.append((times, codes))
+        stores.append(SignalStore(os.path.join(store_dir, pid)))
+    conditions = sorted(set().union(*(MarkerCodebook(plan).conditions() for plan in plans)))
+    # Same number of drift cosines for everyone, sized for the shortest recording
+    n_drift = min(int(2 * len(store) / store.sfreq / 128.0) for store in stores)
+    designs = []
+    for plan, (times, codes), store in zip(plans, markers, stores):
+        design, names = design_matrix(plan, times, codes, store.times, store.sfreq, conditions, n_drift=n_drift)
+        designs.append(design)
+    return names, fit_glm(designs, [store.data for store in stores])
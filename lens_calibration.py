@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Per-lens calibration store and the current-mode fast path.
+
+A CalibrationTable maps (diopter, temperature) to drive current for one lens.
+Tables are stored as JSON under calibration/<lens_serial>.json, so runtime
+code loads them instantly instead of re-measuring.
+
+CurrentModeDriver switches a lens to current mode and converts diopter
+targets to raw 'Aw' commands with vectorized interpolation. This skips the
+firmware's focal-power loop; the command frames for a whole sequence can be
+prepared ahead of time.
+
+    table = CalibrationStore().load(lens.lens_serial)
+    driver = CurrentModeDriver(lens, table)
+    frames = driver.prepare([0.0, 0.5, 1.0])     # precomputed commands
+    driver.send_prepared(frames[1])
+"""
+
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+CALIBRATION_DIR = "calibration"
+
+
+class CalibrationTable:
+    def __init__(self, lens_serial, diopters, temperatures, currents, models=None):
+        """currents[i, j] is the drive current (mA) for diopters[j] at temperatures[i]."""
+        self.lens_serial = lens_serial
+        self.diopters = np.asarray(diopters, float)
+        self.temperatures = np.asarray(temperatures, float)
+        self.currents = np.atleast_2d(np.asarray(currents, float))
+        # Fitted models (e.g. from a calibration sweep), kept alongside the table
+        self.models = models or {}
+
+    def current_for(self, diopter, temperature):
+        """Drive current (mA) for scalar or array diopter targets at one temperature."""
+        temps = self.temperatures
+        if len(temps) == 1 or temperature <= temps[0]:
+            return np.interp(diopter, self.diopters, self.currents[0])
+        if temperature >= temps[-1]:
+            return np.interp(diopter, self.diopters, self.currents[-1])
+        upper = int(np.searchsorted(temps, temperature))
+        weight = (temperature - temps[upper - 1]) / (temps[upper] - temps[upper - 1])
+        low = np.interp(diopter, self.diopters, self.currents[upper - 1])
+        high = np.interp(diopter, self.diopters, self.currents[upper])
+        return low + (high - low) * weight
+
+    def to_dict(self):
+        return {
+            "lens_serial": self.lens_serial,
+            "diopters": self.diopters.tolist(),
+            "temperatures": self.temperatures.tolist(),
+            "currents": self.currents.tolist(),
+            "models": self.models,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["lens_serial"], data["diopters"], data["temperatures"], data["currents"],
+                   data.get("models"))
+
+
+class CalibrationStore:
+    def __init__(self, directory=CALIBRATION_DIR):
+        self.directory = directory
+        self._cache = {}
+
+    def path(self, lens_serial):
+        return os.path.join(self.directory, f"{lens_serial}.json")
+
+    def has(self, lens_serial):
+        return lens_serial in self._cache or os.path.isfile(self.path(lens_serial))
+
+    def load(self, lens_serial):
+        table = self._cache.get(lens_serial)
+        if table is None:
+            with open(self.path(lens_serial)) as f:
+                table = self._cache[lens_serial] = CalibrationTable.from_dict(json.load(f))
+        return table
+
+    def save(self, table):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path(table.lens_serial), "w") as f:
+            json.dump(table.to_dict(), f, indent=2)
+        self._cache[table.lens_serial] = table
+        return self.path(table.lens_serial)
+
+
+class CurrentModeDriver:
+    """Open-loop diopter control through calibrated raw current commands."""
+
+    def __init__(self, lens, table, temperature_refresh=10.0):
+        self.lens = lens
+        self.table = table
+        self.temperature_refresh = temperature_refresh
+        self.raw_per_ma = 4095 / lens.max_output_current
+        self._temperature = None
+        self._temperature_time = 0.0
+        if lens.mode != 1:
+            lens.to_current_mode()
+
+    def temperature(self):
+        """Lens temperature, re-read at most every temperature_refresh seconds."""
+        now = time.monotonic()
+        if self._temperature is None or now - self._temperature_time > self.temperature_refresh:
+            self._temperature = self.lens.get_temperature()
+            self._temperature_time = now
+        return self._temperature
+
+    def raw_currents(self, diopters):
+        currents = self.table.current_for(diopters, self.temperature())
+        raw = np.rint(np.asarray(currents) * self.raw_per_ma)
+        return np.clip(raw, -4095, 4095).astype(int)
+
+    def prepare(self, diopters):
+        """Command payloads for a sequence of diopter targets, ready for send_prepared."""
+        return [b'Aw' + struct.pack('>h', raw) for raw in np.atleast_1d(self.raw_currents(diopters)).tolist()]
+
+    def send_prepared(self, command):
+        self.lens.send_command(command)
+
+    def set_diopter(self, diopter):
+        self.lens.send_command(b'Aw' + struct.pack('>h', int(self.raw_currents(diopter))))
+
+    def close(self):
+        """Hands the lens back to the firmware's focal-power mode."""
+        self.lens.to_focal_power_mode()
+
+
+# ------------------ Model Fitting ------------------
+def _current_design(currents, temperatures, use_temperature):
+    currents = np.asarray(currents, float)
+    columns = [np.ones_like(currents), currents, currents ** 2]
+    if use_temperature:
+        temperatures = np.asarray(temperatures, float)
+        columns += [temperatures - 30.0, (temperatures - 30.0) * currents]
+    return np.column_stack(columns)
+
+
+def fit_current_model(currents, diopters, temperatures):
+    """
+    Least-squares fit of diopter = c0 + c1*I + c2*I^2 (+ t0*(T-30) + t1*(T-30)*I
+    when the sweep saw more than half a degree of temperature change).
+    """
+    temperatures = np.asarray(temperatures, float)
+    use_temperature = bool(np.ptp(temperatures) > 0.5)
+    design = _current_design(currents, temperatures, use_temperature)
+    coef, _, _, _ = np.linalg.lstsq(design, np.asarray(diopters, float), rcond=None)
+    rmse = float(np.sqrt(np.mean((design @ coef - diopters) ** 2)))
+    return {"coef": coef.tolist(), "use_temperature": use_temperature, "rmse_d": rmse}
+
+
+def predict_diopter(model, currents, temperature):
+    currents = np.asarray(currents, float)
+    design = _current_design(currents, np.full_like(currents, temperature), model["use_temperature"])
+    return design @ np.asarray(model["coef"])
+
+
+def fit_settle_model(steps, settle_times, temperatures):
+    """Least-squares fit of settle_time = a + b*ln|step| (+ c*(T-30)); steps in diopters, times in s."""
+    log_steps = np.log(np.maximum(np.abs(np.asarray(steps, float)), 1e-3))
+    temperatures = np.asarray(temperatures, float)
+    use_temperature = bool(np.ptp(temperatures) > 0.5)
+    columns = [np.ones_like(log_steps), log_steps]
+    if use_temperature:
+        columns.append(temperatures - 30.0)
+    design = np.column_stack(columns)
+    settle_times = np.asarray(settle_times, float)
+    coef, _, _, _ = np.linalg.lstsq(design, settle_times, rcond=None)
+    residuals = settle_times - design @ coef
+    return {"coef": coef.tolist(), "use_temperature": use_temperature,
+            "residual_sd_s": float(np.std(residuals)), "max_s": float(settle_times.max())}
+
+
+def predict_settle_time(model, step, temperature=30.0):
+    coef = model["coef"]
+    if abs(step) < 1e-6:
+        return 0.0
+    t = coef[0] + coef[1] * np.log(max(abs(step), 1e-3))
+    if model["use_temperature"]:
+        t += coef[2] * (temperature - 30.0)
+    return float(max(t, 0.0))
+
+
+def table_from_model(lens_serial, model, current_range, diopters, temperatures, models=None):
+    """Inverts a fitted current model onto a diopter x temperature lookup table."""
+    current_grid = np.linspace(current_range[0], current_range[1], 2001)
+    rows = []
+    for temperature in temperatures:
+        predicted = predict_diopter(model, current_grid, temperature)
+        order = np.argsort(predicted)
+        rows.append(np.interp(diopters, predicted[order], current_grid[order]))
+    return CalibrationTable(lens_serial, diopters, temperatures, rows, models)
@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""
+Local lens-control daemon.
+
+The daemon opens every lens once and keeps the serial ports for itself.
+GUIs and experiment runners connect over a Unix socket (or localhost TCP on
+Windows) and get RemoteLens objects with the same methods they use on
+lib.Lens, so they start instantly and share one consistent lens state.
+
+    python lens_daemon.py                       # serve all detected lenses
+    python lens_daemon.py --emulate 2           # serve two pty emulators (Linux)
+
+    client = lens_daemon.connect()              # None when no daemon is running
+    right_lens, left_lens = client.lenses()
+    client.subscribe(lambda index, event, value, t: print(index, event, value))
+
+Wire format (little endian). Requests are fixed size:
+    <I request id> <B op> <B lens index> <d argument>
+Replies and notifications share one header followed by 'length' payload bytes:
+    <B kind> <I request id> <B status> <H length>
+OK replies carry float64 values, STR replies UTF-8 text, ERROR replies the
+error message. Notifications carry <B event> <d value> <d time.time()>.
+
+Notifications are queued per subscriber and written by its own thread, so a
+client that stops reading never holds up another client's lens commands; a
+subscriber whose queue fills up is disconnected.
+"""
+
+import os
+import queue
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import lens_status
+
+REQUEST = struct.Struct('<IBBd')
+HEADER = struct.Struct('<BIBH')
+NOTIFICATION = struct.Struct('<Bdd')
+
+KIND_REPLY, KIND_NOTIFY = 1, 2
+STATUS_OK, STATUS_STR, STATUS_ERROR = 0, 1, 2
+
+OP_LIST = 0
+OP_SET_DIOPTER = 1
+OP_GET_DIOPTER = 2
+OP_SET_CURRENT = 3
+OP_GET_CURRENT = 4
+OP_GET_TEMPERATURE = 5
+OP_TO_FOCAL_POWER = 6
+OP_TO_CURRENT = 7
+OP_GET_STATE = 8
+OP_SUBSCRIBE = 9
+
+EVENT_DIOPTER, EVENT_CURRENT, EVENT_MODE = 1, 2, 3
+
+# Notifications a subscriber may fall behind by before it is disconnected
+NOTIFY_QUEUE_SIZE = 256
+
+if hasattr(socket, 'AF_UNIX'):
+    DEFAULT_ADDRESS = 'unix:' + os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'lensd.sock')
+else:
+    DEFAULT_ADDRESS = 'tcp:127.0.0.1:50555'
+
+
+def parse_address(address):
+    kind, _, rest = address.partition(':')
+    if kind == 'unix':
+        return socket.AF_UNIX, rest
+    if kind == 'tcp':
+        host, _, port = rest.rpartition(':')
+        return socket.AF_INET, (host, int(port))
+    raise ValueError('Address must be unix:<path> or tcp:<host>:<port>, got {}'.format(address))
+
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Lens daemon connection closed')
+        data += chunk
+    return data
+
+
+def pack_reply(request_id, result):
+    if isinstance(result, str):
+        payload, status = result.encode('utf-8'), STATUS_STR
+    else:
+        values = () if result is None else (result if isinstance(result, tuple) else (result,))
+        payload, status = struct.pack('<{}d'.format(len(values)), *values), STATUS_OK
+    return HEADER.pack(KIND_REPLY, request_id, status, len(payload)) + payload
+
+
+# ------------------ Server ------------------
+class LensService:
+    """Owns the Lens objects, serializes access per lens and tracks the commanded state."""
+
+    def __init__(self, lenses, status_board=None):
+        self.lenses = lenses
+        self.status_board = status_board
+        self.locks = [threading.Lock() for _ in lenses]
+        self.commanded_diopter = [float('nan')] * len(lenses)
+        self.commanded_current = [float('nan')] * len(lenses)
+        self.last_command = [0.0] * len(lenses)
+        self.subscribers = set()
+        self.subscribers_lock = threading.Lock()
+
+    def notify(self, index, event, value):
+        message = HEADER.pack(KIND_NOTIFY, 0, index, NOTIFICATION.size) + NOTIFICATION.pack(event, value, time.time())
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+        for handler in subscribers:
+            handler.notify(message)
+
+    def execute(self, op, index, argument):
+        if op == OP_LIST:
+            return ','.join(lens.lens_serial for lens in self.lenses)
+        lens = self.lenses[index]
+        with self.locks[index]:
+            self.last_command[index] = time.monotonic()
+            if op == OP_SET_DIOPTER:
+                lens.set_diopter(argument)
+                self.commanded_diopter[index] = argument
+                self.publish(index, commanded_diopter=argument)
+            elif op == OP_GET_DIOPTER:
+                diopter = lens.get_diopter()
+                self.publish(index, confirmed_diopter=diopter)
+                return diopter
+            elif op == OP_SET_CURRENT:
+                lens.set_current(argument)
+                self.commanded_current[index] = argument
+            elif op == OP_GET_CURRENT:
+                return lens.get_current()
+            elif op == OP_GET_TEMPERATURE:
+                temperature = lens.get_temperature()
+                self.publish(index, temperature=temperature)
+                return temperature
+            elif op == OP_TO_FOCAL_POWER:
+                result = lens.to_focal_power_mode()
+                self.publish(index, mode=lens.mode)
+            elif op == OP_TO_CURRENT:
+                result = lens.to_current_mode()
+                self.publish(index, mode=lens.mode)
+            elif op == OP_GET_STATE:
+                return float(lens.mode), self.commanded_diopter[index], self.commanded_current[index]
+            else:
+                raise Exception('Unknown lens daemon op {}'.format(op))
+
+        if op == OP_SET_DIOPTER:
+            self.notify(index, EVENT_DIOPTER, argument)
+        elif op == OP_SET_CURRENT:
+            self.notify(index, EVENT_CURRENT, argument)
+        else:
+            self.notify(index, EVENT_MODE, float(lens.mode))
+            return result
+
+    def publish(self, index, **fields):
+        # Called with the lens lock held, which keeps one writer per status board slot
+        if self.status_board is not None:
+            self.status_board.update(index, **fields)
+
+    def poll_status(self, interval):
+        """
+        Refreshes confirmed diopter and temperature on the status board every
+        'interval' seconds, skipping lenses commanded within the last interval:
+        their board entries are current and the serial line stays free for them.
+        """
+        while True:
+            time.sleep(interval)
+            for index, lens in enumerate(self.lenses):
+                if time.monotonic() - self.last_command[index] < interval:
+                    continue
+                with self.locks[index]:
+                    fields = dict(temperature=lens.get_temperature(), mode=lens.mode)
+                    if lens.mode == 5:
+                        fields['confirmed_diopter'] = lens.get_diopter()
+                    self.publish(index, **fields)
+
+
+class LensRequestHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.send_lock = threading.Lock()
+        self.notifications = queue.Queue(NOTIFY_QUEUE_SIZE)
+        self.closed = False
+        if self.request.family == socket.AF_INET:
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, message):
+        try:
+            with self.send_lock:
+                self.request.sendall(message)
+        except OSError:
+            pass
+
+    def notify(self, message):
+        """Queues a notification without blocking; a subscriber that has stopped reading is disconnected."""
+        try:
+            self.notifications.put_nowait(message)
+        except queue.Full:
+            if not self.closed:
+                print('[DAEMON] Disconnecting a subscriber that stopped reading notifications')
+                self.close()
+
+    def write_notifications(self):
+        while not self.closed:
+            message = self.notifications.get()
+            if message is None:
+                break
+            self.send(message)
+
+    def close(self):
+        self.closed = True
+        with self.server.service.subscribers_lock:
+            self.server.service.subscribers.discard(self)
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def handle(self):
+        service = self.server.service
+        try:
+            while True:
+                request_id, op, index, argument = REQUEST.unpack(recv_exact(self.request, REQUEST.size))
+                if op == OP_SUBSCRIBE:
+                    self.send(pack_reply(request_id, None))
+                    with service.subscribers_lock:
+                        if self not in service.subscribers:
+                            threading.Thread(target=self.write_notifications, name='LensService notifier',
+                                             daemon=True).start()
+                        service.subscribers.add(self)
+                    continue
+                try:
+                    reply = pack_reply(request_id, service.execute(op, index, argument))
+                except Exception as e:
+                    message = str(e).encode('utf-8')
+                    reply = HEADER.pack(KIND_REPLY, request_id, STATUS_ERROR, len(message)) + message
+                self.send(reply)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            with service.subscribers_lock:
+                service.subscribers.discard(self)
+            try:
+                self.notifications.put_nowait(None)
+            except queue.Full:
+                pass
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(lenses, address=DEFAULT_ADDRESS, status_board=None):
+    family, bind_address = parse_address(address)
+    if family == socket.AF_INET:
+        server = ThreadingTCPServer(bind_address, LensRequestHandler)
+    else:
+        if os.path.exists(bind_address):
+            os.unlink(bind_address)
+        server = ThreadingUnixServer(bind_address, LensRequestHandler)
+    server.service = LensService(lenses, status_board)
+    return server
+
+
+# ------------------ Client ------------------
+class LensClient:
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=5.0):
+        family, connect_address = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(connect_address)
+        self.sock.settimeout(None)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.timeout = timeout
+        self.pending = {}
+        self.callbacks = []
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.reader = threading.Thread(target=self._read_loop, name='LensClient reader', daemon=True)
+        self.reader.start()
+
+    def _read_loop(self):
+        try:
+            while True:
+                kind, request_id, status, length = HEADER.unpack(recv_exact(self.sock, HEADER.size))
+                payload = recv_exact(self.sock, length) if length else b''
+                if kind == KIND_NOTIFY:
+                    event, value, timestamp = NOTIFICATION.unpack(payload)
+                    for callback in list(self.callbacks):
+                        callback(status, event, value, timestamp)
+                    continue
+                future = self.pending.pop(request_id, None)
+                if future is None:
+                    continue
+                if status == STATUS_ERROR:
+                    future.set_exception(Exception(payload.decode('utf-8')))
+                elif status == STATUS_STR:
+                    future.set_result(payload.decode('utf-8'))
+                else:
+                    future.set_result(struct.unpack('<{}d'.format(length // 8), payload))
+        except (ConnectionError, OSError) as e:
+            for future in list(self.pending.values()):
+                future.set_exception(ConnectionError(str(e)))
+            self.pending.clear()
+
+    def request(self, op, index=0, argument=0.0):
+        future = Future()
+        with self.lock:
+            request_id = self.next_id
+            self.next_id = (self.next_id + 1) & 0xFFFFFFFF or 1
+            self.pending[request_id] = future
+            self.sock.sendall(REQUEST.pack(request_id, op, index, argument))
+        return future.result(self.timeout)
+
+    def lenses(self):
+        serials = self.request(OP_LIST)
+        return [RemoteLens(self, i, serial) for i, serial in enumerate(serials.split(',')) if serial]
+
+    def subscribe(self, callback):
+        """callback(lens_index, event, value, timestamp) runs on the reader thread for every state change."""
+        self.callbacks.append(callback)
+        if len(self.callbacks) == 1:
+            self.request(OP_SUBSCRIBE)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class RemoteLens:
+    """Stands in for lib.Lens in the experiment scripts; the daemon keeps the port open."""
+
+    def __init__(self, client, index, lens_serial):
+        self.client = client
+        self.index = index
+        self.lens_serial = lens_serial
+
+    @property
+    def mode(self):
+        return int(self.client.request(OP_GET_STATE, self.index)[0])
+
+    def get_lens_serial_number(self):
+        return self.lens_serial
+
+    def set_diopter(self, diopter):
+        self.client.request(OP_SET_DIOPTER, self.index, diopter)
+
+    def get_diopter(self):
+        return self.client.request(OP_GET_DIOPTER, self.index)[0]
+
+    def set_current(self, current):
+        self.client.request(OP_SET_CURRENT, self.index, current)
+
+    def get_current(self):
+        return self.client.request(OP_GET_CURRENT, self.index)[0]
+
+    def get_temperature(self):
+        return self.client.request(OP_GET_TEMPERATURE, self.index)[0]
+
+    def to_focal_power_mode(self):
+        return self.client.request(OP_TO_FOCAL_POWER, self.index)
+
+    def to_current_mode(self):
+        self.client.request(OP_TO_CURRENT, self.index)
+
+    def get_state(self):
+        """(mode, commanded diopter, commanded current) as tracked by the daemon; no serial traffic."""
+        mode, diopter, current = self.client.request(OP_GET_STATE, self.index)
+        return int(mode), diopter, current
+
+    @property
+    def connection(self):
+        return self
+
+    def close(self):
+        pass
+
+    def lens_close(self, stats_path=None):
+        pass
+
+
+def connect(address=DEFAULT_ADDRESS, timeout=5.0):
+    """Returns a LensClient, or None when no daemon is listening on address."""
+    try:
+        return LensClient(address, timeout)
+    except (ConnectionError, FileNotFoundError, OSError):
+        return None
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve all connected lenses over a local socket.')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help='unix:<path> or tcp:<host>:<port>')
+    parser.add_argument('--emulate', type=int, default=0, help='serve this many pty emulators instead of COM ports')
+    parser.add_argument('--status-board', default=lens_status.DEFAULT_PATH, help='shared-memory status file')
+    parser.add_argument('--status-interval', type=float, default=0.0,
+                        help='seconds between status board refreshes from idle lenses (0, the default, disables '
+                             'polling; commands keep the board current)')
+    args = parser.parse_args()
+
+    from lib import Lens
+
+    emulators = []
+    if args.emulate:
+        from lens_emulator import LensEmulator
+        emulators = [LensEmulator(serial_number=f'CBAA{i:04d}').start() for i in range(args.emulate)]
+        ports = [emu.port for emu in emulators]
+    else:
+        import serial.tools.list_ports
+        ports = [p.name if sys.platform == 'win32' else p.device for p in serial.tools.list_ports.comports()]
+
+    lenses = []
+    for port in ports:
+        lens = Lens(port)
+        lens.to_focal_power_mode()
+        lenses.append(lens)
+        print(f'[DAEMON] Lens {lens.lens_serial} on {port}')
+
+    status_board = lens_status.StatusBoard(args.status_board, [lens.lens_serial for lens in lenses])
+    for index, lens in enumerate(lenses):
+        status_board.update(index, mode=lens.mode)
+    server = make_server(lenses, args.address, status_board)
+    if args.status_interval > 0:
+        threading.Thread(target=server.service.poll_status, args=(args.status_interval,), daemon=True).start()
+    print(f'[DAEMON] Listening on {args.address}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for lens in lenses:
+            lens.lens_close()
+        for emu in emulators:
+            emu.stop()
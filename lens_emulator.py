@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+Pseudo-terminal emulator of an Optotune lens driver.
+
+Opens a pty pair and answers on the master side with the same wire protocol
+lib.Lens speaks (Start/Ready handshake, CRC-16 framed commands and replies),
+so real Lens(port) objects can be opened against emulator.port on Linux.
+
+    with LensEmulator(settle_tau=0.02) as emu:
+        lens = Lens(emu.port)
+
+Run as a script to serve one or more emulated lenses until Ctrl-C:
+
+    python lens_emulator.py --count 2 --latency 0.002
+"""
+
+import math
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+from lib import crc_16
+
+BAUDRATE = 115200
+
+# Request payload length (without CRC) for every opcode lib.Lens uses.
+# Longer opcodes come first so prefix matching picks the most specific one.
+COMMAND_LENGTHS = [
+    (b'CrMA', 6), (b'PwTA', 8), (b'MwCA', 4), (b'MwDA', 4),
+    (b'PwDA', 8), (b'PrDA', 8), (b'MMA', 3), (b'TCA', 3),
+    (b'IR', 10), (b'Ar', 4), (b'Aw', 4), (b'Zr', 3), (b'Zw', 4),
+    (b'H', 1), (b'V', 2), (b'X', 1), (b'F', 1),
+]
+
+MODE_CURRENT = 1
+MODE_FOCAL_POWER = 5
+
+
+def frame_reply(data):
+    return data + struct.pack('<H', crc_16(data)) + b'\r\n'
+
+
+class LensEmulator:
+    def __init__(self, serial_number='CBAA0000', device_id='EMULATOR', firmware_type='A',
+                 firmware_version=(1, 0, 0, 0), max_output_current=290.0, min_diopter=-2.0,
+                 max_diopter=3.0, diopter_offset=0.5, diopter_per_ma=0.02, temperature=30.0,
+                 temperature_coefficient=0.0, latency=0.0, settle_tau=0.0, emulate_baudrate=False,
+                 drop_rate=0.0, corrupt_rate=0.0, seed=None):
+        self.serial_number = serial_number
+        self.device_id = device_id
+        self.firmware_type = firmware_type
+        self.firmware_version = firmware_version
+        self.max_output_current = max_output_current
+        self.min_diopter = min_diopter
+        self.max_diopter = max_diopter
+
+        # Open-loop lens model: diopter = offset + gain * current (+ drift with temperature)
+        self.diopter_offset = diopter_offset
+        self.diopter_per_ma = diopter_per_ma
+        self.temperature = temperature
+        self.temperature_coefficient = temperature_coefficient
+
+        # Timing: fixed reply latency and first-order step response time constant (s)
+        self.latency = latency
+        self.settle_tau = settle_tau
+        self.emulate_baudrate = emulate_baudrate
+
+        # Fault injection on replies: probability of dropping or flipping one byte per frame
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self._random = random.Random(seed)
+
+        self.mode = MODE_FOCAL_POWER
+        self.eeprom = bytearray((i * 7) & 0xFF for i in range(256))
+        self.commands_received = 0
+        self.crc_errors = 0
+
+        self._start_value = 0.0
+        self._target_value = 0.0
+        self._step_time = time.monotonic()
+
+        self._master_fd = None
+        self._slave_fd = None
+        self._thread = None
+        self._running = False
+        self.port = None
+
+    # ------------------ Lifecycle ------------------
+    def start(self):
+        self._master_fd, self._slave_fd = os.openpty()
+        tty.setraw(self._slave_fd)
+        self.port = os.ttyname(self._slave_fd)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name=f'LensEmulator {self.port}', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+        for fd in (self._master_fd, self._slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self._master_fd = self._slave_fd = self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ------------------ Lens model ------------------
+    def _diopter_from_current(self, current):
+        drift = self.temperature_coefficient * (self.temperature - 30.0)
+        return self.diopter_offset + self.diopter_per_ma * current + drift
+
+    def _current_from_diopter(self, diopter):
+        drift = self.temperature_coefficient * (self.temperature - 30.0)
+        return (diopter - self.diopter_offset - drift) / self.diopter_per_ma
+
+    def _step_to(self, value):
+        self._start_value = self.actual_value()
+        self._target_value = value
+        self._step_time = time.monotonic()
+
+    def actual_value(self):
+        """Settled quantity of the active mode (diopter or mA) at this instant."""
+        if self.settle_tau <= 0:
+            return self._target_value
+        elapsed = time.monotonic() - self._step_time
+        decay = math.exp(-elapsed / self.settle_tau)
+        return self._target_value + (self._start_value - self._target_value) * decay
+
+    def actual_diopter(self):
+        value = self.actual_value()
+        return value if self.mode == MODE_FOCAL_POWER else self._diopter_from_current(value)
+
+    def actual_current(self):
+        value = self.actual_value()
+        return value if self.mode == MODE_CURRENT else self._current_from_diopter(value)
+
+    def _raw_diopter(self, diopter):
+        return int(round((diopter + 5) * 200 if self.firmware_type == 'A' else diopter * 200))
+
+    def _diopter_from_raw(self, raw):
+        return raw / 200 - 5 if self.firmware_type == 'A' else raw / 200
+
+    # ------------------ Command handling ------------------
+    def handle(self, command):
+        """Return the reply payload for one CRC-checked request, or None for write-only commands."""
+        self.commands_received += 1
+        op4, op3, op2 = command[:4], command[:3], command[:2]
+
+        if op4 == b'CrMA':
+            return b'CrM' + struct.pack('>h', int(self.max_output_current * 100))
+        if op4 == b'PwTA':
+            return b'PT' + struct.pack('>Bhh', 0, self._raw_diopter(self.max_diopter),
+                                       self._raw_diopter(self.min_diopter))
+        if op4 == b'MwCA':
+            diopter = self.actual_diopter()
+            self.mode = MODE_FOCAL_POWER
+            self._start_value = self._target_value = diopter
+            return b'MwC' + struct.pack('>Bhh', 0, self._raw_diopter(self.max_diopter),
+                                        self._raw_diopter(self.min_diopter))
+        if op4 == b'MwDA':
+            current = self.actual_current()
+            self.mode = MODE_CURRENT
+            self._start_value = self._target_value = current
+            return b'MwD'
+        if op4 == b'PwDA':
+            if self.mode == MODE_FOCAL_POWER:
+                raw, = struct.unpack('>h', command[4:6])
+                diopter = min(max(self._diopter_from_raw(raw), self.min_diopter), self.max_diopter)
+                self._step_to(diopter)
+            return None
+        if op4 == b'PrDA':
+            return b'PD' + struct.pack('>h', self._raw_diopter(self.actual_diopter()))
+        if op3 == b'MMA':
+            return b'MMA' + struct.pack('>B', self.mode)
+        if op3 == b'TCA':
+            return b'TCA' + struct.pack('>h', int(round(self.temperature * 16)))
+        if op2 == b'IR':
+            return b'IR' + self.device_id.encode('ascii')[:8].ljust(8)
+        if op2 == b'Ar':
+            raw = int(round(self.actual_current() * 4095 / self.max_output_current))
+            return b'A' + struct.pack('>h', max(-4095, min(4095, raw)))
+        if op2 == b'Aw':
+            if self.mode == MODE_CURRENT:
+                raw, = struct.unpack('>h', command[2:4])
+                self._step_to(raw * self.max_output_current / 4095)
+            return None
+        if op2 == b'Zr':
+            return b'Z' + bytes([self.eeprom[command[2]]])
+        if op2 == b'Zw':
+            self.eeprom[command[2]] = command[3]
+            return b'Z' + bytes([command[3]])
+        if command[:1] == b'H':
+            return b'H' + self.firmware_type.encode('ascii')
+        if command[:1] == b'V':
+            return b'V' + struct.pack('>BBHH', *self.firmware_version)
+        if command[:1] == b'X':
+            return b'X' + self.serial_number.encode('ascii')[:8].ljust(8)
+        if command[:1] == b'F':
+            return b'F' + struct.pack('>B', 0)
+        return None
+
+    def _command_length(self, buffer):
+        for opcode, length in COMMAND_LENGTHS:
+            if buffer.startswith(opcode):
+                return length
+            if opcode.startswith(bytes(buffer)):
+                return 0  # could still become this opcode, wait for more bytes
+        return None
+
+    def _inject_faults(self, frame):
+        if self.drop_rate and self._random.random() < self.drop_rate:
+            i = self._random.randrange(len(frame))
+            frame = frame[:i] + frame[i + 1:]
+        if self.corrupt_rate and self._random.random() < self.corrupt_rate:
+            i = self._random.randrange(len(frame))
+            frame = frame[:i] + bytes([frame[i] ^ 0x5A]) + frame[i + 1:]
+        return frame
+
+    def _write(self, data):
+        if self.emulate_baudrate:
+            time.sleep(len(data) * 10 / BAUDRATE)
+        os.write(self._master_fd, data)
+
+    def _serve(self):
+        buffer = bytearray()
+        while self._running:
+            ready, _, _ = select.select([self._master_fd], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                buffer += os.read(self._master_fd, 4096)
+            except OSError:
+                continue
+
+            while buffer:
+                if buffer.startswith(b'Start'):
+                    del buffer[:5]
+                    self._write(b'Ready\r\n')
+                    continue
+                if b'Start'.startswith(bytes(buffer)):
+                    break
+
+                length = self._command_length(buffer)
+                if length is None:
+                    del buffer[:1]  # unknown opcode, resynchronize on the next byte
+                    continue
+                if length == 0 or len(buffer) < length + 2:
+                    break
+
+                command, crc = bytes(buffer[:length]), struct.unpack('<H', buffer[length:length + 2])[0]
+                if crc != crc_16(command):
+                    self.crc_errors += 1
+                    del buffer[:1]
+                    continue
+                del buffer[:length + 2]
+
+                if self.emulate_baudrate:
+                    time.sleep((length + 2) * 10 / BAUDRATE)
+                reply = self.handle(command)
+                if reply is not None:
+                    if self.latency > 0:
+                        time.sleep(self.latency)
+                    self._write(self._inject_faults(frame_reply(reply)))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve emulated Optotune lens drivers on pseudo-terminals.')
+    parser.add_argument('--count', type=int, default=1, help='number of lenses to emulate')
+    parser.add_argument('--latency', type=float, default=0.0, help='reply latency in seconds')
+    parser.add_argument('--settle-tau', type=float, default=0.0, help='step response time constant in seconds')
+    parser.add_argument('--baudrate', action='store_true', help='emulate 115200 baud transfer time')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='probability of dropping a byte from a reply')
+    parser.add_argument('--corrupt-rate', type=float, default=0.0, help='probability of corrupting a reply byte')
+    args = parser.parse_args()
+
+    emulators = [LensEmulator(serial_number=f'CBAA{i:04d}', latency=args.latency, settle_tau=args.settle_tau,
+                              emulate_baudrate=args.baudrate, drop_rate=args.drop_rate,
+                              corrupt_rate=args.corrupt_rate).start() for i in range(args.count)]
+    for emu in emulators:
+        print(f'[EMULATOR] Lens {emu.serial_number} listening on {emu.port}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for emu in emulators:
+            emu.stop()
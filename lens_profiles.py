@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Lens model profiles and per-switch settle waits.
+
+Lenses are recognised by their serial prefix. Each profile holds the GUI
+slider limits and presets, the focal-power range that is safe to command, and
+optionally a settle-time model in the format of lens_calibration.fit_settle_model:
+settle_time = a + b*ln|step| (+ c*(T-30)). Only measured step responses belong
+there; no model is shipped for a lens type until one has been characterized.
+
+A calibration sweep (calibrate_lens.py) stores a measured model for each lens
+serial, and lenses driven through an overdrive shaper (command_shaping.py) use
+the shaped model instead. Without any model the wait stays at the fixed 1 s.
+
+    timer = SwitchTimer(lenses)
+    wait = timer.wait(previous_diopter, new_diopter)   # seconds
+"""
+
+import time
+
+from lens_calibration import CalibrationStore, predict_settle_time
+
+
+class LensProfile:
+    def __init__(self, model, serial_prefix, slider_range, safe_range, presets, settle_model=None):
+        self.model = model
+        self.serial_prefix = serial_prefix
+        self.slider_range = slider_range
+        self.safe_range = safe_range
+        self.presets = presets
+        # None means "not characterized": waits fall back to the worst case
+        self.settle_model = settle_model
+
+    def clamp(self, diopter):
+        return min(max(diopter, self.safe_range[0]), self.safe_range[1])
+
+    def settle_time(self, step, temperature=30.0, settle_model=None):
+        model = settle_model or self.settle_model
+        if model is None:
+            return None
+        return predict_settle_time(model, step, temperature)
+
+
+# Settle models stay None until a lens type has been characterized; per-lens calibrations apply regardless
+PROFILES = [
+    LensProfile("EL-16-40", "ANAB", (-10.0, 10.0), (-10.0, 10.0), [-10, -5, -2, 0, 2, 5, 10]),
+    LensProfile("Autofocal EL-35-45", "CBAA", (-2.0, 3.0), (-2.0, 3.0), [-2, -1, 0, 1, 2, 3]),
+]
+UNKNOWN_PROFILE = LensProfile("Unknown", "", (-2.0, 3.0), (-2.0, 3.0), [-2, -1, 0, 1, 2, 3])
+
+
+def profile_for(lens_serial):
+    for profile in PROFILES:
+        if lens_serial and lens_serial.startswith(profile.serial_prefix):
+            return profile
+    return UNKNOWN_PROFILE
+
+
+class SwitchTimer:
+    """
+    Minimum safe wait after commanding new focal powers: the slowest lens's
+    predicted settle time plus margin_sd residual standard deviations, kept
+    within [min_wait, max_wait]. max_wait is the old fixed one-second wait and
+    is used whenever a lens has no settle model or the previous power is unknown.
+    """
+
+    def __init__(self, lenses, store=None, margin_sd=3.0, min_wait=0.05, max_wait=1.0, temperature_refresh=10.0):
+        self.lenses = lenses
+        self.margin_sd = margin_sd
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.temperature_refresh = temperature_refresh
+        store = store or CalibrationStore()
+        self.profiles = []
+        self.settle_models = []
+        for lens in lenses:
+            lens_serial = getattr(lens, "lens_serial", None)
+            self.profiles.append(profile_for(lens_serial))
+            model = None
+            if lens_serial and store.has(lens_serial):
+                key = "settle_time_shaped" if getattr(lens, "shaper", None) is not None else "settle_time"
+                model = store.load(lens_serial).models.get(key)
+            self.settle_models.append(model or self.profiles[-1].settle_model)
+        self._temperatures = [None] * len(lenses)
+        self._temperature_time = 0.0
+
+    def temperatures(self):
+        """Lens temperatures, re-read at most every temperature_refresh seconds (30 C when unavailable)."""
+        now = time.monotonic()
+        if self._temperatures[0] is None or now - self._temperature_time > self.temperature_refresh:
+            self._temperatures = [lens.get_temperature() if hasattr(lens, "get_temperature") else 30.0
+                                  for lens in self.lenses]
+            self._temperature_time = now
+        return self._temperatures
+
+    def wait(self, previous, target):
+        if previous is None or any(model is None for model in self.settle_models):
+            return self.max_wait
+        step = float(target) - float(previous)
+        if abs(step) < 1e-6:
+            return 0.0
+        wait = 0.0
+        for profile, model, temperature in zip(self.profiles, self.settle_models, self.temperatures()):
+            settle = profile.settle_time(step, temperature, model) + self.margin_sd * model["residual_sd_s"]
+            wait = max(wait, settle)
+        return min(max(wait, self.min_wait), self.max_wait)
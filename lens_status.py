@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory lens status board.
+
+The process that owns the lenses (lens_daemon.py or the experiment script)
+publishes one fixed-layout record per lens into a memory-mapped file. Any
+number of readers can poll it at kHz rates without touching the serial bus.
+
+Each record is protected by a seqlock: the writer makes the sequence number
+odd, writes the payload, then makes it even again; a reader retries when it
+sees an odd number or the number changed while it copied the payload. Each
+record must have exactly one writer at a time.
+
+    python lens_status.py                # print the board at 10 Hz
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'lens_status.bin')
+
+MAGIC = b'LSTB'
+VERSION = 1
+HEADER = struct.Struct('<4sHH8x')                   # magic, version, lens count
+SEQ = struct.Struct('<I4x')
+PAYLOAD = struct.Struct('<8sddd B7x d')             # serial, commanded/confirmed diopter, temperature, mode, update time
+SLOT_SIZE = 64
+
+FIELDS = ('lens_serial', 'commanded_diopter', 'confirmed_diopter', 'temperature', 'mode', 'update_time')
+
+
+class StatusBoard:
+    def __init__(self, path=DEFAULT_PATH, lens_serials=None):
+        """Opens the board at path; with lens_serials, (re)creates it for writing."""
+        self.path = path
+        self.writer = lens_serials is not None
+        if self.writer:
+            # Readers in other processes may have the board mapped: it is rewritten in place and only ever
+            # grows, since truncating a mapped file faults their reads (SIGBUS) or fails on Windows
+            size = HEADER.size + SLOT_SIZE * len(lens_serials)
+            try:
+                self._file = open(path, 'r+b')
+            except FileNotFoundError:
+                self._file = open(path, 'w+b')
+            if os.fstat(self._file.fileno()).st_size < size:
+                self._file.truncate(size)
+            self._file.seek(0)
+            self._file.write(HEADER.pack(MAGIC, VERSION, len(lens_serials)))
+            self._file.flush()
+        else:
+            self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE if self.writer else mmap.ACCESS_READ)
+
+        magic, version, self.num_lenses = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise Exception('Not a lens status board: {}'.format(path))
+        if self.writer:
+            self._records = []
+            for i, serial in enumerate(lens_serials):
+                record = [serial, float('nan'), float('nan'), float('nan'), 0, time.time()]
+                self._records.append(record)
+                self._publish(i)
+
+    def _offset(self, index):
+        return HEADER.size + index * SLOT_SIZE
+
+    def _publish(self, index):
+        offset = self._offset(index)
+        seq, = SEQ.unpack_from(self._map, offset)
+        serial, commanded, confirmed, temperature, mode, update_time = self._records[index]
+        SEQ.pack_into(self._map, offset, (seq + 1) & 0xFFFFFFFF)
+        PAYLOAD.pack_into(self._map, offset + SEQ.size, serial.encode('ascii')[:8], commanded, confirmed,
+                          temperature, mode, update_time)
+        SEQ.pack_into(self._map, offset, (seq + 2) & 0xFFFFFFFF)
+
+    def update(self, index, commanded_diopter=None, confirmed_diopter=None, temperature=None, mode=None):
+        record = self._records[index]
+        if commanded_diopter is not None:
+            record[1] = commanded_diopter
+        if confirmed_diopter is not None:
+            record[2] = confirmed_diopter
+        if temperature is not None:
+            record[3] = temperature
+        if mode is not None:
+            record[4] = mode
+        record[5] = time.time()
+        self._publish(index)
+
+    def read(self, index):
+        """Consistent snapshot of one lens record as a dict (spins while a write is in progress)."""
+        offset = self._offset(index)
+        while True:
+            seq1, = SEQ.unpack_from(self._map, offset)
+            if seq1 & 1:
+                continue
+            values = PAYLOAD.unpack_from(self._map, offset + SEQ.size)
+            seq2, = SEQ.unpack_from(self._map, offset)
+            if seq1 == seq2:
+                break
+        record = dict(zip(FIELDS, values))
+        record['lens_serial'] = record['lens_serial'].rstrip(b'\x00').decode('ascii')
+        return record
+
+    def read_all(self):
+        return [self.read(i) for i in range(self.num_lenses)]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def open_board(path=DEFAULT_PATH):
+    """Returns a read-only StatusBoard, or None when no lens owner has published one."""
+    try:
+        return StatusBoard(path)
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    import sys
+
+    board = StatusBoard(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH)
+    try:
+        while True:
+            line = []
+            for record in board.read_all():
+                age = time.time() - record['update_time']
+                line.append('{lens_serial} mode {mode} cmd {commanded_diopter:+.2f} D '
+                            'conf {confirmed_diopter:+.2f} D {temperature:.1f} C'.format(**record) + f' ({age:.1f} s)')
+            print(' | '.join(line), end='\r', flush=True)
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        print()
+    finally:
+        board.close()
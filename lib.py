@@ -1,17 +1,51 @@
+import json
+import math
 import struct
+import time
 import serial
 
+from frame_trace import FrameTracer, TX, RX
+
+# Opcodes sent by Lens, longest first so command_name() matches the most specific one
+OPCODES = ('CrMA', 'PwTA', 'MwCA', 'MwDA', 'PwDA', 'PrDA', 'MMA', 'TCA',
+           'IR', 'Ar', 'Aw', 'Zr', 'Zw', 'H', 'V', 'X', 'F')
+# Pure queries: safe to send again after a lost or corrupted reply
+QUERY_OPCODES = frozenset(('H', 'V', 'IR', 'CrMA', 'MMA', 'TCA', 'PrDA', 'Ar', 'X', 'Zr', 'F'))
+# Queries plus writes that set absolute state (temperature limits, mode switches), so a repeat changes nothing
+IDEMPOTENT_OPCODES = QUERY_OPCODES | frozenset(('PwTA', 'MwCA', 'MwDA'))
+
 
 class Lens:
-    def __init__(self, port, debug=False):
+    # Reply timeouts adapt per opcode to observed latency, within these bounds (s); the floor stays above
+    # USB-serial latency jitter (e.g. the 16 ms FTDI latency timer)
+    min_timeout = 0.02
+    max_timeout = 1.0
+    # Serial read granularity once the handshake is done; reads still return as soon as the bytes arrive
+    poll_interval = 0.002
+    # How long a reply may stall after an early '\r\n' before it counts as a short frame; a reply split
+    # across USB packets (or a payload containing '\r\n') resumes only after the latency timer, so this
+    # stays at the same floor as the timeouts
+    short_read_grace = 0.02
+    retries = 2
+
+    def __init__(self, port, debug=False, trace_path=None, trace_capacity=4096):
         self.debug = debug
+        self.stats = CommandStats()
+        # Raw frames go to an in-memory ring buffer; it is written to trace_path on protocol errors
+        self.tracer = FrameTracer(trace_capacity, label=str(port))
+        self.trace_path = trace_path
 
         self.connection = serial.Serial(port, 115200, timeout=1)
         self.connection.flush()
 
-        self.connection.write(b'Start')
-        if not self.connection.readline() == b'Ready\r\n':
+        for attempt in range(1 + self.retries):
+            self.connection.reset_input_buffer()
+            self.connection.write(b'Start')
+            if self.connection.readline() == b'Ready\r\n':
+                break
+        else:
             raise Exception('Lens Driver did not reply to handshake')
+        self.connection.timeout = self.poll_interval
 
         self.firmware_type = self.get_firmware_type()
         self.firmware_version = self.get_firmware_version()
@@ -23,6 +57,11 @@ class Lens:
         self.mode = None
         self.refresh_active_mode()
 
+        # Optional command_shaping.CommandShaper used by set_diopter; needs the previous target to shape a step
+        self.shaper = None
+        self.commanded_diopter = None
+        self.focal_power_range = None
+
         self.lens_serial = self.get_lens_serial_number()
 
         if self.debug:
@@ -31,27 +70,104 @@ class Lens:
     def send_command(self, command, reply_fmt=None):
         if type(command) is not bytes:
             command = bytes(command, encoding='ascii')
+        stat = self.stats.get(command)
         command = command + struct.pack('<H', crc_16(command))
-        if self.debug:
-            commandhex = ' '.join('{:02x}'.format(c) for c in command)
-            print('{:<50} ¦ {}'.format(commandhex, command))
-        self.connection.write(command)
 
-        if reply_fmt is not None:
-            response_size = struct.calcsize(reply_fmt)
-            response = self.connection.read(response_size+4)
+        if reply_fmt is None:
+            start = time.perf_counter()
+            self._write_frame(command, stat)
+            stat.record(time.perf_counter() - start)
+            return
+
+        response_size = struct.calcsize(reply_fmt)
+        attempts = 1 + (self.retries if stat.name in IDEMPOTENT_OPCODES else 0)
+        for attempt in range(attempts):
+            if attempt:
+                stat.retries += 1
+            # A late reply to an earlier command must not be taken for this one
+            self.connection.reset_input_buffer()
+            start = time.perf_counter()
+            self._write_frame(command, stat)
+            response = self._read_frame(response_size + 4, stat.timeout(self.min_timeout, self.max_timeout))
+            elapsed = time.perf_counter() - start
+            stat.bytes_in += len(response)
             if self.debug:
                 responsehex = ' '.join('{:02x}'.format(c) for c in response)
                 print('{:>50} ¦ {}'.format(responsehex, response))
 
-            if response is None:
-                raise Exception('Expected response not received')
-
-            data, crc, newline = struct.unpack('<{}sH2s'.format(response_size), response)
-            if crc != crc_16(data) or newline != b'\r\n':
-                raise Exception('Response CRC not correct')
-
-            return struct.unpack(reply_fmt, data)
+            if len(response) != response_size + 4:
+                stat.timeouts += 1
+                stat.record(elapsed)
+                error = 'Expected response not received'
+            else:
+                data, crc, newline = struct.unpack('<{}sH2s'.format(response_size), response)
+                if crc != crc_16(data) or newline != b'\r\n':
+                    stat.crc_failures += 1
+                    stat.record(elapsed)
+                    error = 'Response CRC not correct'
+                elif data[:1] != command[:1]:
+                    # Replies echo the first opcode character; anything else belongs to another command
+                    stat.mismatches += 1
+                    stat.record(elapsed)
+                    error = 'Response does not match the command'
+                else:
+                    stat.record(elapsed, ok=True)
+                    return struct.unpack(reply_fmt, data)
+            self._resync()
+
+        self.dump_trace()
+        raise Exception(error)
+
+    def _write_frame(self, command, stat):
+        if self.debug:
+            commandhex = ' '.join('{:02x}'.format(c) for c in command)
+            print('{:<50} ¦ {}'.format(commandhex, command))
+        self.connection.write(command)
+        self.tracer.record(TX, command)
+        stat.bytes_out += len(command)
+
+    def _read_frame(self, size, timeout):
+        """Reads one reply of 'size' bytes, giving up at the deadline or on a premature '\\r\\n'."""
+        now = time.perf_counter()
+        deadline = now + timeout
+        response = self.connection.read(size)
+        while len(response) < size:
+            now = time.perf_counter()
+            if response.endswith(b'\r\n'):
+                # The delimiter came early: a byte was dropped unless the rest is still in flight
+                deadline = min(deadline, now + self.short_read_grace)
+            if now >= deadline:
+                break
+            response += self.connection.read(size - len(response))
+        self.tracer.record(RX, response)
+        return response
+
+    def _resync(self):
+        """Discards the rest of a broken reply, up to the next '\\r\\n' or until the line goes quiet."""
+        junk = b''
+        deadline = time.perf_counter() + self.short_read_grace
+        while time.perf_counter() < deadline:
+            chunk = self.connection.read(self.connection.in_waiting or 1)
+            if chunk:
+                junk += chunk
+                deadline = time.perf_counter() + self.short_read_grace
+            if junk.endswith(b'\r\n') and not self.connection.in_waiting:
+                break
+        if junk:
+            self.tracer.record(RX, junk)
+
+    def dump_trace(self, path=None):
+        path = path or self.trace_path
+        if path is not None:
+            return self.tracer.dump(path)
+
+    def get_command_stats(self):
+        return self.stats.summary()
+
+    def save_command_stats(self, path):
+        summary = {'lens_serial': getattr(self, 'lens_serial', None), 'commands': self.get_command_stats()}
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
 
     def get_max_output_current(self):
         return self.send_command('CrMA\x00\x00', '>xxxh')[0]/100
@@ -74,8 +190,53 @@ class Lens:
     def eeprom_write_byte(self, address, byte):
         return self.send_command(b'Zw' + struct.pack('BB', address, byte), '>xB')[0]
 
+    def eeprom_read(self, addresses, window=32):
+        """
+        Reads EEPROM bytes with up to 'window' 'Zr' requests in flight instead of
+        one round trip per byte. Addresses whose replies are lost or corrupted are
+        re-read one at a time through send_command.
+        """
+        addresses = list(addresses)
+        values = {}
+        stat = self.stats.get(b'Zr')
+        batch_stat = self.stats.by_opcode.setdefault('Zr pipelined', CommandStat('Zr pipelined'))
+        for first in range(0, len(addresses), window):
+            batch = addresses[first:first + window]
+            size = 6 * len(batch)
+            self.connection.reset_input_buffer()
+            start = time.perf_counter()
+            for address in batch:
+                command = b'Zr' + struct.pack('B', address)
+                self._write_frame(command + struct.pack('<H', crc_16(command)), stat)
+            # Replies arrive back to back, so only the whole batch has a deadline
+            deadline = start + min(stat.timeout(self.min_timeout, self.max_timeout) * len(batch), self.max_timeout)
+            response = self.connection.read(size)
+            while len(response) < size and time.perf_counter() < deadline:
+                response += self.connection.read(size - len(response))
+            self.tracer.record(RX, response)
+            stat.bytes_in += len(response)
+
+            for i, address in enumerate(batch):
+                frame = response[6 * i:6 * i + 6]
+                if len(frame) == 6 and frame[:1] == b'Z' and frame[4:] == b'\r\n' and \
+                        struct.unpack('<H', frame[2:4])[0] == crc_16(frame[:2]):
+                    values[address] = frame[1]
+                    continue
+                # Framing is lost from here on: drain the line and fall back to single reads
+                if len(frame) == 6:
+                    stat.crc_failures += 1
+                else:
+                    stat.timeouts += 1
+                self._resync()
+                for remaining in batch[i:]:
+                    values[remaining] = self.send_command(b'Zr' + struct.pack('B', remaining), '>xB')[0]
+                break
+            else:
+                batch_stat.record(time.perf_counter() - start, ok=True)
+        return [values[address] for address in addresses]
+
     def eeprom_dump(self):
-        return [self.send_command(b'Zr'+ struct.pack('B', i), '>xB')[0] for i in range(256)]
+        return self.eeprom_read(range(256))
 
     def eeprom_print(self):
         eeprom = self.eeprom_dump()
@@ -113,6 +274,14 @@ class Lens:
     def set_diopter(self, diopter):
         if not self.mode == 5:
             raise Exception('Cannot set focal power when not in focal power mode')
+        if self.shaper is not None and self.commanded_diopter is not None:
+            self.shaper.apply(self.write_diopter, self.commanded_diopter, diopter)
+        else:
+            self.write_diopter(diopter)
+        self.commanded_diopter = diopter
+
+    def write_diopter(self, diopter):
+        """Sends one focal power command as is: no shaping, no commanded_diopter update (see set_diopter)."""
         raw_diopter = int((diopter + 5)*200 if self.firmware_type == 'A' else diopter*200)
         self.send_command(b'PwDA' + struct.pack('>h', raw_diopter) + b'\x00\x00')
 
@@ -121,6 +290,9 @@ class Lens:
         min_fp, max_fp = min_fp_raw/200, max_fp_raw/200
         if self.firmware_type == 'A':
             min_fp, max_fp = min_fp - 5, max_fp - 5
+        self.focal_power_range = (min_fp, max_fp)
+        # The firmware holds its current focal power, which is not necessarily the last target
+        self.commanded_diopter = None
 
         self.refresh_active_mode()
         return min_fp, max_fp
@@ -133,10 +305,126 @@ class Lens:
         self.mode = self.send_command('MMA', '>xxxB')[0]
         return self.mode
     
-    def lens_close(self):
-         self.connection = serial.Serial.close()
-         
-        
+    def lens_close(self, stats_path=None):
+        if stats_path is not None:
+            self.save_command_stats(stats_path)
+        self.connection.close()
+
+
+def command_name(command):
+    for opcode in OPCODES:
+        if command.startswith(opcode.encode('ascii')):
+            return opcode
+    return command[:1].decode('ascii', 'replace')
+
+
+class CommandStat:
+    # Latency histogram: bucket i holds [2**(i/4), 2**((i+1)/4)) microseconds, i.e. ~19% wide bins
+    BUCKETS_PER_OCTAVE = 4
+    NUM_BUCKETS = 100
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.crc_failures = 0
+        self.mismatches = 0
+        self.timeouts = 0
+        self.retries = 0
+        # Smoothed latency and its mean deviation (RFC 6298 style) for adaptive timeouts
+        self.srtt = None
+        self.rttvar = 0.0
+        self.backoff = 1
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * self.NUM_BUCKETS
+
+    def record(self, elapsed, ok=False):
+        if ok:
+            if self.srtt is None:
+                self.srtt, self.rttvar = elapsed, elapsed / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - elapsed)
+                self.srtt = 0.875 * self.srtt + 0.125 * elapsed
+            self.backoff = 1
+        elif self.srtt is not None:
+            self.backoff = min(self.backoff * 2, 64)
+        self.calls += 1
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        us = elapsed * 1e6
+        bucket = int(math.log2(us) * self.BUCKETS_PER_OCTAVE) if us > 1 else 0
+        self.histogram[min(bucket, self.NUM_BUCKETS - 1)] += 1
+
+    def timeout(self, min_timeout, max_timeout):
+        if self.srtt is None:
+            return max_timeout
+        return min(max(self.srtt + 4 * self.rttvar, min_timeout) * self.backoff, max_timeout)
+
+    @classmethod
+    def bucket_upper(cls, bucket):
+        return 2 ** ((bucket + 1) / cls.BUCKETS_PER_OCTAVE) * 1e-6
+
+    def percentile(self, q):
+        if not self.calls:
+            return None
+        rank = q / 100 * self.calls
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if seen >= rank and count:
+                return min(self.bucket_upper(bucket), self.max_time)
+        return self.max_time
+
+    def summary(self):
+        return {
+            'calls': self.calls,
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'crc_failures': self.crc_failures,
+            'mismatches': self.mismatches,
+            'timeouts': self.timeouts,
+            'retries': self.retries,
+            'timeout_ms': self.timeout(Lens.min_timeout, Lens.max_timeout) * 1e3,
+            'latency_ms': {
+                'mean': self.total_time / self.calls * 1e3 if self.calls else None,
+                'p50': _ms(self.percentile(50)),
+                'p95': _ms(self.percentile(95)),
+                'p99': _ms(self.percentile(99)),
+                'max': self.max_time * 1e3,
+            },
+            'histogram_us': {'{:.0f}'.format(self.bucket_upper(i) * 1e6): count
+                             for i, count in enumerate(self.histogram) if count},
+        }
+
+
+class CommandStats:
+    """Per-opcode counters and latency histograms for Lens.send_command."""
+
+    def __init__(self):
+        self.by_opcode = {}
+        self._names = {}
+
+    def get(self, command):
+        # Cache on the raw command bytes; most commands repeat verbatim
+        name = self._names.get(command)
+        if name is None:
+            name = command_name(command)
+            if len(self._names) < 4096:
+                self._names[command] = name
+        stat = self.by_opcode.get(name)
+        if stat is None:
+            stat = self.by_opcode[name] = CommandStat(name)
+        return stat
+
+    def summary(self):
+        return {name: stat.summary() for name, stat in sorted(self.by_opcode.items())}
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1e3
 
 
 def crc_16(s):
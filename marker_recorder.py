@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Local recorder for the experiment's LSL marker stream.
+
+Run it next to the experiment on the same machine. It subscribes to the
+TuneTriggers outlet (MarkerStream from the older scripts) and writes every
+marker sample with its LSL timestamp and its receipt time on both clocks:
+
+    data/<pid>/<pid>_marker_recording.csv     one row per received marker
+    data/<pid>/<pid>_marker_recording.json    stream info, start/stop, report
+
+When the session ends (the outlet closes, Ctrl-C or --duration) the
+recording is aligned with the runner's own <pid>_triggers.csv for the same
+time span. Markers logged but never received count as lost, received ones
+missing from the log as unexpected. Two latencies are reported per marker:
+
+    delivery     push (sent_time in the trigger log) -> receipt by this inlet
+    push delay   event stamp (timestamp in the log)  -> push
+
+Tone-cued markers are stamped with the start of the tone and pushed after
+it, so only delivery counts towards the late markers. Both ends of it are
+wall-clock times on this machine; logs without sent_time (older sessions,
+stamped at the push) fall back to the LSL timestamp and have no push delay.
+
+    python marker_recorder.py P01
+    python marker_recorder.py P01 --report-only      # re-run the comparison
+"""
+
+import argparse
+import csv
+import difflib
+import json
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from epoching import load_triggers
+from online_average import MARKER_STREAM_NAMES
+from session import TIMESTAMP_FORMAT
+
+
+def resolve_marker_stream(timeout=30.0, local_only=True):
+    """StreamInfo of the first marker stream found, by name preference; only this host's unless local_only is off."""
+    from pylsl import resolve_byprop
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for name in MARKER_STREAM_NAMES:
+            for info in resolve_byprop("name", name, timeout=1.0):
+                if not local_only or info.hostname() == socket.gethostname():
+                    return info
+    raise Exception("No local marker stream ({}) found".format(", ".join(MARKER_STREAM_NAMES)))
+
+
+class MarkerRecorder:
+    """Writes every sample of a marker inlet to CSV with its LSL timestamp and receipt times."""
+
+    def __init__(self, info, path):
+        from pylsl import StreamInlet
+
+        # No recovery: a closed outlet ends the session instead of being waited for
+        self.inlet = StreamInlet(info, recover=False)
+        self.inlet.open_stream(timeout=10.0)
+        self.info = info
+        self.path = path
+        self.received = 0
+        self.start_wall = time.time()
+        self.stop_wall = None
+        with open(path, "w", newline="") as f:
+            csv.writer(f).writerow(["marker_code", "lsl_time", "receipt_lsl", "receipt_wall"])
+
+    def run(self, stop):
+        from pylsl import LostError, local_clock
+
+        with open(self.path, "a", newline="") as f:
+            writer = csv.writer(f)
+            try:
+                while not stop.is_set():
+                    sample, timestamp = self.inlet.pull_sample(timeout=0.2)
+                    if sample is None:
+                        continue
+                    receipt_lsl, receipt_wall = local_clock(), time.time()
+                    writer.writerow([int(sample[0]), f"{timestamp:.6f}", f"{receipt_lsl:.6f}", f"{receipt_wall:.6f}"])
+                    f.flush()
+                    self.received += 1
+            except LostError:
+                print("[INFO] Marker stream closed; session ended")
+        self.stop_wall = time.time()
+
+    def metadata(self):
+        return {
+            "stream": {"name": self.info.name(), "source_id": self.info.source_id(), "hostname": self.info.hostname()},
+            "start": self.start_wall,
+            "stop": self.stop_wall,
+            "received": self.received,
+        }
+
+
+def load_recording(path):
+    """(codes, lsl_times, receipt_lsl, receipt_wall) arrays."""
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    codes = np.array([int(row["marker_code"]) for row in rows], int)
+    columns = [np.array([float(row[name]) for row in rows]) for name in ("lsl_time", "receipt_lsl", "receipt_wall")]
+    return (codes, *columns)
+
+
+def load_sent_times(path):
+    """Push times (POSIX s) from the trigger log's sent_time column, or None for logs without it."""
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    if not rows or "sent_time" not in rows[0]:
+        return None
+    return np.array([datetime.strptime(row["sent_time"], TIMESTAMP_FORMAT).timestamp() for row in rows])
+
+
+def _distribution(seconds):
+    if not len(seconds):
+        return None
+    ms = np.asarray(seconds) * 1e3
+    return {"mean": float(ms.mean()), "p50": float(np.percentile(ms, 50)), "p95": float(np.percentile(ms, 95)),
+            "p99": float(np.percentile(ms, 99)), "max": float(ms.max())}
+
+
+def compare(recording_path, trigger_log_path, start=None, stop=None, late_ms=10.0):
+    """
+    Loss and latency report for a recording against the trigger log entries
+    between start and stop (POSIX s; default: the whole log). The two
+    sequences are aligned on their codes, so one lost marker does not shift
+    every later pairing.
+    """
+    codes, lsl_times, receipt_lsl, receipt_wall = load_recording(recording_path)
+    log_times, log_codes, log_names = load_triggers(trigger_log_path)
+    sent_times = load_sent_times(trigger_log_path)
+    in_span = np.ones(len(log_times), bool)
+    if start is not None:
+        in_span &= log_times >= start
+    if stop is not None:
+        in_span &= log_times <= stop
+    log_times, log_codes = log_times[in_span], log_codes[in_span].astype(int)
+    log_names = [name for name, keep in zip(log_names, in_span) if keep]
+    if sent_times is not None:
+        sent_times = sent_times[in_span]
+
+    matcher = difflib.SequenceMatcher(None, log_codes.tolist(), codes.tolist(), autojunk=False)
+    log_index, recording_index = [], []
+    for block in matcher.get_matching_blocks():
+        log_index += range(block.a, block.a + block.size)
+        recording_index += range(block.b, block.b + block.size)
+    log_index, recording_index = np.array(log_index, int), np.array(recording_index, int)
+    lost = np.setdiff1d(np.arange(len(log_codes)), log_index)
+    unexpected = np.setdiff1d(np.arange(len(codes)), recording_index)
+
+    if sent_times is not None:
+        # Stamps are back-dated to the event, so delivery runs from the push instead
+        delivery = receipt_wall[recording_index] - sent_times[log_index]
+        push_delay = sent_times[log_index] - log_times[log_index]
+    else:
+        delivery = (receipt_lsl - lsl_times)[recording_index]
+        push_delay = np.array([])
+    return {
+        "logged": len(log_codes),
+        "received": len(codes),
+        "lost": [{"code": int(log_codes[i]), "name": log_names[i],
+                  "time": datetime.fromtimestamp(log_times[i]).isoformat(sep=" ")} for i in lost],
+        "unexpected": [{"code": int(codes[i]), "lsl_time": float(lsl_times[i])} for i in unexpected],
+        "late": int((delivery * 1e3 > late_ms).sum()),
+        "late_ms": late_ms,
+        "delivery_ms": _distribution(delivery),
+        "push_delay_ms": _distribution(push_delay),
+    }
+
+
+def print_report(report):
+    print(f"[INFO] {report['received']} of {report['logged']} logged markers received, "
+          f"{len(report['lost'])} lost, {len(report['unexpected'])} unexpected, "
+          f"{report['late']} delivered later than {report['late_ms']:.0f} ms")
+    for name in ("delivery_ms", "push_delay_ms"):
+        if report[name] is not None:
+            print(f"[INFO] {name[:-3].replace('_', ' ')} (ms): " +
+                  ", ".join(f"{key} {value:.2f}" for key, value in report[name].items()))
+    for marker in report["lost"]:
+        print(f"[WARNING] Lost marker {marker['code']} ({marker['name']}) at {marker['time']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Record the experiment's marker stream and check it against the trigger log.")
+    parser.add_argument("participant")
+    parser.add_argument("--data", default="data")
+    parser.add_argument("--duration", type=float, default=0.0,
+                        help="stop after this many seconds (0 = until the stream closes)")
+    parser.add_argument("--late-ms", type=float, default=10.0, help="delivery latency counted as late")
+    parser.add_argument("--any-host", action="store_true", help="also accept marker streams from other machines")
+    parser.add_argument("--report-only", action="store_true", help="compare an existing recording again")
+    args = parser.parse_args()
+
+    folder = os.path.join(args.data, args.participant)
+    os.makedirs(folder, exist_ok=True)
+    recording_path = os.path.join(folder, f"{args.participant}_marker_recording.csv")
+    metadata_path = os.path.join(folder, f"{args.participant}_marker_recording.json")
+    trigger_log_path = os.path.join(folder, f"{args.participant}_triggers.csv")
+
+    if args.report_only:
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+    else:
+        print("[INFO] Waiting for the marker stream...")
+        recorder = MarkerRecorder(resolve_marker_stream(local_only=not args.any_host), recording_path)
+        print(f"[INFO] Recording {recorder.info.name()} to {recording_path}")
+        stop = threading.Event()
+        worker = threading.Thread(target=recorder.run, args=(stop,), daemon=True)
+        worker.start()
+        try:
+            deadline = time.monotonic() + args.duration if args.duration else None
+            while worker.is_alive() and (deadline is None or time.monotonic() < deadline):
+                time.sleep(0.2)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop.set()
+            worker.join(timeout=1.0)
+        metadata = recorder.metadata()
+
+    # The runner writes its log line just after the push, so the last marker may be logged after the stop
+    metadata["report"] = compare(recording_path, trigger_log_path, metadata["start"],
+                                 (metadata["stop"] or time.time()) + 1.0, args.late_ms)
+    with open(metadata_path, "w") as f:
+        json.dump(metadata, f, indent=2)
+    print_report(metadata["report"])
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Closed-loop neurofeedback: an fNIRS feature drives lens blur.
+
+Every incoming chunk of the NIRS stream is low-pass filtered per channel
+(one-pole IIR) and fed to a sliding least-squares slope kept with running
+sums, so each sample costs O(channels) whatever the window length. The
+feature, the mean slope over the selected channels, maps linearly to a
+diopter target inside the lens's safe range and is written through
+lib.Lens (or a lens daemon / emulator stand-in).
+
+Latency is measured from the moment a chunk is pulled from the inlet to the
+return of the last lens write and recorded in a lib.CommandStat histogram.
+A chunk whose newest sample is already older than the budget when it is
+pulled is not acted on, and a write that finishes over budget counts as a
+miss.
+
+    python neurofeedback.py --participant P01 --channels 0 1 2 3 --budget-ms 50
+    python neurofeedback.py --replay signal_store/P01 --emulate   # no hardware
+"""
+
+import argparse
+import csv
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+from lib import CommandStat
+from lens_profiles import profile_for
+
+
+class LowPass:
+    """One-pole IIR low-pass per channel."""
+
+    def __init__(self, cutoff, sfreq):
+        self.alpha = 1 - math.exp(-2 * math.pi * cutoff / sfreq)
+        self.state = None
+
+    def process(self, samples):
+        out = np.empty_like(samples)
+        state = samples[0].copy() if self.state is None else self.state
+        for i, x in enumerate(samples):
+            state = state + self.alpha * (x - state)
+            out[i] = state
+        self.state = state
+        return out
+
+
+class SlidingSlope:
+    """
+    Least-squares slope (per sample) of the last 'window' samples per channel,
+    updated in O(1) with S1 = sum(y_k) and S2 = sum(k*y_k), k = 0 oldest.
+    """
+
+    def __init__(self, window, n_channels):
+        self.window = window
+        self.buffer = np.zeros((window, n_channels))
+        self.count = 0
+        self.s1 = np.zeros(n_channels)
+        self.s2 = np.zeros(n_channels)
+        k = np.arange(window)
+        self.denominator = window * (k ** 2).sum() - k.sum() ** 2
+        self.k_sum = k.sum()
+
+    def push(self, y):
+        slot = self.count % self.window
+        if self.count >= self.window:
+            oldest = self.buffer[slot]
+            self.s2 += (self.window - 1) * y - (self.s1 - oldest)
+            self.s1 += y - oldest
+        else:
+            self.s2 += self.count * y
+            self.s1 += y
+        self.buffer[slot] = y
+        self.count += 1
+
+    def ready(self):
+        return self.count >= self.window
+
+    def slope(self):
+        return (self.window * self.s2 - self.k_sum * self.s1) / self.denominator
+
+
+class FeedbackMapping:
+    """Linear feature-to-diopter map, clamped to a range, with a deadband against jitter writes."""
+
+    def __init__(self, base, gain, diopter_range, deadband=0.05):
+        self.base = base
+        self.gain = gain
+        self.diopter_range = diopter_range
+        self.deadband = deadband
+
+    def target(self, feature):
+        return min(max(self.base + self.gain * feature, self.diopter_range[0]), self.diopter_range[1])
+
+
+class NeurofeedbackLoop:
+    def __init__(self, lenses, sfreq, channels, mapping, window_s=5.0, cutoff=0.5, budget=0.05,
+                 log_path=None):
+        self.lenses = lenses
+        self.sfreq = sfreq
+        self.channels = list(channels)
+        self.mapping = mapping
+        self.budget = budget
+        self.low_pass = LowPass(cutoff, sfreq)
+        self.slope = SlidingSlope(int(round(window_s * sfreq)), len(self.channels))
+        self.latency = CommandStat("sample-to-lens")
+        self.stale_chunks = 0
+        self.budget_misses = 0
+        self.commanded = None
+        self.log_path = log_path
+        if log_path is not None:
+            with open(log_path, "w", newline="") as f:
+                csv.writer(f).writerow(["sample_time", "feature", "diopter", "latency_ms"])
+
+    def process(self, samples, times, arrival, clock_offset=None):
+        """
+        Handles one chunk pulled at perf_counter() time 'arrival'. times are the
+        chunk's LSL timestamps; with clock_offset (the inlet's time correction)
+        chunks older than the budget are not acted on. Returns the diopter
+        written, or None.
+        """
+        samples = np.asarray(samples, float)[:, self.channels]
+        for y in self.low_pass.process(samples):
+            self.slope.push(y)
+        if not self.slope.ready():
+            return None
+        feature = float(self.slope.slope().mean() * self.sfreq)
+        target = self.mapping.target(feature)
+        if self.commanded is not None and abs(target - self.commanded) < self.mapping.deadband:
+            return None
+        if clock_offset is not None:
+            from pylsl import local_clock
+            if local_clock() - (times[-1] + clock_offset) > self.budget:
+                # The data is already too old to act on; wait for fresher samples
+                self.stale_chunks += 1
+                return None
+        for lens in self.lenses:
+            lens.set_diopter(target)
+        self.commanded = target
+        elapsed = time.perf_counter() - arrival
+        self.latency.record(elapsed, ok=elapsed <= self.budget)
+        if elapsed > self.budget:
+            self.budget_misses += 1
+        if self.log_path is not None:
+            with open(self.log_path, "a", newline="") as f:
+                csv.writer(f).writerow([times[-1], feature, target, elapsed * 1e3])
+        return target
+
+    def run(self, inlet, stop):
+        while not stop.is_set():
+            samples, times = inlet.pull_chunk(timeout=0.02)
+            if times:
+                self.process(samples, times, time.perf_counter(), clock_offset=inlet.time_correction())
+
+    def summary(self):
+        return {
+            "writes": self.latency.calls,
+            "budget_ms": self.budget * 1e3,
+            "budget_misses": self.budget_misses,
+            "stale_chunks": self.stale_chunks,
+            "latency_ms": {q: _ms(self.latency.percentile(q)) for q in (50, 95, 99)},
+            "max_latency_ms": self.latency.max_time * 1e3,
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1e3
+
+
+def replay_outlet(store_path, stop, speed=1.0, chunk_size=4):
+    """Publishes a signal_store recording as a live NIRS stream at its recorded rate (times speed)."""
+    from pylsl import StreamInfo, StreamOutlet, local_clock
+    from signal_store import SignalStore
+
+    store = SignalStore(store_path)
+    outlet = StreamOutlet(StreamInfo("ReplayNIRS", "NIRS", len(store.channels), store.sfreq, "float32",
+                                     "replay_" + os.path.basename(store_path)))
+    start = local_clock()
+    for first, _, data in store.iter_chunks(chunk_size):
+        if stop.is_set():
+            break
+        delay = start + first / store.sfreq / speed - local_clock()
+        if delay > 0:
+            time.sleep(delay)
+        outlet.push_chunk(np.asarray(data).tolist())
+
+
+def open_lenses(emulate=0):
+    """Lenses from a running daemon, else the serial ports, else (emulate > 0) pty emulators."""
+    import lens_daemon
+    from lib import Lens
+
+    if emulate:
+        from lens_emulator import LensEmulator
+        emulators = [LensEmulator(serial_number=f"CBAA{i:04d}", settle_tau=0.03).start() for i in range(emulate)]
+        lenses = [Lens(emu.port) for emu in emulators]
+    else:
+        emulators = []
+        client = lens_daemon.connect()
+        if client is not None and client.lenses():
+            lenses = client.lenses()
+        else:
+            import serial.tools.list_ports
+            lenses = [Lens(p.name if os.name == "nt" else p.device) for p in serial.tools.list_ports.comports()]
+    for lens in lenses:
+        lens.to_focal_power_mode()
+    return lenses, emulators
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive lens blur from a real-time fNIRS feature.")
+    parser.add_argument("--participant", help="log feedback updates to data/<pid>/<pid>_neurofeedback.csv")
+    parser.add_argument("--channels", type=int, nargs="+", default=[0], help="stream channel indices to average")
+    parser.add_argument("--window", type=float, default=5.0, help="slope window (s)")
+    parser.add_argument("--cutoff", type=float, default=0.5, help="low-pass cutoff (Hz)")
+    parser.add_argument("--base", type=float, default=0.0, help="diopter at zero slope")
+    parser.add_argument("--gain", type=float, default=1.0, help="diopters per (signal unit / s)")
+    parser.add_argument("--deadband", type=float, default=0.05, help="minimum diopter change worth a write")
+    parser.add_argument("--budget-ms", type=float, default=50.0, help="sample-to-lens latency budget")
+    parser.add_argument("--duration", type=float, default=0.0, help="stop after this many seconds (0 = Ctrl-C)")
+    parser.add_argument("--replay", help="publish this signal_store recording as the NIRS stream")
+    parser.add_argument("--emulate", action="store_true", help="drive two pty emulators instead of lenses")
+    args = parser.parse_args(argv)
+
+    from pylsl import StreamInlet, resolve_byprop
+
+    stop = threading.Event()
+    if args.replay:
+        threading.Thread(target=replay_outlet, args=(args.replay, stop), daemon=True).start()
+    streams = resolve_byprop("type", "NIRS", timeout=10.0)
+    if not streams:
+        raise Exception("No NIRS stream found on the network")
+    inlet = StreamInlet(streams[0], max_chunklen=1)
+    info = inlet.info()
+
+    lenses, emulators = open_lenses(2 if args.emulate else 0)
+    profiles = [profile_for(getattr(lens, "lens_serial", None)) for lens in lenses]
+    # Only the focal-power range every lens can reach safely
+    diopter_range = (max(p.safe_range[0] for p in profiles), min(p.safe_range[1] for p in profiles))
+    log_path = None
+    if args.participant:
+        folder = os.path.join("data", args.participant)
+        os.makedirs(folder, exist_ok=True)
+        log_path = os.path.join(folder, f"{args.participant}_neurofeedback.csv")
+
+    loop = NeurofeedbackLoop(lenses, info.nominal_srate(), args.channels,
+                             FeedbackMapping(args.base, args.gain, diopter_range, args.deadband),
+                             args.window, args.cutoff, args.budget_ms / 1e3, log_path)
+    worker = threading.Thread(target=loop.run, args=(inlet, stop), daemon=True)
+    worker.start()
+    try:
+        if args.duration:
+            time.sleep(args.duration)
+        else:
+            while worker.is_alive():
+                time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        worker.join(timeout=1.0)
+        print(loop.summary())
+        for lens in lenses:
+            lens.lens_close()
+        for emu in emulators:
+            emu.stop()
+
+
+if __name__ == "__main__":
+    main()
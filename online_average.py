@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Online per-condition block averages during acquisition.
+
+Subscribes to the fNIRS data stream and the experiment's marker stream
+(TuneTriggers, or MarkerStream from the older scripts) over LSL. Each Active
+Onset is cut into an epoch once its last sample has arrived, baseline-corrected
+and folded into a running mean and variance per condition with Welford's
+update, so the cost per block is constant however long the session runs.
+The averages are redrawn a few times per second from a decimated copy.
+
+Both streams carry LSL timestamps, so epochs line up without touching the
+trigger log. With the participant's blocks.csv the codes decode to (task,
+blur); without it they fall back to (task, blur index) from marker_base.
+
+    python online_average.py --participant P01
+    python online_average.py --synthetic          # against a simulated outlet
+"""
+
+import argparse
+import os
+import random
+import threading
+import time
+
+import numpy as np
+
+from epoching import MarkerCodebook
+from session import load_blocks, marker_base
+
+MARKER_STREAM_NAMES = ("TuneTriggers", "MarkerStream")
+
+
+class WelfordAverager:
+    """Running mean and variance of (channels x time) epochs per condition."""
+
+    def __init__(self):
+        self.counts = {}
+        self.means = {}
+        self.m2 = {}
+        # Epochs arrive on the acquisition thread while the plot reads snapshots
+        self.lock = threading.Lock()
+
+    def add(self, condition, epoch):
+        epoch = np.asarray(epoch, float)
+        with self.lock:
+            count = self.counts.get(condition, 0) + 1
+            if count == 1:
+                self.means[condition] = epoch.copy()
+                self.m2[condition] = np.zeros_like(epoch)
+            else:
+                delta = epoch - self.means[condition]
+                self.means[condition] += delta / count
+                self.m2[condition] += delta * (epoch - self.means[condition])
+            self.counts[condition] = count
+
+    def mean(self, condition):
+        return self.means[condition]
+
+    def variance(self, condition):
+        count = self.counts[condition]
+        return self.m2[condition] / (count - 1) if count > 1 else np.zeros_like(self.m2[condition])
+
+    def conditions(self):
+        return sorted(self.counts, key=str)
+
+    def snapshot(self, decimate=1):
+        """{condition: (count, mean, variance)} copied under the lock, every decimate-th sample."""
+        with self.lock:
+            return {condition: (self.counts[condition], self.mean(condition)[:, ::decimate].copy(),
+                                self.variance(condition)[:, ::decimate]) for condition in self.conditions()}
+
+
+def live_decoder(codebook=None):
+    """decode(code) -> condition or None, for Active Onset codes only."""
+    bases = {base: task for task, base in marker_base.items()}
+
+    def decode(code):
+        if codebook is not None:
+            task, blur, phase = codebook.decode(code)
+            return (task, blur) if phase == "active" else None
+        task = bases.get(code - code % 10)
+        return (task, code % 10) if task is not None and code % 10 < 5 else None
+    return decode
+
+
+class OnlineEpocher:
+    """
+    Buffers incoming samples and turns each Active Onset into an epoch for the
+    averager once the window [onset + tmin, onset + tmax] has been received.
+    """
+
+    def __init__(self, averager, decode, sfreq, n_channels, tmin=-5.0, tmax=25.0, baseline=(-5.0, 0.0),
+                 buffer_seconds=120.0):
+        self.averager = averager
+        self.decode = decode
+        self.tmin, self.tmax = tmin, tmax
+        self.length = int(round((tmax - tmin) * sfreq)) + 1
+        self.baseline = (int(round((baseline[0] - tmin) * sfreq)), int(round((baseline[1] - tmin) * sfreq)))
+        # Linear buffer of twice the kept span; the newer half moves to the front when it fills up
+        self.capacity = int(buffer_seconds * sfreq)
+        self.times = np.empty(2 * self.capacity)
+        self.data = np.empty((2 * self.capacity, n_channels))
+        self.size = 0
+        self.pending = []
+        self.dropped = 0
+
+    def push_samples(self, times, data):
+        times = np.asarray(times, float)
+        data = np.asarray(data, float)
+        if self.size + len(times) > len(self.times):
+            keep = min(self.size, max(self.capacity - len(times), 0))
+            self.times[:keep] = self.times[self.size - keep:self.size]
+            self.data[:keep] = self.data[self.size - keep:self.size]
+            self.size = keep
+            times, data = times[-len(self.times):], data[-len(self.times):]
+        self.times[self.size:self.size + len(times)] = times
+        self.data[self.size:self.size + len(times)] = data
+        self.size += len(times)
+        self._complete()
+
+    def push_marker(self, timestamp, code):
+        condition = self.decode(int(code))
+        if condition is not None:
+            self.pending.append((timestamp, condition))
+            self._complete()
+
+    def _complete(self):
+        if not self.pending or not self.size:
+            return
+        latest = self.times[self.size - 1]
+        while self.pending and self.pending[0][0] + self.tmax <= latest:
+            onset, condition = self.pending.pop(0)
+            start = int(np.searchsorted(self.times[:self.size], onset + self.tmin))
+            if (start == 0 and self.times[0] > onset + self.tmin) or start + self.length > self.size:
+                self.dropped += 1
+                continue
+            epoch = self.data[start:start + self.length].T
+            b0, b1 = self.baseline
+            self.averager.add(condition, epoch - epoch[:, b0:b1].mean(axis=1, keepdims=True))
+
+
+def resolve_inlets(timeout=10.0):
+    from pylsl import StreamInlet, resolve_byprop
+
+    data_streams = resolve_byprop("type", "NIRS", timeout=timeout)
+    if not data_streams:
+        raise Exception("No NIRS stream found on the network")
+    for name in MARKER_STREAM_NAMES:
+        marker_streams = resolve_byprop("name", name, timeout=timeout)
+        if marker_streams:
+            break
+    else:
+        raise Exception("No marker stream ({}) found".format(", ".join(MARKER_STREAM_NAMES)))
+    return StreamInlet(data_streams[0]), StreamInlet(marker_streams[0])
+
+
+def acquire(data_inlet, marker_inlet, epocher, stop):
+    """Pulls both inlets into the epocher until stop is set."""
+    while not stop.is_set():
+        samples, times = data_inlet.pull_chunk(timeout=0.05)
+        markers, marker_times = marker_inlet.pull_chunk(timeout=0.0)
+        # Markers first: their epochs may complete with this chunk of samples
+        for marker, timestamp in zip(markers, marker_times):
+            epocher.push_marker(timestamp + marker_inlet.time_correction(), marker[0])
+        if times:
+            epocher.push_samples(np.asarray(times) + data_inlet.time_correction(), samples)
+
+
+def plot_live(averager, epocher, sfreq, channel=None, plot_interval=0.5, decimate=5):
+    """Redraws the mean +/- standard error per condition every plot_interval s (blocks until the window closes)."""
+    import matplotlib.pyplot as plt
+
+    t = (epocher.tmin + np.arange(epocher.length) / sfreq)[::decimate]
+    fig, ax = plt.subplots()
+    while plt.fignum_exists(fig.number):
+        ax.clear()
+        snapshot = averager.snapshot(decimate)
+        for condition, (count, mean, variance) in snapshot.items():
+            sem = np.sqrt(variance / count)
+            mean, sem = (mean.mean(axis=0), sem.mean(axis=0)) if channel is None else (mean[channel], sem[channel])
+            line, = ax.plot(t, mean, label=f"{condition[0]} {condition[1]} (n={count})")
+            ax.fill_between(t, mean - sem, mean + sem, color=line.get_color(), alpha=0.2)
+        ax.axvline(0, color="grey", linewidth=0.5)
+        ax.set_xlabel("Time from Active Onset (s)")
+        ax.set_title("Channel {}".format(channel) if channel is not None else "Mean over channels")
+        if snapshot:
+            ax.legend(fontsize="small", loc="upper right")
+        plt.pause(plot_interval)
+
+
+def run_synthetic(stop, n_channels=16, sfreq=10.0, time_scale=1.0, seed=None):
+    """
+    Publishes a simulated NIRS stream and a TuneTriggers marker stream that
+    runs a full block plan. During each active period the signal rises towards
+    1 + blur with a 3 s time constant and decays again afterwards.
+    time_scale < 1 compresses the session for quick checks.
+    """
+    from pylsl import StreamInfo, StreamOutlet, local_clock
+    from session import generate_blocks, get_blur_levels
+
+    rng = random.Random(seed)
+    noise = np.random.default_rng(seed)
+    data_outlet = StreamOutlet(StreamInfo("SyntheticNIRS", "NIRS", n_channels, sfreq, "float32", "synthetic_nirs"))
+    marker_outlet = StreamOutlet(StreamInfo("TuneTriggers", "Markers", 1, 0, "int32", "synthetic_markers"))
+    blocks = generate_blocks(*get_blur_levels(0.0, False), shuffle=rng.shuffle)
+
+    # (time, marker code, response level from then on)
+    events = []
+    t = local_clock() + 2.0
+    for block in blocks:
+        duration = 20.0 if block["Task"] == "Visuomotor" else 10.0
+        events.append((t, block["Active Onset"], 1.0 + block["Blur(D)"]))
+        events.append((t + duration * time_scale, block["Task Offset"], 0.0))
+        t += (duration + 3.0 + rng.uniform(5, 10)) * time_scale
+
+    level, response = 0.0, 0.0
+    step = 1 / sfreq * time_scale
+    next_sample = local_clock()
+    while not stop.is_set() and events:
+        now = local_clock()
+        while next_sample <= now:
+            while events and events[0][0] <= next_sample:
+                onset, code, level = events.pop(0)
+                marker_outlet.push_sample([code], onset)
+            response += (level - response) * step / (3.0 * time_scale)
+            data_outlet.push_sample((response + noise.normal(0, 0.5, n_channels)).tolist(), next_sample)
+            next_sample += step
+        time.sleep(0.005)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Live per-condition block averages from the LSL streams.")
+    parser.add_argument("--participant", help="use data/<pid>/<pid>_blocks.csv to decode blur values")
+    parser.add_argument("--sfreq", type=float, help="data stream rate (default: the stream's nominal rate)")
+    parser.add_argument("--channel", type=int, help="plot one channel instead of the channel mean")
+    parser.add_argument("--plot-interval", type=float, default=0.5)
+    parser.add_argument("--decimate", type=int, default=5)
+    parser.add_argument("--synthetic", action="store_true", help="also run a simulated outlet in this process")
+    args = parser.parse_args(argv)
+
+    stop = threading.Event()
+    if args.synthetic:
+        threading.Thread(target=run_synthetic, args=(stop,), daemon=True).start()
+
+    codebook = None
+    if args.participant:
+        plan_path = os.path.join("data", args.participant, f"{args.participant}_blocks.csv")
+        if os.path.isfile(plan_path):
+            codebook = MarkerCodebook(load_blocks(plan_path))
+
+    data_inlet, marker_inlet = resolve_inlets()
+    info = data_inlet.info()
+    sfreq = args.sfreq or info.nominal_srate()
+    averager = WelfordAverager()
+    epocher = OnlineEpocher(averager, live_decoder(codebook), sfreq, info.channel_count())
+    threading.Thread(target=acquire, args=(data_inlet, marker_inlet, epocher, stop), daemon=True).start()
+    try:
+        plot_live(averager, epocher, sfreq, args.channel, args.plot_interval, args.decimate)
+    finally:
+        stop.set()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+"""
+Session helpers shared by the experiment scripts: block randomization,
+CSV logging of trials, power changes and markers, and the block runner.
+
+Nothing in here opens a window or a serial port, so the functions can be
+imported by tools (benchmarks, analysis) without starting an experiment.
+"""
+
+import csv
+import os
+import random
+import time
+from collections import Counter
+from datetime import datetime
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# ------------------ Experiment Parameters ------------------
+task_variants = ["Visuomotor", "Motor-only", "Visual-only", "Baseline"]
+
+marker_base = {"Visuomotor": 30, "Motor-only": 40, "Visual-only": 50, "Baseline": 60}
+# Length of the cue tones (s); logs without sent_time stamped task markers at the end of them
+CUE_TONE_S = 0.3
+# Switch the lenses for the next block at the end of each post-task rest instead of at the next block's start
+PREPOSITION_LENSES = True
+# Switch phase before each block (s): none when pre-positioned, otherwise up to the 1 s worst-case settle wait
+SWITCH_PHASE_S = 0.0 if PREPOSITION_LENSES else 1.0
+task_descriptions = {
+    "Visuomotor": "Move the bead from left to right \n 1 grey 2 white repeat.",
+    "Motor-only": "Pick the bead from left and drop on the right board",
+    "Visual-only": "Watch the board from left to right",
+    "Baseline": "+"
+}
+
+
+def get_blur_levels(prescription, is_practice):
+    """Returns (blur_levels_vm_vo, blur_levels_motor, repeats) for a run type."""
+    if is_practice:
+        blur_levels_vm_vo = [x + prescription for x in [0, 0.5]]
+        blur_levels_motor = [x + prescription for x in [0]]
+        repeats = 1
+    else:
+        blur_levels_vm_vo = [x + prescription for x in [0, 0.5, 1.0, 1.5, 2.0]]
+        blur_levels_motor = [x + prescription for x in [0]]
+        repeats = 3
+    return blur_levels_vm_vo, blur_levels_motor, repeats
+
+
+def generate_blocks(blur_levels_vm_vo, blur_levels_motor, repeats, shuffle=random.shuffle):
+    blocks = []
+    trial_counter = 1
+    for r in range(repeats):
+        rep_blocks = []
+        rep_blocks += [("Visuomotor", b) for b in blur_levels_vm_vo]
+        rep_blocks += [("Motor-only", b) for b in blur_levels_motor]
+        rep_blocks += [("Visual-only", b) for b in blur_levels_vm_vo]
+        rep_blocks += [("Baseline", b) for b in blur_levels_vm_vo]
+        shuffle(rep_blocks)
+        for task, blur in rep_blocks:
+            blur_idx = 0 if task == "Motor-only" else blur_levels_vm_vo.index(blur)
+            active_marker = marker_base[task] + blur_idx
+            blocks.append({
+                "Trial": trial_counter,
+                "Task": task,
+                "Blur(D)": blur,
+                "Lens Switch": 10,
+                "Prep Cue": 20,
+                "Active Onset": active_marker,
+                "Task Offset": active_marker + 5,
+                "Post-task": 70,
+                "Baseline": 80
+            })
+            trial_counter += 1
+    return blocks
+
+
+def save_blocks(participant_id, blocks, folder=None):
+    folder = folder or get_participant_folder(participant_id)
+    file_path = os.path.join(folder, f"{participant_id}_blocks.csv")
+    with open(file_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(blocks[0].keys()))
+        writer.writeheader()
+        writer.writerows(blocks)
+    return file_path
+
+
+def load_blocks(path):
+    """Block plan rows from a <pid>_blocks.csv with numeric fields converted."""
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        for key, value in row.items():
+            if key == "Blur(D)":
+                row[key] = float(value)
+            elif key != "Task":
+                row[key] = int(value)
+    return rows
+
+
+# ------------------ Optimized Schedules ------------------
+# design_optimizer.py writes <run id>_blocks.csv and <run id>_post_task_waits.csv here ahead of a session
+SCHEDULE_DIR = "schedules"
+
+
+def run_id(participant, is_practice):
+    """Id of one run as the experiment names its files: <participant>_Main or <participant>_Practice."""
+    return f"{participant}_{'Practice' if is_practice else 'Main'}"
+
+
+def load_schedule(participant_id, directory=SCHEDULE_DIR):
+    """(blocks, post_task_waits) prepared for the run participant_id, or None when there is no schedule."""
+    blocks_path = os.path.join(directory, f"{participant_id}_blocks.csv")
+    waits_path = os.path.join(directory, f"{participant_id}_post_task_waits.csv")
+    if not (os.path.isfile(blocks_path) and os.path.isfile(waits_path)):
+        print(f"[WARNING] No optimized schedule for {participant_id} ({blocks_path} and {waits_path}); "
+              f"blocks will be shuffled")
+        return None
+    with open(waits_path, newline='') as f:
+        waits = [float(row["post_task_wait"]) for row in csv.DictReader(f)]
+    return load_blocks(blocks_path), waits
+
+
+def schedule_mismatches(blocks, waits, blur_levels_vm_vo, blur_levels_motor, repeats):
+    """
+    Ways a loaded schedule differs from the block set get_blur_levels gives
+    for this run (its prescription and practice/main): empty when it matches.
+    """
+    expected = generate_blocks(blur_levels_vm_vo, blur_levels_motor, repeats, shuffle=lambda blocks: None)
+
+    def conditions(rows):
+        return Counter((row["Task"], round(float(row["Blur(D)"]), 3), int(row["Active Onset"])) for row in rows)
+
+    problems = []
+    if conditions(blocks) != conditions(expected):
+        found = sorted({float(block["Blur(D)"]) for block in blocks})
+        wanted = sorted(set(blur_levels_vm_vo) | set(blur_levels_motor))
+        problems.append(f"{len(blocks)} blocks at blur {found} D, expected {len(expected)} blocks at {wanted} D")
+    if len(waits) != len(blocks):
+        problems.append(f"{len(waits)} post-task waits for {len(blocks)} blocks")
+    return problems
+
+
+# ------------------ Logging ------------------
+def get_participant_folder(participant_id):
+    folder = os.path.join("data", participant_id)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def get_trial_file_path(participant_id):
+    return os.path.join(get_participant_folder(participant_id), f"{participant_id}_trials.csv")
+
+
+def log_trial(participant_id, trial_number, condition, right_power, left_power, start_time, end_time):
+    file_path = get_trial_file_path(participant_id)
+    file_exists = os.path.isfile(file_path)
+    with open(file_path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if not file_exists:
+            writer.writerow(["participant", "trial", "condition", "right_power", "left_power", "start_time", "end_time"])
+        writer.writerow([
+            participant_id,
+            trial_number,
+            condition,
+            right_power,
+            left_power,
+            start_time.strftime(TIMESTAMP_FORMAT),
+            end_time.strftime(TIMESTAMP_FORMAT)
+        ])
+
+
+def get_save_path(participant_id, condition, trial_number):
+    base_dir = "data"
+    participant_dir = os.path.join(base_dir, participant_id)
+    condition_dir = os.path.join(participant_dir, condition.replace(" ", ""))
+    os.makedirs(condition_dir, exist_ok=True)
+    filename = f"trial_{trial_number}.csv"
+    return os.path.join(condition_dir, filename)
+
+
+def log_power_change(participant_id, trial_number, condition, right_power, left_power, save=True):
+    if condition == "Testing lenses" or not save:
+        return
+    file_path = get_save_path(participant_id, condition, trial_number)
+    timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+    file_exists = os.path.isfile(file_path)
+    with open(file_path, 'a', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        if not file_exists:
+            writer.writerow(["timestamp","participant","trial","condition","right_power","left_power"])
+        writer.writerow([timestamp, participant_id, trial_number, condition, right_power, left_power])
+
+
+def log_staircase_trial(participant_id, trial_number, step, blur, response, selection_time, threshold, slope):
+    """
+    Appends one adaptive-blur staircase step to data/<pid>/<pid>_adaptive_blur.csv
+    with the posterior estimate after it, so the last row of a run holds its
+    final threshold and slope.
+    """
+    file_path = os.path.join(get_participant_folder(participant_id), f"{participant_id}_adaptive_blur.csv")
+    timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+    file_exists = os.path.isfile(file_path)
+    with open(file_path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if not file_exists:
+            writer.writerow(["timestamp", "participant", "trial", "step", "blur", "response", "selection_ms",
+                             "threshold", "slope"])
+        writer.writerow([timestamp, participant_id, trial_number, step, f"{blur:.4f}", int(response),
+                         f"{selection_time * 1000:.3f}", f"{threshold:.4f}", f"{slope:.4f}"])
+
+
+def marker_names(max_blur_levels=5):
+    """
+    Stable code -> name map of every marker BlockRunner can send; blur levels
+    are indices into the plan. The stream description and the trigger log both
+    take their names from it (see marker_name).
+    """
+    names = {5: "Lens Command", 10: "Lens Switch", 20: "Prep Cue"}
+    for task, base in marker_base.items():
+        for level in range(max_blur_levels):
+            names[base + level] = f"Active Onset - {task} blur level {level}"
+            names[base + 5 + level] = f"Task Offset - {task} blur level {level}"
+    names.update({70: "Post-task", 80: "Baseline", 99: "Block Complete"})
+    return names
+
+
+MARKER_NAMES = marker_names()
+
+
+def marker_name(code, blur=None):
+    """Name logged with a marker: the one in the stream description, with the block's blur (D) for task markers."""
+    name = MARKER_NAMES.get(int(code), str(code))
+    return name if blur is None else f"{name} ({blur}D)"
+
+
+def describe_markers(info, names=None):
+    """Adds the code -> name map to an LSL StreamInfo as <markers><marker><code/><name/></marker>...</markers>."""
+    markers = info.desc().append_child("markers")
+    for code, name in sorted((names or marker_names()).items()):
+        marker = markers.append_child("marker")
+        marker.append_child_value("code", str(code))
+        marker.append_child_value("name", name)
+    return info
+
+
+class MarkerSender:
+    """
+    Pushes marker codes to an LSL outlet and appends them to <pid>_triggers.csv.
+
+    A marker is stamped with the time of the event it marks when one is given
+    (on clock, the LSL clock by default), otherwise with the time of the call.
+    The trigger log gets the same time on the wall clock, and the wall time of
+    the push itself as sent_time (logs started before that column existed
+    keep their three columns). Markers of one event go out together with
+    send_many, as a single chunk.
+    """
+
+    def __init__(self, outlet, trigger_log_path, verbose=True, clock=None):
+        self.outlet = outlet
+        self.trigger_log_path = trigger_log_path
+        self.verbose = verbose
+        if clock is None:
+            from pylsl import local_clock as clock
+        self.clock = clock
+        if not os.path.exists(trigger_log_path):
+            with open(trigger_log_path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(["timestamp", "marker_code", "marker_name", "sent_time"])
+        with open(trigger_log_path, newline='') as f:
+            self.log_sent_time = "sent_time" in next(csv.reader(f), [])
+
+    def send(self, code, name=None, timestamp=None):
+        self.send_many([(code, name)], timestamp)
+
+    def send_many(self, markers, timestamp=None):
+        """Sends (code, name) pairs that belong to one event, all stamped with its timestamp."""
+        now = self.clock()
+        if timestamp is None:
+            timestamp = now
+
+        # Send to LSL
+        if len(markers) == 1:
+            self.outlet.push_sample([markers[0][0]], timestamp)
+        else:
+            self.outlet.push_chunk([[code] for code, _ in markers], timestamp)
+
+        # Same instant on the wall clock
+        sent = time.time()
+        event_time = datetime.fromtimestamp(sent - (now - timestamp)).strftime(TIMESTAMP_FORMAT)
+        sent_time = datetime.fromtimestamp(sent).strftime(TIMESTAMP_FORMAT)
+
+        # Print to console
+        if self.verbose:
+            for code, name in markers:
+                if name:
+                    print(f"[LSL] Marker sent: {code} ({name}) at {event_time}")
+                else:
+                    print(f"[LSL] Marker sent: {code} at {event_time}")
+
+        # Save to CSV
+        with open(self.trigger_log_path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            for code, name in markers:
+                row = [event_time, code, name if name else ""]
+                writer.writerow(row + [sent_time] if self.log_sent_time else row)
+
+
+# ------------------ Block Runner ------------------
+class LabelDisplay:
+    """Shows instruction text on a (CustomTkinter) label and refreshes its root window."""
+
+    def __init__(self, root, label):
+        self.root = root
+        self.label = label
+
+    def show(self, text, font=None):
+        if font is None:
+            self.label.configure(text=text)
+        else:
+            self.label.configure(text=text, font=font)
+        self.root.update()
+
+
+class BlockRunner:
+    """
+    Runs one block: lens switch -> prep cue -> active task -> post-task wait.
+    Display, tone playback, sleeping and the post-task jitter are injected so
+    the same sequence runs with the real GUI or headless (e.g. zero sleeps).
+    settle_wait(previous, target) gives the stabilization wait after a lens
+    switch (e.g. lens_profiles.SwitchTimer.wait); previous is None before the
+    first switch.
+
+    With preposition=True and the next block passed to run_block, the lenses
+    are switched to the next blur level at the end of this block's post-task
+    rest, so the lens has settled when the next block starts. The next block's
+    Lens Switch marker goes out at that moment and its switch phase is skipped.
+
+    Markers carry the time of their event on the marker clock: the lens
+    command, the end of the settle wait, the start of a cue tone or a phase
+    deadline. Phases sleep to their deadline rather than for a fixed time.
+    """
+
+    def __init__(self, participant_id, lenses, markers, display, play_tone,
+                 is_practice=False, sleep=time.sleep, post_task_wait=lambda: random.uniform(5, 10),
+                 status_board=None, settle_wait=lambda previous, target: 1.0, preposition=False):
+        self.participant_id = participant_id
+        self.lenses = lenses
+        self.status_board = status_board
+        self.markers = markers
+        self.display = display
+        self.play_tone = play_tone
+        self.is_practice = is_practice
+        self.sleep = sleep
+        self.post_task_wait = post_task_wait
+        self.settle_wait = settle_wait
+        self.lens_power = None
+        self.preposition = preposition
+        self.prepositioned_trial = None
+        self.lens_command_time = None
+
+    def set_lens_power(self, val):
+        val = float(val)
+        self.lens_power = val
+        self.lens_command_time = self.markers.clock()
+        if any(getattr(l, "shaper", None) is not None for l in self.lenses):
+            # Overdrive pulses run on both lenses at once so the eyes are not skewed during the switch
+            from command_shaping import set_diopters
+            set_diopters(self.lenses, val)
+        else:
+            for l in self.lenses:
+                l.set_diopter(val)
+        if self.status_board is not None:
+            for i in range(len(self.lenses)):
+                self.status_board.update(i, commanded_diopter=val)
+        self.markers.send(5, marker_name(5), self.lens_command_time)
+
+    def sleep_until(self, deadline):
+        """Sleeps to a deadline on the marker clock, so phase lengths do not pick up the overhead before them."""
+        self.sleep(max(deadline - self.markers.clock(), 0.0))
+
+    def confirm_lens_power(self):
+        right_power, left_power = self.lenses[0].get_diopter(), self.lenses[-1].get_diopter()
+        if self.status_board is not None:
+            self.status_board.update(0, confirmed_diopter=right_power)
+            self.status_board.update(len(self.lenses) - 1, confirmed_diopter=left_power)
+        return right_power, left_power
+
+    def run_block(self, block, next_block=None):
+        send_marker = self.markers.send
+        start_time = datetime.now()
+
+        # Lens setting
+        if self.prepositioned_trial == block["Trial"]:
+            print(f"[INFO] Blur value {block['Blur(D)']} already set during the previous rest")
+        else:
+            self.display.show("Lens Switching...\n\n Setting blur value")
+            previous_power = self.lens_power
+            self.set_lens_power(block["Blur(D)"])
+            settle_wait = self.settle_wait(previous_power, self.lens_power)
+            settled = self.lens_command_time + settle_wait
+            self.sleep_until(settled)
+            print(f"[INFO] Setting blur value: {block['Blur(D)']} (settle wait {settle_wait * 1000:.0f} ms)")
+            send_marker(block["Lens Switch"], marker_name(block["Lens Switch"]), settled)
+
+        # Task sequence
+        if block["Task"] == "Baseline":
+            prep_text = f"Prepare for the task: {block['Task']}\n\n Look at the fixation cross"
+            self.display.show(prep_text)
+            prep_time = self.markers.clock()
+            send_marker(block["Prep Cue"], marker_name(block["Prep Cue"]), prep_time)
+            self.sleep_until(prep_time + 3)
+
+            onset = self.markers.clock()
+            self.play_tone(frequency=1500, duration=CUE_TONE_S)
+            self.display.show("+", font=("Arial", 72))
+            send_marker(block["Active Onset"], marker_name(block["Active Onset"], block["Blur(D)"]), onset)
+            self.sleep_until(onset + 10)
+            send_marker(block["Task Offset"], marker_name(block["Task Offset"], block["Blur(D)"]), onset + 10)
+
+            post_task = self.markers.clock()
+            self.play_tone(frequency=2500, duration=CUE_TONE_S)
+            self.display.show("Task Complete.\n\nPlease remain still.", font=("Arial", 36))
+            send_marker(block["Post-task"], marker_name(block["Post-task"]), post_task)
+        else:
+            prep_text = f"Prepare for the task: {block['Task']}\n\n{task_descriptions[block['Task']]}"
+            if self.is_practice:
+                prep_text = f"[Practice Run]\n\n{prep_text}"
+            self.display.show(prep_text)
+            prep_time = self.markers.clock()
+            send_marker(block["Prep Cue"], marker_name(block["Prep Cue"]), prep_time)
+            self.sleep_until(prep_time + 3)
+
+            # Active Onset is stamped at the start of the cue tone
+            onset = self.markers.clock()
+            self.play_tone(frequency=1000, duration=CUE_TONE_S)
+            active_text = f"Active Task: {block['Task']}"
+            if self.is_practice:
+                active_text = f"Active Task (Practice): {block['Task']}"
+            self.display.show(active_text)
+            send_marker(block["Active Onset"], marker_name(block["Active Onset"], block["Blur(D)"]), onset)
+            if block["Task"] == "Visuomotor":
+                self.sleep_until(onset + 20)  # 20 seconds for Visuomotor
+            else:
+                self.sleep_until(onset + 10)  # 10 seconds for other tasks
+
+            post_task = self.markers.clock()
+            self.play_tone(frequency=2000, duration=CUE_TONE_S)
+            self.display.show("Task Complete.\n\nPlease remain still.")
+            self.markers.send_many([(block["Task Offset"], marker_name(block["Task Offset"], block["Blur(D)"])),
+                                    (block["Post-task"], marker_name(block["Post-task"]))], post_task)
+
+        post_task_duration = self.post_task_wait()  # Random float between 5 and 10 seconds
+        print(f"[INFO] Post-task wait: {post_task_duration:.2f} seconds")
+        # The rest is timed from the Post-task stamp, which includes the closing tone
+        rest_end = post_task + post_task_duration
+        next_wait = None
+        if self.preposition and next_block is not None:
+            next_wait = self.settle_wait(self.lens_power, float(next_block["Blur(D)"]))
+        if next_wait is not None and next_wait <= post_task_duration:
+            # Switch as late in the rest as the settle time allows; this block's powers are read first
+            self.sleep_until(rest_end - next_wait)
+            right_power, left_power = self.confirm_lens_power()
+            self.set_lens_power(next_block["Blur(D)"])
+            # Lens Switch marks the settled lens, as in the normal switch phase
+            settled = self.lens_command_time + next_wait
+            self.sleep_until(settled)
+            send_marker(next_block["Lens Switch"], marker_name(next_block["Lens Switch"]), settled)
+            self.prepositioned_trial = next_block["Trial"]
+            print(f"[INFO] Pre-positioned blur value {next_block['Blur(D)']} for trial {next_block['Trial']}")
+        else:
+            self.sleep_until(rest_end)
+            right_power, left_power = self.confirm_lens_power()
+
+        end_time = datetime.now()
+        log_trial(
+            self.participant_id,
+            block["Trial"],
+            f"{block['Task']}_{block['Blur(D)']}",
+            right_power,
+            left_power,
+            start_time,
+            end_time
+        )
+
+        send_marker(99, marker_name(99))
+        print(f"[INFO] Trial {block['Trial']} complete.")
+        return True
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Timing QA of recorded sessions against the block protocol.
+
+For every data/<pid>/<pid>_triggers.csv (with its _trials.csv) the markers
+are assigned to blocks and every phase is timed with vectorized differences:
+
+    switch   5 (lens command)  -> 10 Lens Switch     <= 1 s settle wait
+    prep     20 Prep Cue       -> Active Onset       3 s
+    active   Active Onset      -> Task Offset        20 s Visuomotor, 10 s otherwise
+    post     70 Post-task      -> 99 Block Complete  5-10 s jittered rest
+
+Lens switches made during the previous rest (pre-positioning) count towards
+the block they prepare. Logs without a sent_time column come from the
+runner that stamped markers when they were pushed, after the cue tone: their
+prep and (non-baseline) active phases are expected to be one tone longer. A session is flagged for missing or duplicated codes,
+phases outside tolerance, robust outliers (|x - median| > 5 MAD), a trend
+in the timing error across the session (drift), and a trials.csv that
+disagrees with the triggers or logs lens powers off the commanded blur.
+Sessions run in a process pool.
+
+    python session_qa.py                      # all sessions under data/
+    python session_qa.py --output qa.csv
+"""
+
+import argparse
+import csv
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from epoching import load_triggers
+from session import CUE_TONE_S, TIMESTAMP_FORMAT, marker_base
+
+# Phase: (start category, end category, nominal low, nominal high) in seconds; None = per task
+PHASES = {
+    "switch": ("lens_command", "lens_switch", 0.0, 1.0),
+    "prep": ("prep", "active", 3.0, 3.0),
+    "active": ("active", "offset", None, None),
+    "post": ("post_task", "complete", 5.0, 10.0),
+}
+ACTIVE_S = {"Visuomotor": 20.0}
+FIXED_CATEGORIES = {5: "lens_command", 10: "lens_switch", 20: "prep", 70: "post_task", 99: "complete"}
+CATEGORIES = ("lens_command", "lens_switch", "prep", "active", "offset", "post_task", "complete")
+TASK_BY_BASE = {base: task for task, base in marker_base.items()}
+
+
+def read_trials(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    trials = np.array([int(row["trial"]) for row in rows], int)
+    ends = np.array([datetime.strptime(row["end_time"], TIMESTAMP_FORMAT).timestamp() for row in rows])
+    # Commanded blur against the powers read back from both lenses
+    blur = np.array([float(row["condition"].rsplit("_", 1)[1]) for row in rows])
+    powers = np.array([[float(row["right_power"]), float(row["left_power"])] for row in rows])
+    return trials, ends, np.abs(powers - blur[:, None]).max(axis=1)
+
+
+def push_stamped(triggers_path):
+    """True for trigger logs written before markers were stamped with their event time (no sent_time column)."""
+    with open(triggers_path, newline="") as f:
+        return "sent_time" not in next(csv.reader(f), [])
+
+
+def categorize(codes):
+    """Category index (into CATEGORIES, -1 for unknown codes) and task name per marker."""
+    category = np.full(len(codes), -1)
+    for code, name in FIXED_CATEGORIES.items():
+        category[codes == code] = CATEGORIES.index(name)
+    in_task_range = np.isin(codes - codes % 10, list(TASK_BY_BASE))
+    category[in_task_range & (codes % 10 < 5)] = CATEGORIES.index("active")
+    category[in_task_range & (codes % 10 >= 5)] = CATEGORIES.index("offset")
+    tasks = np.array([TASK_BY_BASE.get(code - code % 10, "") for code in codes.tolist()])
+    return category, tasks
+
+
+def assign_blocks(codes):
+    """Block index per marker; lens switch markers after the block's Post-task belong to the next block."""
+    complete = codes == 99
+    block = np.cumsum(complete) - complete
+    posted = np.cumsum(codes == 70) > block
+    prepositioned = posted & np.isin(codes, (5, 10))
+    return block + prepositioned
+
+
+def robust_outliers(values, threshold=5.0):
+    values = values[~np.isnan(values)]
+    if len(values) < 5:
+        return 0
+    deviation = np.abs(values - np.median(values))
+    mad = np.median(deviation) * 1.4826
+    return int((deviation > threshold * max(mad, 1e-3)).sum())
+
+
+def check_session(triggers_path, tolerance=0.1, power_tolerance=0.1):
+    """
+    QA row for one session. Phases are flagged when off by more than
+    tolerance (s), and drift when the fitted error trend accumulates more than
+    tolerance over the session.
+    """
+    participant = os.path.basename(triggers_path)[:-len("_triggers.csv")]
+    times, codes, _ = load_triggers(triggers_path)
+    codes = codes.astype(int)
+    report = {"participant": participant, "markers": len(codes), "push_stamped": push_stamped(triggers_path),
+              "flags": []}
+    if not len(codes):
+        report["flags"].append("empty trigger log")
+        return report
+
+    category, tasks = categorize(codes)
+    block = assign_blocks(codes)
+    n_blocks = int(block.max()) + 1
+    report["blocks"] = n_blocks
+    report["unknown_codes"] = sorted(set(codes[category < 0].tolist()))
+    if report["unknown_codes"]:
+        report["flags"].append(f"unknown codes {report['unknown_codes']}")
+
+    # Per block and category: marker count and time of its first occurrence
+    counts = np.zeros((n_blocks, len(CATEGORIES)), int)
+    first = np.full((n_blocks, len(CATEGORIES)), np.nan)
+    known = category >= 0
+    np.add.at(counts, (block[known], category[known]), 1)
+    order = np.lexsort((times[known], category[known], block[known]))
+    b, c, t = block[known][order], category[known][order], times[known][order]
+    leading = np.ones(len(b), bool)
+    leading[1:] = (b[1:] != b[:-1]) | (c[1:] != c[:-1])
+    first[b[leading], c[leading]] = t[leading]
+
+    missing, duplicated = counts == 0, counts > 1
+    for name, mask in (("missing", missing), ("duplicated", duplicated)):
+        per_category = {CATEGORIES[j]: int(mask[:, j].sum()) for j in range(len(CATEGORIES)) if mask[:, j].any()}
+        report[name] = per_category
+        if per_category:
+            report["flags"].append(f"{name} {per_category}")
+
+    active_index = np.where(category == CATEGORIES.index("active"))[0]
+    block_task = np.full(n_blocks, "", dtype=object)
+    block_task[block[active_index]] = tasks[active_index]
+    # Push-stamped onsets follow the cue tone, and so do the offsets of all tasks but Baseline
+    tone = CUE_TONE_S if report["push_stamped"] else 0.0
+
+    for phase, (start, end, low, high) in PHASES.items():
+        duration = first[:, CATEGORIES.index(end)] - first[:, CATEGORIES.index(start)]
+        if phase == "prep":
+            low, high = low + tone, high + tone
+        if low is None:
+            nominal = np.array([ACTIVE_S.get(task, 10.0) + (tone if task != "Baseline" else 0.0)
+                                for task in block_task])
+            error = duration - nominal
+        else:
+            error = np.where(duration < low, duration - low, np.where(duration > high, duration - high, 0.0))
+        valid = ~np.isnan(error)
+        report[f"{phase}_mean_s"] = float(np.nanmean(duration)) if valid.any() else None
+        report[f"{phase}_max_error_ms"] = float(np.abs(error[valid]).max() * 1e3) if valid.any() else None
+        out_of_range = int((np.abs(error[valid]) > tolerance).sum())
+        outliers = robust_outliers(error) if low is None or low == high else 0
+        report[f"{phase}_violations"] = out_of_range
+        report[f"{phase}_outliers"] = outliers
+        if out_of_range:
+            report["flags"].append(f"{phase} out of range in {out_of_range} blocks")
+        if outliers:
+            report["flags"].append(f"{phase} outliers in {outliers} blocks")
+        if valid.sum() >= 5 and (low is None or low == high):
+            slope = float(np.polyfit(np.where(valid)[0], error[valid], 1)[0])
+            report[f"{phase}_drift_ms_per_block"] = slope * 1e3
+            if abs(slope) * (n_blocks - 1) > tolerance:
+                report["flags"].append(f"{phase} drifts {slope * 1e3:+.1f} ms/block")
+
+    trials = read_trials(triggers_path[:-len("_triggers.csv")] + "_trials.csv")
+    if trials is None:
+        report["flags"].append("no trials.csv")
+    else:
+        numbers, ends, power_error = trials
+        report["trials"] = len(numbers)
+        if len(numbers) != int((~missing[:, CATEGORIES.index("complete")]).sum()):
+            report["flags"].append(f"{len(numbers)} trials logged for {n_blocks} blocks")
+        if len(np.unique(numbers)) != len(numbers) or np.any(np.diff(numbers) <= 0):
+            report["flags"].append("trial numbers not strictly increasing")
+        # Each trial ends just before its Block Complete marker
+        complete = first[:len(numbers), CATEGORIES.index("complete")]
+        lag = complete - ends[:len(complete)]
+        if np.any(np.abs(lag[~np.isnan(lag)]) > 1.0):
+            report["flags"].append("trials.csv end times disagree with Block Complete markers")
+        off_target = int((power_error > power_tolerance).sum())
+        report["power_mismatches"] = off_target
+        if off_target:
+            report["flags"].append(f"lens power off target in {off_target} trials")
+    return report
+
+
+def find_sessions(data_dir="data"):
+    return sorted(glob.glob(os.path.join(data_dir, "*", "*_triggers.csv")))
+
+
+def run(paths, workers=None, tolerance=0.1):
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(check_session, paths, [tolerance] * len(paths),
+                             chunksize=max(1, len(paths) // (4 * (workers or os.cpu_count() or 1)))))
+
+
+def write_report(reports, path):
+    fields = []
+    for report in reports:
+        fields += [key for key in report if key not in fields]
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for report in reports:
+            writer.writerow({key: "; ".join(value) if key == "flags" else value for key, value in report.items()})
+
+
+if __name__ == "__main__":
+    import time
+
+    parser = argparse.ArgumentParser(description="Check recorded session timing against the block protocol.")
+    parser.add_argument("--data", default="data", help="folder with one sub-folder per participant")
+    parser.add_argument("--output", default="session_qa.csv")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed phase timing error (s)")
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    paths = find_sessions(args.data)
+    reports = run(paths, args.workers, args.tolerance)
+    write_report(reports, args.output)
+    flagged = [r for r in reports if r["flags"]]
+    for report in flagged:
+        print(f"[QA] {report['participant']}: " + "; ".join(report["flags"]))
+    print(f"[INFO] {len(reports)} sessions checked in {time.perf_counter() - start:.2f} s, "
+          f"{len(flagged)} flagged -> {args.output}")
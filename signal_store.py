@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped fNIRS signal store.
+
+A recording is ingested chunk by chunk into
+
+    signal_store/<pid>/signal.f32     samples x channels, float32, row major
+    signal_store/<pid>/times.f64      sample times (POSIX s, the send_marker clock)
+    signal_store/<pid>/markers.npz    trigger times and codes from <pid>_triggers.csv
+    signal_store/<pid>/meta.json      channel names, sampling rate, sample count
+
+so no step ever holds the whole recording in memory. Readers memory-map the
+files: time slices are found by binary search on the time index, epochs are
+gathered straight from the map (epoching.extract_epochs accepts it), and
+map_chunks runs a function over fixed-size chunks in worker processes.
+
+LSL recordings are timestamped with local_clock(); align_clock() finds the
+offset to the wall clock of the trigger log from the marker stream recorded
+alongside the data.
+
+    store = ingest("P01", read_csv_chunks("P01_fnirs.csv"), channel_names, sfreq=10.0,
+                   trigger_path="data/P01/P01_triggers.csv")
+    data = store.slice_time(t0, t0 + 30.0)
+"""
+
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from epoching import load_triggers
+
+STORE_DIR = "signal_store"
+
+
+def read_csv_chunks(path, chunk_rows=65536, time_column=0):
+    """(times, data) chunks from a CSV export with one header row and a time column."""
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        next(reader)
+        rows = []
+        for row in reader:
+            rows.append(row)
+            if len(rows) == chunk_rows:
+                yield _split_rows(rows, time_column)
+                rows = []
+        if rows:
+            yield _split_rows(rows, time_column)
+
+
+def _split_rows(rows, time_column):
+    values = np.array(rows, float)
+    return values[:, time_column], np.delete(values, time_column, axis=1)
+
+
+def read_xdf_chunks(path, stream_type="NIRS", chunk_rows=65536):
+    """
+    (times, data) chunks of the first stream of stream_type in an XDF file,
+    plus the recorded marker stream (times, codes) for align_clock. pyxdf
+    has no streaming reader, so the whole XDF file is loaded into memory
+    first; chunking only bounds the float copies made while ingesting.
+    """
+    import pyxdf
+    streams, _ = pyxdf.load_xdf(path)
+    data_stream = next(s for s in streams if s["info"]["type"][0] == stream_type)
+    marker_stream = next((s for s in streams if s["info"]["type"][0] == "Markers"), None)
+    markers = None
+    if marker_stream is not None:
+        markers = (np.asarray(marker_stream["time_stamps"]), np.asarray(marker_stream["time_series"]).ravel())
+    times, series = data_stream["time_stamps"], data_stream["time_series"]
+    chunks = ((times[i:i + chunk_rows], np.asarray(series[i:i + chunk_rows], float))
+              for i in range(0, len(times), chunk_rows))
+    return chunks, markers
+
+
+def align_clock(stream_times, stream_codes, log_times, log_codes):
+    """
+    Offset (s) to add to LSL timestamps to land on the trigger log clock: the
+    median difference over markers matched in order by code.
+    """
+    offsets = []
+    j = 0
+    for t, code in zip(stream_times, stream_codes):
+        while j < len(log_codes) and log_codes[j] != int(code):
+            j += 1
+        if j == len(log_codes):
+            break
+        offsets.append(log_times[j] - t)
+        j += 1
+    if not offsets:
+        raise Exception("No marker in the recording matches the trigger log")
+    return float(np.median(offsets))
+
+
+def ingest(participant_id, chunks, channel_names, sfreq, trigger_path=None, clock_offset=0.0, directory=STORE_DIR):
+    """Appends (times, data) chunks to a new store for participant_id and returns it opened."""
+    path = os.path.join(directory, participant_id)
+    os.makedirs(path, exist_ok=True)
+    n_samples = 0
+    with open(os.path.join(path, "signal.f32"), "wb") as signal_file, \
+            open(os.path.join(path, "times.f64"), "wb") as times_file:
+        for times, data in chunks:
+            data = np.asarray(data, np.float32)
+            if data.shape[1] != len(channel_names):
+                raise Exception(f"Chunk has {data.shape[1]} channels, expected {len(channel_names)}")
+            signal_file.write(np.ascontiguousarray(data).tobytes())
+            times_file.write((np.asarray(times, np.float64) + clock_offset).tobytes())
+            n_samples += len(data)
+
+    if trigger_path is not None:
+        marker_times, marker_codes, _ = load_triggers(trigger_path)
+        np.savez(os.path.join(path, "markers.npz"), times=marker_times, codes=marker_codes)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"participant": participant_id, "channels": list(channel_names), "sfreq": sfreq,
+                   "n_samples": n_samples, "clock_offset": clock_offset}, f, indent=2)
+    return SignalStore(path)
+
+
+class SignalStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.channels = self.meta["channels"]
+        self.sfreq = self.meta["sfreq"]
+        shape = (self.meta["n_samples"], len(self.channels))
+        self.data = np.memmap(os.path.join(path, "signal.f32"), np.float32, "r", shape=shape)
+        self.times = np.memmap(os.path.join(path, "times.f64"), np.float64, "r", shape=(shape[0],))
+
+    def __len__(self):
+        return len(self.times)
+
+    def markers(self):
+        """(times, codes) of the trigger log, or empty arrays when none was ingested."""
+        path = os.path.join(self.path, "markers.npz")
+        if not os.path.isfile(path):
+            return np.array([]), np.array([], int)
+        with np.load(path) as markers:
+            return markers["times"], markers["codes"]
+
+    def index(self, t):
+        return int(np.searchsorted(self.times, t))
+
+    def slice_time(self, t0, t1):
+        """Samples with t0 <= time < t1 as a memory-mapped view."""
+        return self.data[self.index(t0):self.index(t1)]
+
+    def iter_chunks(self, chunk_size=65536, overlap=0):
+        """(start, times, data) views; consecutive chunks share 'overlap' samples (e.g. for filter warm-up)."""
+        step = _chunk_step(chunk_size, overlap)
+        for start in range(0, len(self), step):
+            stop = min(start + chunk_size, len(self))
+            yield start, self.times[start:stop], self.data[start:stop]
+            if stop == len(self):
+                break
+
+    def map_chunks(self, fn, chunk_size=65536, overlap=0, workers=None):
+        """
+        fn(times, data) over every chunk in worker processes; each worker maps
+        the files itself, so only results cross process boundaries. fn must be
+        a module-level function. Results come back in chunk order.
+        """
+        step = _chunk_step(chunk_size, overlap)
+        ranges = [(start, min(start + chunk_size, len(self))) for start in range(0, max(len(self) - overlap, 1), step)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(_run_chunk, [(self.path, fn, start, stop) for start, stop in ranges]))
+
+
+def _chunk_step(chunk_size, overlap):
+    if not 0 <= overlap < chunk_size:
+        raise ValueError(f"overlap must be in [0, chunk_size), got {overlap} for chunk_size {chunk_size}")
+    return chunk_size - overlap
+
+
+def _run_chunk(task):
+    path, fn, start, stop = task
+    store = SignalStore(path)
+    return fn(store.times[start:stop], store.data[start:stop])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Ingest an fNIRS recording into a memory-mapped signal store.")
+    parser.add_argument("participant")
+    parser.add_argument("recording", help="CSV export (time column first) or LSL .xdf recording")
+    parser.add_argument("--sfreq", type=float, required=True)
+    parser.add_argument("--triggers", help="trigger log (default data/<pid>/<pid>_triggers.csv)")
+    parser.add_argument("--store", default=STORE_DIR)
+    parser.add_argument("--chunk-rows", type=int, default=65536)
+    args = parser.parse_args()
+
+    trigger_path = args.triggers or os.path.join("data", args.participant, f"{args.participant}_triggers.csv")
+    offset = 0.0
+    if args.recording.endswith(".xdf"):
+        chunks, markers = read_xdf_chunks(args.recording, chunk_rows=args.chunk_rows)
+        if markers is not None and os.path.isfile(trigger_path):
+            log_times, log_codes, _ = load_triggers(trigger_path)
+            offset = align_clock(markers[0], markers[1], log_times, log_codes)
+        first = next(chunks)
+        channel_names = [f"ch{i + 1}" for i in range(first[1].shape[1])]
+        chunks = (chunk for source in ([first], chunks) for chunk in source)
+    else:
+        with open(args.recording, newline="") as f:
+            channel_names = next(csv.reader(f))[1:]
+        chunks = read_csv_chunks(args.recording, args.chunk_rows)
+
+    store = ingest(args.participant, chunks, channel_names, args.sfreq,
+                   trigger_path if os.path.isfile(trigger_path) else None, offset, args.store)
+    print(f"[INFO] {len(store)} samples x {len(store.channels)} channels -> {store.path} (clock offset {offset:+.3f} s)")
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Startup helpers for the experiment scripts: deferred imports, background
+initialization and a timer that reports where startup time goes.
+
+    timer = StartupTimer()
+    np = lazy_import("numpy", timer)           # imported on first attribute access
+    outlet = background(make_outlet, timer)    # Future, built while the form is open
+    ...
+    timer.mark("participant form shown")
+    timer.report()
+"""
+
+import importlib
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="startup")
+
+
+class StartupTimer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.marks = []
+        self.durations = []
+        self._lock = threading.Lock()
+
+    def mark(self, name):
+        with self._lock:
+            self.marks.append((name, time.perf_counter() - self.start))
+
+    def record(self, name, duration):
+        with self._lock:
+            self.durations.append((name, duration))
+
+    def report(self):
+        for name, duration in self.durations:
+            print(f"[STARTUP] {name:<34} {duration * 1000:8.1f} ms")
+        for name, elapsed in self.marks:
+            print(f"[STARTUP] {name:<34} {elapsed * 1000:8.1f} ms after launch")
+
+
+class LazyModule:
+    """Module proxy that performs the real import on first attribute access."""
+
+    def __init__(self, name, timer=None):
+        self._name = name
+        self._timer = timer
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                already_loaded = self._name in sys.modules
+                start = time.perf_counter()
+                self._module = importlib.import_module(self._name)
+                if self._timer is not None and not already_loaded:
+                    self._timer.record(f"import {self._name}", time.perf_counter() - start)
+        return self._module
+
+    def preload(self):
+        """Imports the module now (e.g. on a background thread) so the first real use does not pay for it."""
+        return self._load()
+
+    def __getattr__(self, attr):
+        return getattr(self._module or self._load(), attr)
+
+
+def lazy_import(name, timer=None):
+    return LazyModule(name, timer)
+
+
+def background(fn, timer=None, name=None):
+    """Runs fn() on a startup worker thread and returns its Future."""
+    label = name or getattr(fn, "__name__", "task")
+
+    def run():
+        start = time.perf_counter()
+        result = fn()
+        if timer is not None:
+            timer.record(f"{label} (background)", time.perf_counter() - start)
+        return result
+
+    return _executor.submit(run)